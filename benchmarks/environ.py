@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+    Environ setup cost
+    ~~~~~~~~~~~~~~~~~~
+
+    Measures :meth:`xmppflask.server.XmppWsgiServer.setup_environ` of the
+    native engine for parsed stanzas when lazy values stay untouched, as
+    for most views, against computing all of them, as eager environ did:
+    raw XML serialization, delay timestamp parsing and presence priority.
+
+    Usage::
+
+        python benchmarks/environ.py [number of stanzas]
+
+    :license: BSD
+"""
+
+import os
+import sys
+import timeit
+from xml.etree import ElementTree as etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from xmppflask import XmppFlask
+from xmppflask.server.native import NativeXmppWsgiServer
+from xmppflask.server.xmlstream import make_stanza
+
+
+STANZAS = [
+    ('message', u"<message xmlns='jabber:client' from='k.bx@ya.ru/home'"
+                u" to='bot@ya.ru' type='chat' id='m1'><body>echo hello"
+                u" world</body><active xmlns="
+                u"'http://jabber.org/protocol/chatstates'/></message>"),
+    ('delayed message', u"<message xmlns='jabber:client' from='k.bx@ya.ru"
+                        u"/home' to='bot@ya.ru' type='chat' id='m2'><body>"
+                        u"ping</body><delay xmlns='urn:xmpp:delay'"
+                        u" from='ya.ru' stamp='2014-02-10T12:30:00Z'/>"
+                        u"</message>"),
+    ('presence', u"<presence xmlns='jabber:client' from='k.bx@ya.ru/home'"
+                 u" to='bot@ya.ru'><show>away</show><status>out</status>"
+                 u"<priority>5</priority><c xmlns='http://jabber.org/"
+                 u"protocol/caps' hash='sha-1' node='http://psi-im.org'"
+                 u" ver='q07IKJEyjvHSyhy//CH0CxmKi8w='/></presence>"),
+]
+
+
+class Client(object):
+    """Takes handlers of the capabilities, there is no connection."""
+
+    def register_handler(self, name, handler):
+        pass
+
+
+def make_server():
+    server = NativeXmppWsgiServer(XmppFlask('environ_benchmark'))
+    server.xmpp = Client()
+    server.register_capability('std')
+    server.register_capability('XEP-0203')
+    return server
+
+
+def run(func, number):
+    func()  # warm up
+    return number / min(timeit.repeat(func, repeat=3, number=number))
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    server = make_server()
+    setup_environ = server.setup_environ
+    print '%-16s %14s %14s %8s' % ('stanza', 'lazy ops/s', 'eager ops/s',
+                                   'speedup')
+    for name, xml in STANZAS:
+        stanza = make_stanza(etree.fromstring(xml.encode('utf-8')))
+        lazy = run(lambda: setup_environ(stanza), number)
+        eager = run(lambda: setup_environ(stanza).resolve(), number)
+        print '%-16s %14.0f %14.0f %7.2fx' % (name, lazy, eager,
+                                              lazy / eager)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+    End-to-end loopback throughput
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Injects generated messages and presences into
+    :class:`xmppflask.server.loopback.LoopbackWsgiServer` serving a small
+    app with routes of various kinds and in-memory sessions, so the whole
+    pipeline is measured: environ setup, capabilities, request context,
+    routing, sessions and response dispatching.
+
+    Reports stanzas/sec, latency percentiles of every pipeline stage and
+    objects allocated per request. Python 2 has no allocation tracer, so
+    allocations are counted as growth of garbage collector generation 0
+    counter, i.e. container objects (dicts, lists, instances) created and
+    not yet freed within the stage; objects retained after the whole run
+    are reported as well.
+
+    Usage::
+
+        python benchmarks/loopback.py [number of stanzas] [number of users]
+
+    Stages nest: `session` is also part of `view`, everything is part of
+    `total`.
+
+    :license: BSD
+"""
+
+import gc
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from xmppflask import XmppFlask
+from xmppflask.sessions import MemorySessionInterface
+from xmppflask.server.loopback import LoopbackWsgiServer, Message, Presence
+
+STAGES = ('environ', 'routing', 'session', 'view', 'response', 'total')
+
+
+def make_app():
+    app = XmppFlask('loopback_benchmark')
+    app.config['DEBUG'] = False
+    app.session_interface = MemorySessionInterface()
+
+    @app.route(u'ping')
+    def ping():
+        return u'pong'
+
+    @app.route(u'echo <text>')
+    def echo(text):
+        return text
+
+    @app.route(u'add <int:a> <int:b>')
+    def add(a, b):
+        return u'%d' % (a + b)
+
+    @app.route(u'count')
+    def count():
+        from xmppflask import session
+        session['count'] = session.get('count', 0) + 1
+        return u'%d' % session['count']
+
+    @app.route(u'steps')
+    def steps():
+        yield u'one'
+        yield u'two'
+
+    @app.route_presence()
+    def presence():
+        return 'presence', {'type': 'available'}
+
+    return app
+
+
+def make_stanzas(count, users, seed=42):
+    """Yields `count` stanzas from `users` JIDs: 90% of messages (one in
+    ten doesn't match any route), the rest are presences. Users activity
+    follows zipfian distribution."""
+    rnd = random.Random(seed)
+    jids = [u'user%d@example.com/res' % idx for idx in xrange(users)]
+    weights = [1.0 / (rank + 1) for rank in xrange(users)]
+    total = sum(weights)
+    cumulative = []
+    acc = 0.0
+    for weight in weights:
+        acc += weight / total
+        cumulative.append(acc)
+    bodies = [u'ping', u'echo hello', u'add 2 3', u'count', u'steps',
+              u'ping', u'count', u'echo world', u'add 40 2',
+              u'no such command']
+    from bisect import bisect_left
+    for idx in xrange(count):
+        jid = jids[min(users - 1, bisect_left(cumulative, rnd.random()))]
+        if idx % 10 == 9:
+            yield Presence(jid, show=rnd.choice((u'away', u'dnd', None)))
+        else:
+            yield Message(jid, rnd.choice(bodies))
+
+
+class Stages(object):
+    """Wraps pipeline methods of server and app to time them."""
+
+    def __init__(self, server):
+        self.timer = timeit.default_timer
+        self.current = dict.fromkeys(STAGES, 0.0)
+        self.allocs = dict.fromkeys(STAGES, 0)
+        self.samples = dict((stage, []) for stage in STAGES)
+        self.alloc_samples = dict((stage, []) for stage in STAGES)
+        app = server.app
+        self.wrap(server, 'setup_environ', 'environ')
+        self.wrap(server, 'dispatch_app_response', 'response')
+        self.wrap(app, 'request_context', 'routing')
+        self.wrap(app, 'full_dispatch_request', 'view')
+        self.wrap(app, 'open_session', 'session')
+        self.wrap(app, 'save_session', 'session')
+
+    def wrap(self, obj, name, stage):
+        func = getattr(obj, name)
+        timer = self.timer
+        current = self.current
+        allocs = self.allocs
+
+        def timed(*args, **kwargs):
+            count = gc.get_count()[0]
+            started = timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                current[stage] += timer() - started
+                allocs[stage] += max(0, gc.get_count()[0] - count)
+        setattr(obj, name, timed)
+
+    def run(self, func, arg):
+        count = gc.get_count()[0]
+        started = self.timer()
+        func(arg)
+        self.current['total'] = self.timer() - started
+        self.allocs['total'] = max(0, gc.get_count()[0] - count)
+        for stage in STAGES:
+            self.samples[stage].append(self.current[stage])
+            self.alloc_samples[stage].append(self.allocs[stage])
+            self.current[stage] = 0.0
+            self.allocs[stage] = 0
+
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    app = make_app()
+    server = LoopbackWsgiServer(app)
+    server.connect('bot@example.com', None)
+    server.inject_many(make_stanzas(1000, users, seed=1))  # warm up
+    stages = Stages(server)
+
+    gc.collect()
+    objects = len(gc.get_objects())
+    # gen0 counter only grows while collector is off
+    gc.disable()
+    handle = server.handle
+    run = stages.run
+    try:
+        elapsed = timeit.default_timer()
+        for stanza in make_stanzas(count, users):
+            run(handle, stanza)
+            if gc.get_count()[0] > 100000:
+                gc.enable()
+                gc.collect()
+                gc.disable()
+        elapsed = timeit.default_timer() - elapsed
+    finally:
+        gc.enable()
+    gc.collect()
+    retained = len(gc.get_objects()) - objects
+
+    print '%d stanzas from %d users in %.2fs: %.0f stanzas/s' % (
+        count, users, elapsed, count / elapsed)
+    print 'sent: %s in %d writes' % (
+        ', '.join('%s=%d' % item for item in sorted(server.xmpp.sent.items())),
+        server.xmpp.writes)
+    print 'retained objects: %d (%.3f per stanza)' % (retained,
+                                                     retained / float(count))
+    print
+    print '%-9s %9s %9s %9s %9s %11s' % ('stage', 'p50 us', 'p95 us',
+                                         'p99 us', 'max us', 'allocs/req')
+    for stage in STAGES:
+        samples = sorted(stages.samples[stage])
+        allocs = stages.alloc_samples[stage]
+        print '%-9s %9.1f %9.1f %9.1f %9.1f %11.1f' % (
+            stage,
+            percentile(samples, 0.5) * 1e6,
+            percentile(samples, 0.95) * 1e6,
+            percentile(samples, 0.99) * 1e6,
+            samples[-1] * 1e6,
+            sum(allocs) / float(len(allocs)))
+
+
+if __name__ == '__main__':
+    main()
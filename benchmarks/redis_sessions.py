@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+    Redis sessions round trips
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Injects messages of many users into
+    :class:`xmppflask.server.loopback.LoopbackWsgiServer` serving an app
+    which updates :class:`xmppflask.sessions.RedisSessionInterface`
+    sessions, handling them one by one and in batches, which load sessions
+    by a single ``MGET`` and write them by a single pipeline.
+
+    Runs against in-process fake unless Redis address is given, with the
+    fake only round trips per stanza are meaningful.
+
+    Usage::
+
+        python benchmarks/redis_sessions.py [number of stanzas] [host:port]
+
+    :license: BSD
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from xmppflask import XmppFlask
+from xmppflask.sessions import RedisSessionInterface
+from xmppflask.server.loopback import LoopbackWsgiServer, Message
+from xmppflask.tests.helpers import FakeRedis
+
+
+def make_server(address):
+    app = XmppFlask('redis_sessions_benchmark')
+    if address is None:
+        app.session_interface = RedisSessionInterface(client=FakeRedis())
+    else:
+        host, port = address.rsplit(':', 1)
+        app.session_interface = RedisSessionInterface(
+            host, int(port), namespace='xmppflask:benchmark:%s')
+
+    @app.route(u'count')
+    def count():
+        from xmppflask import session
+        session['count'] = session.get('count', 0) + 1
+        return u'%d' % session['count']
+
+    @app.route(u'peek')
+    def peek():
+        from xmppflask import session
+        return u'%d' % session.get('count', 0)
+
+    server = LoopbackWsgiServer(app)
+    server.connect('bot@ya.ru', None)
+    return server
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    address = sys.argv[2] if len(sys.argv) > 2 else None
+    stanzas = [Message('user%d@ya.ru/home' % random.randrange(1000),
+                       random.choice([u'count', u'peek']))
+               for _ in xrange(number)]
+    print '%-6s %12s %16s' % ('batch', 'stanzas/s', 'trips/stanza')
+    for batch in (1, 16, 128):
+        server = make_server(address)
+        started = time.time()
+        server.inject_many(stanzas, batch=batch)
+        elapsed = time.time() - started
+        trips = server.app.session_interface.stats()['round_trips']
+        print '%-6d %12.0f %16.3f' % (batch, number / elapsed,
+                                      float(trips) / number)
+
+
+if __name__ == '__main__':
+    main()
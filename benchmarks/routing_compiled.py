@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+    Linear vs compiled route dispatching
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares :meth:`xmppflask.routing.MapAdapter.match` with rules tried one
+    by one against :class:`xmppflask.routing.CompiledRules` dispatching for
+    route tables of 10, 100 and 1000 rules. Commands starting with a static
+    word leave few candidates after prefix trie, so both modes match them
+    one by one; commands starting with a converter are candidates for every
+    message, that's what compiled dispatching is for.
+
+    Usage::
+
+        python benchmarks/routing_compiled.py [number of matches]
+
+    :license: BSD
+"""
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from xmppflask.exceptions import NotFound
+from xmppflask.routing import Map, Rule
+
+
+def make_rules(count, lead):
+    rules = []
+    for idx in xrange(count):
+        kind = idx % 3
+        if kind == 0:
+            rules.append(Rule(lead + u'command%d' % idx, endpoint='e%d' % idx))
+        elif kind == 1:
+            rules.append(Rule(lead + u'command%d <arg>' % idx,
+                              endpoint='e%d' % idx))
+        else:
+            rules.append(Rule(lead + u'command%d <int:n> times' % idx,
+                              endpoint='e%d' % idx))
+    return rules
+
+
+def make_messages(count, size, lead):
+    rnd = random.Random(count)
+    messages = []
+    for _ in xrange(size):
+        idx = rnd.randrange(count)
+        kind = idx % 3
+        if rnd.random() < 0.1:
+            messages.append(lead + u'no such command %d' % idx)
+        elif kind == 0:
+            messages.append(lead + u'command%d' % idx)
+        elif kind == 1:
+            messages.append(lead + u'command%d foo' % idx)
+        else:
+            messages.append(lead + u'command%d 42 times' % idx)
+    return messages
+
+
+def run(count, number, leading):
+    lead = (u'<bot> ', u'bot ') if leading else (u'', u'')
+    messages = make_messages(count, 1000, lead[1])
+    results = []
+    for compiled in (False, True):
+        adapter = Map(make_rules(count, lead[0]), compiled=compiled).bind()
+
+        def dispatch():
+            for message in messages:
+                try:
+                    adapter.match(message)
+                except NotFound:
+                    pass
+
+        dispatch()  # warm up lazy structures
+        loops = max(1, number // len(messages))
+        elapsed = min(timeit.repeat(dispatch, repeat=3, number=loops))
+        results.append(loops * len(messages) / elapsed)
+    return results
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print '%-9s %6s %15s %15s %8s' % ('leading', 'rules', 'linear ops/s',
+                                      'compiled ops/s', 'speedup')
+    for leading in (False, True):
+        for count in (10, 100, 1000):
+            linear, compiled = run(count, number, leading)
+            print '%-9s %6d %15.0f %15.0f %7.1fx' % (
+                'converter' if leading else 'word', count, linear, compiled,
+                compiled / linear)
+
+
+if __name__ == '__main__':
+    main()
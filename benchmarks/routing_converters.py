@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+    Converter application cost
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures :meth:`xmppflask.routing.MapAdapter.match` for routes with 0, 1
+    and 4 converters, both for identity converters (``string``) and ones
+    that have to convert values (``int``).
+
+    Usage::
+
+        python benchmarks/routing_converters.py [number of matches]
+
+    :license: BSD
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from xmppflask.routing import Map, Rule
+
+
+CASES = [
+    ('0 converters', u'move north now', u'move north now'),
+    ('1 string', u'move <a>', u'move north'),
+    ('1 int', u'move <int:a>', u'move 1'),
+    ('4 string', u'move <a> <b> <c> <d>', u'move n e s w'),
+    ('4 int', u'move <int:a> <int:b> <int:c> <int:d>', u'move 1 2 3 4'),
+]
+
+
+def run(rule, message, number, compiled):
+    adapter = Map([Rule(rule, endpoint='move')], compiled=compiled).bind()
+    adapter.match(message)  # warm up lazy structures
+    elapsed = min(timeit.repeat(lambda: adapter.match(message),
+                                repeat=3, number=number))
+    return number / elapsed
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print '%-14s %15s %15s' % ('route', 'linear ops/s', 'compiled ops/s')
+    for name, rule, message in CASES:
+        print '%-14s %15.0f %15.0f' % (name,
+                                       run(rule, message, number, False),
+                                       run(rule, message, number, True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+    Routing benchmark suite
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Reproducible benchmarks for :class:`xmppflask.routing.Map` building
+    (which binds every :class:`~xmppflask.routing.Rule`),
+    :meth:`~xmppflask.routing.MapAdapter.match` and
+    :meth:`~xmppflask.routing.MapAdapter.build`.
+
+    Route tables and message corpora are synthetic, generated from a fixed
+    seed: literal commands, converter-heavy commands, commands restricted by
+    ``from_jid`` and presence rules. Messages hit rules with a zipfian
+    distribution (a few popular commands, a long tail) plus 10% of messages
+    that match nothing.
+
+    Every scenario is a setup function returning list of operations, each
+    one is timed separately. Scenarios report ops/sec and per-operation
+    latency percentiles.
+    Results are compared with ``benchmarks/baselines.json``; the run fails
+    (exit status 1) if ops/sec dropped or p95 latency grew by more than the
+    tolerance. Baselines are machine specific and aren't kept in the
+    repository: the first run records ones of missing scenarios, ``--save``
+    replaces them all, e.g. before making changes::
+
+        python benchmarks/routing_suite.py --save
+        python benchmarks/routing_suite.py [--tolerance 0.2] [scenario ...]
+
+    :license: BSD
+"""
+
+import gc
+import json
+import optparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from xmppflask.exceptions import NotFound
+from xmppflask.routing import Map, Rule
+
+SEED = 20111
+RULES = 200
+CORPUS = 2000
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'baselines.json')
+
+
+def make_rules(count, rnd):
+    """Returns list of `(rule factory, message factory, build values)` for
+    a synthetic route table of `count` rules."""
+    table = []
+    for idx in xrange(count):
+        kind = rnd.choice(('literal', 'literal', 'converters', 'from_jid',
+                           'presence'))
+        endpoint = '%s%d' % (kind, idx)
+        if kind == 'literal':
+            table.append((
+                lambda i=idx, e=endpoint: Rule(u'command%d' % i, endpoint=e),
+                lambda r, i=idx: (u'command%d' % i, 'message', 'u@x.org'),
+                {}))
+        elif kind == 'converters':
+            table.append((
+                lambda i=idx, e=endpoint: Rule(
+                    u'set%d <name> <int:a> <float:b> <int(max_=99):c>' % i,
+                    endpoint=e),
+                lambda r, i=idx: (u'set%d key %d %d.5 %d' % (
+                    i, r.randrange(1000), r.randrange(10), r.randrange(100)),
+                    'message', 'u@x.org'),
+                {'name': u'key', 'a': 1, 'b': 0.5, 'c': 7}))
+        elif kind == 'from_jid':
+            table.append((
+                lambda i=idx, e=endpoint: Rule(
+                    u'admin%d <target>' % i, from_jid=r'.*@admin\.org',
+                    endpoint=e),
+                lambda r, i=idx: (u'admin%d kick' % i, 'message',
+                                  r.choice(('root@admin.org', 'u@x.org'))),
+                {'target': u'kick'}))
+        else:
+            table.append((
+                lambda i=idx, e=endpoint: Rule(
+                    u'status%d <text>' % i, event_type='presence',
+                    endpoint=e),
+                lambda r, i=idx: (u'status%d away' % i, 'presence',
+                                  'u@x.org'),
+                {'text': u'away'}))
+    return table
+
+
+def make_corpus(table, size, rnd):
+    """Picks rules with zipfian popularity, one in ten messages misses."""
+    weights = [1.0 / (rank + 1) for rank in xrange(len(table))]
+    order = range(len(table))
+    rnd.shuffle(order)
+    total = sum(weights)
+    corpus = []
+    for _ in xrange(size):
+        if rnd.random() < 0.1:
+            corpus.append((u'unknown command %d' % rnd.randrange(size),
+                           'message', 'u@x.org'))
+            continue
+        point = rnd.random() * total
+        for rank, weight in enumerate(weights):
+            point -= weight
+            if point <= 0:
+                break
+        corpus.append(table[order[rank]][1](rnd))
+    return corpus
+
+
+def scenarios():
+    rnd = random.Random(SEED)
+    table = make_rules(RULES, rnd)
+    corpus = make_corpus(table, CORPUS, rnd)
+    builds = [(rule_f().endpoint, values) for rule_f, _, values in table]
+
+    def build_map(compiled=False, match_cache_size=None):
+        return Map([rule_f() for rule_f, _, _ in table], compiled=compiled,
+                   match_cache_size=match_cache_size)
+
+    def map_build():
+        return [lambda: build_map().update()]
+
+    def matcher(**kwargs):
+        def setup():
+            match = build_map(**kwargs).bind().match
+
+            def op(message, event_type, from_jid):
+                try:
+                    match(message, event_type=event_type, from_jid=from_jid)
+                except NotFound:
+                    pass
+            ops = [lambda args=args: op(*args) for args in corpus]
+            for warm_up in ops:  # lazy compiled rules, steady cache state
+                warm_up()
+            return ops
+        return setup
+
+    def builder():
+        build = build_map().bind().build
+        return [lambda e=endpoint, v=values: build(e, v)
+                for endpoint, values in builds]
+
+    return [
+        ('map.build', map_build, 50),
+        ('adapter.match', matcher(), 10),
+        ('adapter.match[compiled]', matcher(compiled=True), 10),
+        ('adapter.match[cached]', matcher(match_cache_size=1024), 10),
+        ('adapter.build', builder, 50),
+    ]
+
+
+def measure(setup, rounds):
+    """Calls `setup` `rounds` times and times every operation it returns
+    separately. Returns ops/sec of the best round and latency percentiles
+    over all rounds in microseconds. Garbage collector is disabled while
+    timing, as :mod:`timeit` does."""
+    timer = timeit.default_timer
+    samples = []
+    best = None
+    for _ in xrange(rounds):
+        elapsed = 0.0
+        ops = setup()
+        gc.collect()
+        gc.disable()
+        try:
+            for op in ops:
+                started = timer()
+                op()
+                spent = timer() - started
+                samples.append(spent)
+                elapsed += spent
+        finally:
+            gc.enable()
+        if best is None or len(ops) / elapsed > best:
+            best = len(ops) / elapsed
+    samples.sort()
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))] * 1e6
+
+    return {'ops': best, 'p50': percentile(0.5), 'p95': percentile(0.95),
+            'p99': percentile(0.99)}
+
+
+def compare(result, baseline, tolerance):
+    """Returns list of regressions of `result` against `baseline`."""
+    problems = []
+    if result['ops'] < baseline['ops'] * (1 - tolerance):
+        problems.append('ops/s %.0f < %.0f' % (result['ops'], baseline['ops']))
+    if result['p95'] > baseline['p95'] * (1 + tolerance):
+        problems.append('p95 %.1fus > %.1fus' % (result['p95'],
+                                                 baseline['p95']))
+    return problems
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('--baselines', default=BASELINES,
+                      help='baselines file [%default]')
+    parser.add_option('--save', action='store_true',
+                      help='store results as new baselines')
+    parser.add_option('--tolerance', type='float', default=0.25,
+                      help='allowed relative drift [%default]')
+    parser.add_option('--rounds', type='int', default=None,
+                      help='override rounds for every scenario')
+    options, names = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(options.baselines):
+        with open(options.baselines) as f:
+            baselines = json.load(f)
+
+    failed = False
+    results = {}
+    print '%-24s %12s %10s %10s %10s  %s' % ('scenario', 'ops/s', 'p50 us',
+                                            'p95 us', 'p99 us', 'baseline')
+    for name, setup, rounds in scenarios():
+        if names and name not in names:
+            continue
+        result = measure(setup, options.rounds or rounds)
+        if options.save or name not in baselines:
+            results[name] = result
+            verdict = 'saved'
+        else:
+            problems = compare(result, baselines[name], options.tolerance)
+            failed = failed or bool(problems)
+            verdict = 'REGRESSION: ' + ', '.join(problems) if problems \
+                else 'ok'
+        print '%-24s %12.0f %10.1f %10.1f %10.1f  %s' % (
+            name, result['ops'], result['p50'], result['p95'], result['p99'],
+            verdict)
+
+    if results:
+        baselines.update(results)
+        with open(options.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
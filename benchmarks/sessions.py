@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+    In-memory sessions concurrency
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures :class:`xmppflask.sessions.MemorySessionInterface` throughput
+    of open, update and save session cycles from 1, 4 and 16 threads, with
+    a single shard, i.e. one lock for all sessions, against the default
+    number of shards.
+
+    Usage::
+
+        python benchmarks/sessions.py [cycles per thread] [number of users]
+
+    :license: BSD
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from xmppflask import XmppFlask
+from xmppflask.sessions import MemorySessionInterface
+
+
+class Request(object):
+
+    def __init__(self, jid):
+        self.environ = {'xmpp.jid': jid}
+
+
+def worker(app, interface, requests):
+    for request in requests:
+        session = interface.open_session(app, request)
+        session['visits'] = session.get('visits', 0) + 1
+        interface.save_session(app, session, None)
+
+
+def run(shards, threads, cycles, users):
+    app = XmppFlask('sessions_benchmark')
+    interface = MemorySessionInterface(shards=shards)
+    jids = ['user%d@ya.ru' % idx for idx in xrange(users)]
+    workers = []
+    for _ in xrange(threads):
+        requests = [Request(random.choice(jids)) for _ in xrange(cycles)]
+        workers.append(threading.Thread(target=worker,
+                                        args=(app, interface, requests)))
+    started = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return threads * cycles / (time.time() - started)
+
+
+def main():
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    print '%-8s %14s %14s %8s' % ('threads', '1 shard ops/s', '16 shards ops/s',
+                                  'speedup')
+    for threads in (1, 4, 16):
+        single = run(1, threads, cycles, users)
+        sharded = run(16, threads, cycles, users)
+        print '%-8d %14.0f %14.0f %7.2fx' % (threads, single, sharded,
+                                             sharded / single)
+
+
+if __name__ == '__main__':
+    main()
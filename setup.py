@@ -31,7 +31,7 @@ setup(
     extras_require={
         'sleekxmpp': ["sleekxmpp>=1.1.2"],
         'xmpppy': ["xmpppy>=0.5.0rc1"],
-        'redis': ['redis>=2.4'],
+        'redis': ['redis>=2.10'],
         'tests': ['mock', 'unittest2'],
         'dev': ['sleekxmpp', 'xmpppy', 'mock', 'nose', 'coverage']
     }
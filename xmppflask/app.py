@@ -48,7 +48,44 @@ class XmppFlask(_PackageBoundObject):
     default_config = ImmutableDict({
         'DEBUG': True,
         #: Non permanent session lifetime in seconds. One hour by default.
-        'SESSION_TTL': 3600
+        'SESSION_TTL': 3600,
+        #: Number of threads running app for incoming stanzas. Zero means
+        #: to run it in XMPP library event thread.
+        'XMPPWSGI_WORKERS': 0,
+        #: Maximum number of stanzas waiting for a free worker.
+        'XMPPWSGI_QUEUE_SIZE': 100,
+        #: What to do with stanza if queue is full: ``block``,
+        #: ``drop_oldest`` or ``reject``.
+        'XMPPWSGI_QUEUE_OVERFLOW': 'block',
+        #: Reply to messages rejected due to full queue.
+        'XMPPWSGI_REJECT_MESSAGE': None,
+        #: Incoming stanza types to drop before they reach app, e.g.
+        #: ``('error', 'headline')``.
+        'XMPPWSGI_IGNORED_TYPES': (),
+        #: Bare JIDs whose stanzas are dropped before they reach app.
+        'XMPPWSGI_BLOCKED_JIDS': (),
+        #: Number of last incoming stanza IDs remembered per server to drop
+        #: duplicates. Zero disables the check.
+        'XMPPWSGI_DUPLICATES_WINDOW': 0,
+        #: Maximum number of outgoing stanzas buffered by XMPPWSGI server
+        #: to be written to the stream at once. Buffer is also flushed at
+        #: the end of every dispatch cycle, stanzas sent outside of it are
+        #: written immediately. Zero disables buffering.
+        'XMPPWSGI_SEND_BATCH': 100,
+        #: Maximum average number of outgoing stanzas per second, those
+        #: over the limit wait in queue. Zero means no limit.
+        'XMPPWSGI_RATE_LIMIT': 0,
+        #: Number of outgoing stanzas which could be sent at once.
+        'XMPPWSGI_RATE_BURST': 10,
+        #: Maximum average number of stanzas per second for a single
+        #: recipient. Zero means no limit.
+        'XMPPWSGI_RECIPIENT_RATE_LIMIT': 0,
+        #: Number of stanzas which could be sent to a recipient at once.
+        'XMPPWSGI_RECIPIENT_RATE_BURST': 5,
+        #: Dict of outgoing lanes weights: ``reply``, ``presence`` and
+        #: ``bulk``. The more weight, the bigger share of writes lane gets
+        #: when stanzas wait. None means ``8``, ``2`` and ``1``.
+        'XMPPWSGI_LANE_WEIGHTS': None
     })
 
     #: The rule object to use for route rules created.  This is used by
@@ -145,7 +182,7 @@ class XmppFlask(_PackageBoundObject):
         """A decorator that's provides a link between presence event and
         his handler func. Example::
 
-            @app.route_presence(from_jid='*@xmpp.ru)
+            @app.route_presence(from_jid=r'.*@xmpp\.ru')
             def index():
                 if 'handled_presences' not in session:
                     session['handled_presences'] = 0
@@ -227,9 +264,9 @@ class XmppFlask(_PackageBoundObject):
         :param pwd: Password for specified JID.
         :type pwd: str
 
-        :param engine: XMPP backend library. Currently supported xmpppy and
-                       SleekXMPP. Possible shortcuts: xmpp, sleek. Values are
-                       case insensitive.
+        :param engine: XMPP backend library. Currently supported xmpppy,
+                       SleekXMPP and native. Possible shortcuts: xmpp, sleek.
+                       Values are case insensitive.
         :type engine: str
 
         :raises:
@@ -254,10 +291,16 @@ class XmppFlask(_PackageBoundObject):
         implementation, check :meth:`open_session`. Instead of overriding this
         method we recommend replacing the :class:`session_interface`.
 
+        Sessions which were not changed are not written, the
+        :attr:`session_interface` is asked to refresh them instead.
+
         :param session: the session to be saved
         :param response: an instance of :attr:`response_class`
         """
-        return self.session_interface.save_session(self, session, response)
+        interface = self.session_interface
+        if not interface.should_save_session(self, session):
+            return interface.refresh_session(self, session, response)
+        return interface.save_session(self, session, response)
 
     def make_null_session(self):
         """Creates a new instance of a missing session.  Instead of overriding
@@ -328,8 +371,16 @@ class XmppFlask(_PackageBoundObject):
         """
         ctx = _request_ctx_stack.top
         bp = ctx.request.blueprint # TODO: does this really needed?
-        if not self.session_interface.is_null_session(ctx.session):
-            self.save_session(ctx.session, response)
+        session = ctx.session
+        if self.session_interface.is_null_session(session):
+            pass
+        elif getattr(response, 'lazy', False):
+            # generator view changes session while response is iterated,
+            # so it's known whether it has to be saved only at the end
+            response.call_on_close(
+                lambda: self.save_session(session, response))
+        else:
+            self.save_session(session, response)
         funcs = ()
         if bp is not None and bp in self.after_request_funcs:
             funcs = reversed(self.after_request_funcs[bp])
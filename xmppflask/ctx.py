@@ -107,9 +107,17 @@ class RequestContext(object):
         else:
             self._implicit_app_ctx_stack.append(None)
 
+        top = _request_ctx_stack.top
         _request_ctx_stack.push(self)
 
-        self.session = self.app.open_session(self.request)
+        # the server and the app push contexts of the same request, which
+        # should share the session instead of loading it twice
+        if top is not None and top.request.environ is self.request.environ:
+            self.session = top.session
+            return
+        if self.session is None:
+            # resumed responses bring the session of their request
+            self.session = self.app.open_session(self.request)
         if self.session is None:
             self.session = self.app.make_null_session()
 
@@ -8,13 +8,25 @@
 """
 
 import re
-from itertools import izip
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import chain, izip
+from threading import Lock, RLock
 
 from .exceptions import NotFound
 from .thirdparty.werkzeug import ImmutableDict, MultiDict
 from .thirdparty.werkzeug import get_converter, parse_rule
 
 
+#: bucket key for event and stanza types that no rule asks for
+_other = object()
+
+# sentinel
+_missing = object()
+
+_inf = float('inf')
+
+
 class BuildError(Exception):
     pass
 
@@ -56,7 +68,7 @@ class UnicodeConverter(BaseConverter):
     regex = '.'
 
     def __init__(self, map_, minlength=1, maxlength=None, length=None):
-        super(UnicodeConverter, self).__init__(map)
+        super(UnicodeConverter, self).__init__(map_)
         if length is not None:
             length = '{%d}' % int(length)
         else:
@@ -173,6 +185,58 @@ class ValidationError(ValueError):
     pass
 
 
+def is_identity_converter(converter):
+    """Checks if converter returns matched values as is, so there is no
+    need to call its :meth:`~BaseConverter.to_python` at all.
+
+    :internal:
+    """
+    to_python = getattr(type(converter).to_python, 'im_func', None)
+    return to_python is BaseConverter.to_python.im_func
+
+
+#: regex syntax characters, patterns without them are plain strings
+_jid_pattern_special = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+
+class JidPattern(object):
+    """Compiled ``from_jid`` pattern of a :class:`Rule`. Matches sender JID
+    string with :func:`re.match` semantics, i.e. from its very beginning.
+
+    Plain string patterns (``'admin@localhost'``) are matched as a string
+    prefix and ``'.*' + plain string`` ones (``'.*@xmpp\\.ru'``, dots may
+    be escaped) as a substring, both without the regex engine.
+
+    :internal:
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        tail = pattern[2:] if pattern.startswith('.*') else ''
+        if not _jid_pattern_special.search(pattern):
+            self.kind = 'prefix'
+            self.match = self._match_prefix
+            self.literal = pattern
+        elif tail and not _jid_pattern_special.search(tail.replace('\\.', '')):
+            self.kind = 'contains'
+            self.match = self._match_contains
+            self.literal = tail.replace('\\.', '.')
+        else:
+            self.kind = 'regex'
+            self.match = re.compile(pattern).match
+            self.literal = None
+
+    def _match_prefix(self, jid):
+        return jid.startswith(self.literal)
+
+    def _match_contains(self, jid):
+        return self.literal in jid
+
+    def __repr__(self):
+        return '<%s %s %r>' % (self.__class__.__name__, self.kind,
+                               self.pattern)
+
+
 class Rule(object):
     """Rule to handle single message"""
 
@@ -194,6 +258,11 @@ class Rule(object):
         self._weights = None
         self._converters = None
         self._regex = None
+        self._parts = None
+        self._prefix = None
+        self._from_jid = None
+        self._match_key = None
+        self._conversions = None
 
         if defaults is not None:
             self.arguments = set(map(str, defaults))
@@ -218,55 +287,100 @@ class Rule(object):
         self._trace = []
         self._converters = {}
         self._weights = []
+        self._parts = []
 
         regex_parts = []
+        conversions = []
         for converter, arguments, variable in parse_rule(rule):
             if converter is None:
                 regex_parts.append(re.escape(variable))
+                self._parts.append((None, re.escape(variable)))
                 self._trace.append((False, variable))
                 self._weights.append(len(variable))
             else:
                 convobj = get_converter(map_, converter, arguments)
                 regex_parts.append('(?P<%s>%s)' % (variable, convobj.regex))
+                self._parts.append((variable, convobj.regex))
                 self._converters[variable] = convobj
+                to_python = None
+                if not is_identity_converter(convobj):
+                    to_python = convobj.to_python
+                conversions.append((variable, str(variable), to_python))
                 self._trace.append((True, variable))
                 self._weights.append(convobj.weight)
                 self.arguments.add(str(variable))
                 if convobj.is_greedy:
                     self.greediness += 1
 
+        self._conversions = tuple(conversions)
+
         regex = u''.join(regex_parts)
         if self.strict:
             regex = '^' + regex + '$'
         self._regex = re.compile(regex, re.UNICODE)
 
+        if self.from_jid is not None:
+            self._from_jid = map_.jid_pattern(self.from_jid)
+
+        self._match_key = self.match_key()
+
+        # non strict rules may match anywhere in the message, so only
+        # strict ones are bound to their leading static segment
+        if self.strict and self._trace and not self._trace[0][0]:
+            self._prefix = self._trace[0][1]
+        else:
+            self._prefix = u''
+
     def match(self, message, event_type, from_jid, type):
         """Check if rule matches a given message"""
+        if not self.applies_to(event_type, from_jid, type):
+            return
+
+        m = self._regex.search(message)
+        if m is not None:
+            return self.convert(m.groupdict())
+
+    def applies_to(self, event_type, from_jid, type):
+        """Check if rule handles stanzas of given kind and sender.
+
+        :internal:
+        """
         if self.event_type is not None and event_type is not None:
             if self.event_type != event_type:
-                return
+                return False
 
         if self.type is not None and type is not None:
             if self.type != type:
-                return
+                return False
 
-        if self.from_jid is not None and from_jid is not None:
-            if not re.match(self.from_jid, from_jid):
-                return
+        if self._from_jid is not None and from_jid is not None:
+            if not self._from_jid.match(from_jid):
+                return False
 
-        m = self._regex.search(message)
-        if m is not None:
-            groups = m.groupdict()
-            result = {}
-            for name, value in groups.iteritems():
+        return True
+
+    def convert(self, groups):
+        """Turn the dict of matched groups into view arguments with
+        converters :meth:`~BaseConverter.to_python`. Returns `None` if any
+        converter rejects its value.
+
+        Conversion plan is prepared by :meth:`bind`: converters that don't
+        override :meth:`~BaseConverter.to_python` are not called at all.
+
+        :internal:
+        """
+        result = {}
+        for variable, name, to_python in self._conversions:
+            value = groups[variable]
+            if to_python is not None:
                 try:
-                    value = self._converters[name].to_message(value)
+                    value = to_python(value)
                 except ValidationError:
                     return
-                result[str(name)] = value
-            if self.defaults is not None:
-                result.update(self.defaults)
-            return result
+            result[name] = value
+        if self.defaults is not None:
+            result.update(self.defaults)
+        return result
 
     def build(self, values):
         """
@@ -321,6 +435,21 @@ class Rule(object):
             self.endpoint
         )
 
+    def match_key(self):
+        """Sort key that orders rules exactly like :meth:`match_compare`
+        does. Rules with equal keys keep the order they were added in.
+
+        :internal:
+        """
+        # higher weights go first; on a common prefix the longer rule goes
+        # first, so the end is marked with a value above every weight
+        weights = tuple(-weight for weight in self._weights)
+        return (weights + (_inf,),
+                bool(self.arguments),
+                self.defaults is not None,
+                -self.greediness,
+                len(self.arguments))
+
     def match_compare(self, other):
         """Compare this object with another one for matching.
         Needed to match "hello world" rule before "hello" rule ("hello"
@@ -359,16 +488,431 @@ class Rule(object):
         return self.match_compare(other) # not sure if that's right
 
 
+class CompiledRules(object):
+    """Sequence of bound rules merged into alternation regexes, so a single
+    search resolves the winning rule and its arguments instead of running
+    every rule regex in turn.
+
+    Rules are expected in :meth:`Rule.match_compare` order. Alternatives
+    keep that order, so the first one that matches is exactly the rule the
+    linear scan would pick. If the winner is rejected afterwards (sender
+    JID or converter validation) the search continues linearly from the
+    next rule.
+
+    :internal:
+    """
+
+    #: Python 2 ``re`` refuses patterns with more than 100 groups, so rules
+    #: are split into several regexes that stay below this limit.
+    max_groups = 99
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._chunks = []
+
+        alternatives = []
+        entries = {}
+        ngroups = 0
+        start = 0
+        for pos, rule in enumerate(self.rules):
+            pattern, groups, size = self._compile_rule(rule, ngroups + 1)
+            if alternatives and ngroups + size > self.max_groups:
+                self._add_chunk(alternatives, entries, start, pos)
+                alternatives, entries, ngroups, start = [], {}, 0, pos
+                pattern, groups, size = self._compile_rule(rule, 1)
+            alternatives.append(pattern)
+            entries[ngroups + 1] = (pos, groups)
+            ngroups += size
+        if alternatives:
+            self._add_chunk(alternatives, entries, start, len(self.rules))
+
+    def _compile_rule(self, rule, index):
+        """Returns rule alternative with positional groups starting from
+        `index`, list of ``(name, group index)`` pairs for the converters and
+        the total number of groups used."""
+        parts = []
+        groups = []
+        size = 1
+        for variable, regex in rule._parts:
+            if variable is None:
+                parts.append(regex)
+                continue
+            groups.append((variable, index + size))
+            parts.append('(%s)' % regex)
+            size += 1 + re.compile(regex).groups
+        pattern = u''.join(parts)
+        if rule.strict:
+            pattern = u'(%s$)' % pattern
+        else:
+            pattern = u'([\\s\\S]*?%s)' % pattern
+        return pattern, groups, size
+
+    def _add_chunk(self, alternatives, entries, start, stop):
+        try:
+            regex = re.compile(u'|'.join(alternatives), re.UNICODE)
+        except (re.error, AssertionError):
+            # converter regex that can't live in alternation (named or
+            # referenced groups); keep these rules on the linear path
+            regex = None
+        self._chunks.append((regex, entries, start, stop))
+
+    def match(self, message, event_type, from_jid, type):
+        """Returns ``(rule, view_args)`` pair for the first matched rule or
+        `None`."""
+        for regex, entries, start, stop in self._chunks:
+            if regex is None:
+                rv = self._match_linear(start, stop, message,
+                                        event_type, from_jid, type)
+                if rv is not None:
+                    return rv
+                continue
+            m = regex.match(message)
+            if m is None:
+                continue
+            pos, groups = entries[m.lastindex]
+            rule = self.rules[pos]
+            if rule.applies_to(event_type, from_jid, type):
+                rv = rule.convert(dict((name, m.group(idx))
+                                       for name, idx in groups))
+                if rv is not None:
+                    return rule, rv
+            return self._match_linear(pos + 1, len(self.rules), message,
+                                      event_type, from_jid, type)
+
+    def _match_linear(self, start, stop, message, event_type, from_jid, type):
+        for idx in xrange(start, stop):
+            rule = self.rules[idx]
+            rv = rule.match(message, event_type, from_jid, type)
+            if rv is not None:
+                return rule, rv
+
+
+class PrefixTrie(object):
+    """Trie over the static leading segments of rule patterns, used to pick
+    candidate rules for a message without running their regexes.
+
+    Rules without a leading static segment (leading converter, empty or non
+    strict pattern) are candidates for every message. Candidates keep the
+    order of the given rules, which are expected in
+    :meth:`Rule.match_compare` order.
+
+    :internal:
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._root = {}
+        self._always = []
+        for pos, rule in enumerate(self.rules):
+            if not rule._prefix:
+                self._always.append(pos)
+                continue
+            node = self._root
+            for char in rule._prefix:
+                node = node.setdefault(char, {})
+            # None is never a message character, so it marks rule positions
+            node.setdefault(None, []).append(pos)
+
+    def candidates(self, message):
+        """Returns list of rules that may match the message."""
+        rules = self.rules
+        return [rules[pos] for pos in self.positions(message)]
+
+    def positions(self, message):
+        """Returns sorted list of :attr:`rules` indexes of
+        :meth:`candidates`."""
+        positions = None
+        node = self._root
+        for char in message:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                if positions is None:
+                    positions = self._always + node[None]
+                else:
+                    positions.extend(node[None])
+        if positions is None:
+            return self._always
+        positions.sort()
+        return positions
+
+
+class RuleBucket(object):
+    """Rules that may handle stanzas of a single ``(event_type, type)`` pair,
+    wildcard ones included, in :meth:`Rule.match_compare` order together
+    with the indexes used to dispatch them.
+
+    :internal:
+    """
+
+    #: prefix trie leaves few candidates for most messages, which are
+    #: matched faster one by one than by a search over their alternation,
+    #: so :attr:`Map.compiled` applies only to this many candidates or more
+    min_compiled = 8
+
+    def __init__(self, map_, rules):
+        self.map = map_
+        self.rules = rules
+        self.prefix_trie = map_.prefix_trie_class(rules)
+        #: :class:`CompiledRules` by :meth:`PrefixTrie.positions` of them
+        self._compiled_candidates = {}
+        #: whether result depends on sender JID
+        self.restricted = any(rule.from_jid is not None for rule in rules)
+
+    def compiled_candidates(self, positions):
+        """:class:`CompiledRules` for rules at :meth:`PrefixTrie.positions`,
+        one per distinct candidates set, built on first use."""
+        key = tuple(positions)
+        compiled = self._compiled_candidates.get(key)
+        if compiled is None:
+            rules = self.rules
+            compiled = self.map.compiled_rules_class(
+                [rules[pos] for pos in positions])
+            self._compiled_candidates[key] = compiled
+        return compiled
+
+    def match(self, message, event_type, from_jid, type):
+        """Returns ``(rule, view_args)`` pair for the first matched rule or
+        `None`."""
+        positions = self.prefix_trie.positions(message)
+        if self.map.compiled and len(positions) >= self.min_compiled:
+            return self.compiled_candidates(positions).match(
+                message, event_type, from_jid, type)
+        # rules commonly share sender restrictions, so every distinct
+        # pattern runs at most once and the rest is a dict lookup
+        verdicts = {}
+        rules = self.rules
+        for pos in positions:
+            rule = rules[pos]
+            if rule._from_jid is not None and from_jid is not None:
+                verdict = verdicts.get(rule._from_jid)
+                if verdict is None:
+                    verdict = bool(rule._from_jid.match(from_jid))
+                    verdicts[rule._from_jid] = verdict
+                if not verdict:
+                    continue
+            rv = rule.match(message, event_type, None, type)
+            if rv is not None:
+                return rule, rv
+
+
+class MatchCache(object):
+    """Bounded LRU cache of :meth:`MapAdapter.match` results. Misses are
+    cached as well, so repeated unknown commands are cheap too.
+
+    :param maxsize: maximum number of cached results.
+
+    :internal:
+    """
+
+    #: messages longer than this are not cached to keep memory bounded.
+    max_message_length = 256
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        #: token of the data cached, see :meth:`clear`
+        self.generation = None
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        """Stores the value unless the cache was cleared for another
+        `generation` of data meanwhile."""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self, generation=None):
+        with self._lock:
+            self._data.clear()
+            self.generation = generation
+
+
+class EndpointBuilder(object):
+    """Builds messages for a single endpoint. Rules are indexed by the
+    frozenset of argument names they require, so picking candidates for a
+    set of values is a dict lookup, and messages of static rules (no
+    converters) are rendered once.
+
+    Rules are expected in :meth:`Rule.match_compare` order; the first one
+    that is :meth:`Rule.suitable_for` given values and builds a message
+    wins, as it did with a plain scan.
+
+    :internal:
+    """
+
+    #: maximum number of remembered value key sets
+    max_candidates = 256
+
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        self._entries = []
+        for rule in self.rules:
+            defaults = rule.defaults or {}
+            required = frozenset(rule.arguments) - frozenset(defaults)
+            static = None
+            if not rule._converters:
+                static = rule.build({})
+            self._entries.append((rule, required, frozenset(rule.arguments),
+                                  tuple(defaults.items()), static))
+        self._candidates = {}
+
+    def candidates(self, keys):
+        """Returns entries of rules whose required arguments are all in
+        `keys` frozenset."""
+        rv = self._candidates.get(keys)
+        if rv is None:
+            rv = tuple(entry for entry in self._entries if entry[1] <= keys)
+            if len(self._candidates) < self.max_candidates:
+                self._candidates[keys] = rv
+        return rv
+
+    def build(self, values):
+        """Returns message for the first suitable rule or `None`."""
+        keys = frozenset(values)
+        for rule, _, arguments, defaults, static in self.candidates(keys):
+            if defaults and arguments <= keys:
+                if any(value != values[key] for key, value in defaults):
+                    continue
+            if static is not None:
+                return static
+            rv = rule.build(values)
+            if rv is not None:
+                return rv
+
+
+class MapIndex(object):
+    """Immutable snapshot of everything :class:`MapAdapter` needs to dispatch
+    and build messages. :class:`Map` replaces it as a whole on rebuild, so
+    concurrent readers see either the old or the new one, never a half
+    updated state.
+
+    Rules are partitioned into buckets for every known event type and
+    stanza type plus `None` (no filter) and :data:`_other` (value that no
+    rule asks for).
+
+    :internal:
+    """
+
+    def __init__(self, map_, rules, rules_by_endpoint):
+        event_types = set(rule.event_type for rule in rules)
+        event_types.discard(None)
+        types = set(rule.type for rule in rules)
+        types.discard(None)
+
+        buckets = {}
+        for event_type in chain((None, _other), event_types):
+            for type in chain((None, _other), types):
+                bucket_rules = [rule for rule in rules
+                                if rule.applies_to(event_type, None, type)]
+                buckets[event_type, type] = map_.bucket_class(map_,
+                                                              bucket_rules)
+
+        self.rules = tuple(rules)
+        self.rules_by_endpoint = dict((endpoint, tuple(endpoint_rules))
+                                      for endpoint, endpoint_rules
+                                      in rules_by_endpoint.iteritems())
+        self.builders = dict((endpoint, map_.builder_class(endpoint_rules))
+                             for endpoint, endpoint_rules
+                             in rules_by_endpoint.iteritems())
+        self.buckets = buckets
+        self.event_types = frozenset(event_types)
+        self.types = frozenset(types)
+
+    def bucket(self, event_type=None, type=None):
+        """Returns :class:`RuleBucket` with rules that could handle stanzas
+        of given event type and stanza type. `None` stands for any value as
+        it does for :meth:`Rule.match`.
+        """
+        bucket = self.buckets.get((event_type, type))
+        if bucket is None:
+            if event_type not in self.event_types:
+                event_type = None if event_type is None else _other
+            if type not in self.types:
+                type = None if type is None else _other
+            bucket = self.buckets[event_type, type]
+        return bucket
+
+
 class Map(object):
-    """Map of routes and their handlers"""
+    """Map of routes and their handlers
+
+    :param rules: sequence of :class:`Rule` to add.
+    :param converters: additional converters for this map.
+    :param compiled: if `True`, dispatch through :class:`CompiledRules`
+                     instead of trying candidate rules one by one. Pays
+                     off only if many rules remain candidates for a
+                     message, e.g. ones starting with a converter.
+    :param match_cache_size: if set, keep up to this number of recent match
+                             results in :attr:`match_cache`.
+    """
 
     #: for more on converters see http://werkzeug.pocoo.org/docs/routing/
     default_converters = ImmutableDict(DEFAULT_CONVERTERS)
 
-    def __init__(self, rules=None, converters=None):
+    #: the class used for :attr:`compiled` dispatching.
+    compiled_rules_class = CompiledRules
+
+    #: the class used to prefilter rules by message body.
+    prefix_trie_class = PrefixTrie
+
+    #: the class used to group rules by event and stanza type.
+    bucket_class = RuleBucket
+
+    #: the class used for :attr:`match_cache`.
+    match_cache_class = MatchCache
+
+    #: the class used to build messages for an endpoint.
+    builder_class = EndpointBuilder
+
+    #: the class of dispatch snapshots built by :meth:`update`.
+    index_class = MapIndex
+
+    def __init__(self, rules=None, converters=None, compiled=False,
+                 match_cache_size=None):
         self._rules = []
         self._rules_by_endpoint = {}
+        #: rules in match order and their :meth:`Rule.match_key` values
+        self._sorted_rules = []
+        self._sorted_keys = []
         self._remap = True
+        self._index = None
+        #: current index while the map is frozen, `None` otherwise
+        self._frozen = None
+        self._jid_patterns = {}
+        self._lock = RLock()
+
+        #: dispatch mode, see :class:`CompiledRules`. May be switched at
+        #: any time.
+        self.compiled = compiled
+
+        #: :class:`MatchCache` in front of :meth:`MapAdapter.match` or
+        #: `None` if disabled. Its ``hits`` and ``misses`` counters help to
+        #: choose the size.
+        self.match_cache = None
+        if match_cache_size:
+            self.match_cache = self.match_cache_class(match_cache_size)
 
         self.converters = self.default_converters.copy()
         if converters:
@@ -376,18 +920,46 @@ class Map(object):
         for rulefactory in rules or ():
             self.add(rulefactory)
 
+    @property
+    def frozen(self):
+        """Whether the map is frozen by :meth:`freeze`."""
+        return self._frozen is not None
+
     def add(self, rulefactory):
         """Add a new rule to the map and bind it.
 
         :param rule: a :class:`Rule`
+
+        :raises:
+            :exc:`RuntimeError`: If map is frozen.
         """
-        for rule in rulefactory.get_rules(self):
-            rule.bind(self)
-            self._rules.append(rule)
-            (self._rules_by_endpoint
-             .setdefault(rule.endpoint, [])
-             .append(rule))
-        self._remap = True
+        with self._lock:
+            if self._frozen is not None:
+                raise RuntimeError('map %r is frozen, thaw() it to add'
+                                   ' new rules' % self)
+            for rule in rulefactory.get_rules(self):
+                rule.bind(self)
+                self._rules.append(rule)
+                key = rule._match_key
+                idx = bisect_right(self._sorted_keys, key)
+                self._sorted_keys.insert(idx, key)
+                self._sorted_rules.insert(idx, rule)
+                rules = list(self._rules_by_endpoint.get(rule.endpoint, ()))
+                idx = bisect_right([item._match_key for item in rules], key)
+                rules.insert(idx, rule)
+                self._rules_by_endpoint[rule.endpoint] = rules
+            self._remap = True
+
+    def jid_pattern(self, pattern):
+        """Returns :class:`JidPattern` for given ``from_jid`` pattern. Rules
+        with the same pattern share single instance.
+
+        :internal:
+        """
+        rv = self._jid_patterns.get(pattern)
+        if rv is None:
+            rv = self._jid_patterns[pattern] = JidPattern(pattern)
+        return rv
 
     def bind(self, message=None, event_type=None, from_jid=None, type=None):
         return MapAdapter(self, message=message,
@@ -400,11 +972,43 @@ class Map(object):
                          type=environ.get('xmpp.stanza_type'))
 
     def update(self):
+        """Rebuilds :class:`MapIndex` if rules were added since the last
+        call and returns the current one.
+        """
         if self._remap:
-            self._rules.sort(lambda a, b: a.match_compare(b))
-            for rules in self._rules_by_endpoint.itervalues():
-                rules.sort(lambda a, b: a.match_compare(b))
-            self._remap = False
+            with self._lock:
+                if self._remap:
+                    self._index = self.index_class(self, self._sorted_rules,
+                                                   self._rules_by_endpoint)
+                    self._remap = False
+                    if self.match_cache is not None:
+                        self.match_cache.clear(self._index)
+        return self._index
+
+    def freeze(self):
+        """Finalizes rules ordering and dispatch indexes. Until :meth:`thaw`
+        is called adding rules raises :exc:`RuntimeError` and matching goes
+        straight to the prebuilt index without checking for changes.
+
+        Called by XMPPWSGI servers once the XMPP session starts.
+        """
+        with self._lock:
+            self._frozen = self.update()
+
+    def thaw(self):
+        """Allows to add rules to a frozen map again. Dispatching keeps using
+        the current index until the next :meth:`update` or :meth:`freeze`
+        replaces it in a single step.
+        """
+        with self._lock:
+            self._frozen = None
+
+    def bucket(self, event_type=None, type=None):
+        """Returns :class:`RuleBucket` of the current index.
+
+        :internal:
+        """
+        return self.update().bucket(event_type, type)
 
 
 class MapAdapter(object):
@@ -422,23 +1026,33 @@ class MapAdapter(object):
         parameters to call (or use somehow).
         """
         # TODO: redirects maybe
-        self.map.update()
+        index = self.map._frozen or self.map.update()
         message = message or self.message
         event_type = event_type or self.event_type
         from_jid = from_jid or self.from_jid
         type = type or self.type
-        for rule in self.map._rules:
-            rv = rule.match(message=message,
-                            event_type=event_type,
-                            from_jid=str(from_jid),
-                            type=type)
-            if rv is None:
-                continue
-            if return_rule:
-                return rule, rv
-            else:
-                return rule.endpoint, rv
-        raise NotFound()
+        bucket = index.bucket(event_type, type)
+        from_jid = str(from_jid)
+        cache = self.map.match_cache
+        if cache is None or len(message) > cache.max_message_length:
+            rv = bucket.match(message, event_type, from_jid, type)
+        else:
+            key = (message, event_type, type,
+                   from_jid if bucket.restricted else None)
+            rv = cache.get(key, _missing)
+            if rv is _missing:
+                rv = bucket.match(message, event_type, from_jid, type)
+                # results of a replaced index never get into the cache
+                cache.set(key, rv, index)
+        if rv is None:
+            raise NotFound()
+        rule, rv = rv
+        if cache is not None:
+            rv = dict(rv)  # views must not alter cached arguments
+        if return_rule:
+            return rule, rv
+        else:
+            return rule.endpoint, rv
 
     def build(self, endpoint, values=None):
         """Building messages that suite certain endpoint with valutes (params).
@@ -446,7 +1060,7 @@ class MapAdapter(object):
         In XMPP world it might be not as must-have feature, but still it's
         needed and nice.
         """
-        self.map.update()
+        index = self.map._frozen or self.map.update()
         if values:
             if isinstance(values, MultiDict):
                 values = dict((k, v) for k, v in values.iteritems(multi=True)
@@ -457,16 +1071,14 @@ class MapAdapter(object):
         else:
             values = {}
 
-        rv = self._partial_build(endpoint, values)
+        rv = self._partial_build(index, endpoint, values)
         if rv is None:
             raise BuildError(endpoint, values)
         message = rv
 
         return message
 
-    def _partial_build(self, endpoint, values):
-        for rule in self.map._rules_by_endpoint.get(endpoint, ()):
-            if rule.suitable_for(values):
-                rv = rule.build(values)
-                if rv is not None:
-                    return rv
+    def _partial_build(self, index, endpoint, values):
+        builder = index.builders.get(endpoint)
+        if builder is not None:
+            return builder.build(values)
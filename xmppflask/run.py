@@ -38,10 +38,11 @@ optional arguments:
   --password=PASSWORD  password to that jid. Also, it could be setted via
                        XMPPFLASK_PASSWORD variable. Finally, if password is
                        not given it will be asked from tty.
-  --engine=ENGINE      XMPP backend library. Currently supported xmpppy and
-                       SleekXMPP. Possible shortcuts: xmpp, sleek. Values are
-                       case insensitive. If omitted XmppFlask will try to
-                       guest which one you have.
+  --engine=ENGINE      XMPP backend library. Currently supported xmpppy,
+                       SleekXMPP and native one which requires no library.
+                       Possible shortcuts: xmpp, sleek. Values are case
+                       insensitive. If omitted XmppFlask will try to guest
+                       which one you have.
 '''.lstrip() % dict(name=os.path.basename(sys.argv[0]))
 
 _NO_APP = 'Target XmppFlask app is not specified. Try --help for more info.\n'
@@ -61,6 +62,8 @@ def run_server(app, jid, pwd, engine):
         return run_xmpppy_server(app, jid, pwd)
     elif engine.lower() in ['sleekxmpp', 'sleek']:
         return run_sleek_server(app, jid, pwd)
+    elif engine.lower() in ['native']:
+        return run_native_server(app, jid, pwd)
     else:
         raise ValueError('Unknown xmpp engine %s' % engine)
 
@@ -81,6 +84,14 @@ def run_sleek_server(app, jid, pwd):
     return server
 
 
+def run_native_server(app, jid, pwd):
+    from .server.native import NativeXmppWsgiServer
+    server = NativeXmppWsgiServer(app)
+    server.connect(jid, pwd)
+    server.serve_forever()
+    return server
+
+
 def main():
     def load_app_from_configstr(app_str):
         # TODO: There should be better way to load app
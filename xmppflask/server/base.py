@@ -10,12 +10,22 @@
 """
 
 import inspect
+import logging
+import threading
 import time
 import sys
 from abc import ABCMeta, abstractmethod
 from collections import Mapping, OrderedDict
+from contextlib import contextmanager
+from functools import partial
 from pprint import pformat
 from .caps import Capability, CapabilityNotFound
+from .dispatch import Dispatcher, KeyedThreadPoolDispatcher
+from .helpers import Future, LazyEnviron
+from .iq import PendingIqTable
+from .lanes import LANE_BULK, LANE_REPLY
+from .ratelimit import OutboundRateLimiter
+from ..jid import JID
 
 
 class XmppWsgiServer(object):
@@ -34,12 +44,52 @@ class XmppWsgiServer(object):
 
     capability_class = Capability
 
+    #: Runs app in XMPP library event thread, used if ``XMPPWSGI_WORKERS``
+    #: config value is zero.
+    dispatcher_class = Dispatcher
+    #: Runs app in worker threads, used if ``XMPPWSGI_WORKERS`` is positive.
+    #: Stanzas of the same sender are handled in order of arrival.
+    pool_dispatcher_class = KeyedThreadPoolDispatcher
+
+    #: Mapping type of request environ, capabilities may defer computing
+    #: of expensive values until they are accessed.
+    environ_class = LazyEnviron
+
+    #: Classes of :mod:`~xmppflask.server.filters` created for every
+    #: server, they are applied to incoming stanzas before environ setup.
+    #: Used by servers which implement stanza accessors like
+    #: :meth:`stanza_sender`.
+    filter_classes = ()
+
+    #: Holds back outgoing stanzas over ``XMPPWSGI_RATE_LIMIT`` and
+    #: ``XMPPWSGI_RECIPIENT_RATE_LIMIT``.
+    rate_limiter_class = OutboundRateLimiter
+
+    #: Seconds to wait for IQ response before failing with
+    #: :exc:`~xmppflask.server.iq.IqTimeout`.
+    iq_timeout = 5
+
     def __init__(self, app):
         self.app = app
         self.app_ctx = app.app_context()
         self.base_environ = self.create_environ()
         self.caps = OrderedDict()
         self.commands = {}
+        self.dispatcher = self.create_dispatcher()
+        self.base_environ['wsgi.multithread'] = self.dispatcher.multithread
+        self.filters = self.create_filters()
+        #: Maximum number of outgoing stanzas written at once, zero means
+        #: to write every stanza as soon as it's queued.
+        self.send_batch = app.config['XMPPWSGI_SEND_BATCH']
+        #: Queued `(lane, stanza)` pairs in order of queueing, lanes take
+        #: effect in :attr:`rate_limiter` only: within a single write
+        #: order matters more, e.g. MUC join goes before the room message.
+        self._outgoing = []
+        self._outgoing_lock = threading.Lock()
+        self._local = threading.local()
+        self.rate_limiter = self.create_rate_limiter()
+        #: IQ requests waiting for responses.
+        self.iq_table = PendingIqTable()
 
     @abstractmethod
     def connect(self, jid, pwd, use_tls=True, use_ssl=False):
@@ -52,12 +102,57 @@ class XmppWsgiServer(object):
         self.register_capability('std')  # force to have standard capability
         self.register_capabilities()
         self.check_app_requirements()
+        # routes are all known by now, make dispatching plain lookups
+        self.app.route_map.freeze()
+        self.dispatcher.start()
+        if self.rate_limiter is not None:
+            self.rate_limiter.start()
 
     @abstractmethod
     def serve_forever(self):
         """Should implement infinity loop if needed."""
         raise NotImplementedError
 
+    def create_dispatcher(self):
+        """Creates dispatcher of incoming stanzas according to app config."""
+        config = self.app.config
+        if not config['XMPPWSGI_WORKERS']:
+            return self.dispatcher_class(self)
+        return self.pool_dispatcher_class(
+            self,
+            workers=config['XMPPWSGI_WORKERS'],
+            queue_size=config['XMPPWSGI_QUEUE_SIZE'],
+            overflow=config['XMPPWSGI_QUEUE_OVERFLOW'],
+            reject_message=config['XMPPWSGI_REJECT_MESSAGE'])
+
+    def create_rate_limiter(self):
+        """Creates outgoing stanzas rate limiter if app config sets any
+        limit."""
+        config = self.app.config
+        if not (config['XMPPWSGI_RATE_LIMIT']
+                or config['XMPPWSGI_RECIPIENT_RATE_LIMIT']):
+            return None
+        return self.rate_limiter_class(
+            self.write_stanzas, self.stanza_recipient,
+            rate=config['XMPPWSGI_RATE_LIMIT'],
+            burst=config['XMPPWSGI_RATE_BURST'],
+            recipient_rate=config['XMPPWSGI_RECIPIENT_RATE_LIMIT'],
+            recipient_burst=config['XMPPWSGI_RECIPIENT_RATE_BURST'],
+            weights=config['XMPPWSGI_LANE_WEIGHTS'])
+
+    def create_filters(self):
+        """Creates filters of incoming stanzas which are active for app
+        config."""
+        filters = (cls(self) for cls in self.filter_classes)
+        return [stanza_filter for stanza_filter in filters
+                if stanza_filter.active]
+
+    def add_filter(self, func):
+        """Adds filter of incoming stanzas to the end of chain. Filter is
+        called with stanza of XMPP library and returns False to drop it."""
+        self.filters.append(func)
+        return func
+
     def lookup_capability(self, name):
         """Lookups capability by name for current XMPPWSGI server.
 
@@ -157,17 +252,8 @@ class XmppWsgiServer(object):
         :return: XMPPWSGI environ
         :rtype: dict
         """
-        if isinstance(stanza, self.message_class):
-            stanza_cls = u'message'
-        elif isinstance(stanza, self.presence_class):
-            stanza_cls = u'presence'
-        elif isinstance(stanza, self.iq_class):
-            stanza_cls = u'iq'
-        else:
-            stanza_cls = None
-
-        environ = self.base_environ.copy()
-        environ['xmpp.stanza'] = stanza_cls
+        environ = self.environ_class(self.base_environ)
+        environ['xmpp.stanza'] = self.stanza_kind(stanza)
         environ['xmpp.timestamp'] = int(time.mktime(time.gmtime()))
 
         for cap in self.caps.values():
@@ -175,8 +261,136 @@ class XmppWsgiServer(object):
 
         return environ
 
+    def queue_stanza(self, stanza, lane=None):
+        """Queues outgoing stanza. Queued stanzas are written to the stream
+        at once by :meth:`flush` at the end of dispatch cycle or when
+        there are ``XMPPWSGI_SEND_BATCH`` of them. Stanzas queued outside
+        of :meth:`dispatch_cycle`, e.g. by commands called from background
+        threads, are written immediately since nothing would flush them.
+
+        :param lane: One of :mod:`~xmppflask.server.lanes`, by default
+                     stanzas are replies unless notification queue is
+                     being dispatched.
+        """
+        if lane is None:
+            lane = getattr(self._local, 'lane', LANE_REPLY)
+        # XMPP library connections are not safe to write from several
+        # worker threads at once
+        with self._outgoing_lock:
+            self._outgoing.append((lane, stanza))
+            if (not self.send_batch
+                    or not getattr(self._local, 'cycles', 0)
+                    or len(self._outgoing) >= self.send_batch):
+                self.send_stanzas(self._drain_outgoing())
+
+    @contextmanager
+    def dispatch_cycle(self):
+        """Context of a single app run in the current thread. Stanzas
+        queued within it are buffered and flushed on exit, even if the
+        app fails."""
+        self._local.cycles = getattr(self._local, 'cycles', 0) + 1
+        try:
+            yield
+        finally:
+            self._local.cycles -= 1
+            self.flush()
+
+    def flush(self):
+        """Writes all queued stanzas. Should be called before sending
+        anything bypassing the queue to keep stanzas order."""
+        with self._outgoing_lock:
+            if self._outgoing:
+                self.send_stanzas(self._drain_outgoing())
+
+    def _drain_outgoing(self):
+        stanzas, self._outgoing = self._outgoing, []
+        return stanzas
+
+    def send_stanzas(self, stanzas):
+        """Writes `(lane, stanza)` pairs through the rate limiter, if
+        any."""
+        if self.rate_limiter is None:
+            self.write_stanzas([stanza for _, stanza in stanzas])
+        else:
+            self.rate_limiter.send(stanzas)
+
+    def write_stanzas(self, stanzas):
+        """Should write stanzas to the stream with as few writes as
+        possible."""
+        raise NotImplementedError
+
+    def stanza_kind(self, stanza):
+        """Returns stanza class: ``message``, ``presence``, ``iq`` or None
+        for anything else."""
+        if isinstance(stanza, self.message_class):
+            return u'message'
+        elif isinstance(stanza, self.presence_class):
+            return u'presence'
+        elif isinstance(stanza, self.iq_class):
+            return u'iq'
+
+    def stanza_sender(self, stanza):
+        """Should return sender full JID as string without parsing."""
+
+    def stanza_body(self, stanza):
+        """Should return message body."""
+
+    def stanza_type(self, stanza):
+        """Should return stanza type attribute value."""
+
+    def stanza_recipient(self, stanza):
+        """Should return recipient JID of outgoing stanza as string."""
+
+    def stanza_id(self, stanza):
+        """Should return stanza ID."""
+
+    def track_iq(self, iq_id, to, timeout=None):
+        """Registers sent IQ request in :attr:`iq_table`.
+
+        :returns: :class:`~xmppflask.server.helpers.Future` of response
+                  stanza which fails with :exc:`~xmppflask.server.iq.IqError`
+                  or :exc:`~xmppflask.server.iq.IqTimeout`.
+        """
+        return self.iq_table.register(iq_id, to, timeout or self.iq_timeout)
+
+    def resolve_iq(self, stanza):
+        """Completes pending IQ request with ``result`` or ``error`` response
+        stanza. Returns False if no request waits for it."""
+        return self.iq_table.resolve(self.stanza_id(stanza),
+                                     self.stanza_sender(stanza), stanza,
+                                     self.stanza_type(stanza) == 'error')
+
     def handle(self, stanza):
         """Handles XMPP stanza."""
+        if self.accept(stanza):
+            self.dispatch_stanza(stanza)
+
+    def handle_many(self, stanzas):
+        """Handles XMPP stanzas which arrived together. Sessions of their
+        senders are loaded and saved in a batch. With worker threads views
+        run after the batch, so it only loads sessions."""
+        accepted = [stanza for stanza in stanzas if self.accept(stanza)]
+        if not accepted:
+            return
+        jids = self.session_jids(accepted)
+        with self.app.session_interface.batch(self.app, jids):
+            for stanza in accepted:
+                self.dispatch_stanza(stanza)
+
+    def session_jids(self, stanzas):
+        """Returns JIDs of stanza senders as ``xmpp.jid`` environ values,
+        which sessions are opened for."""
+        return [JID(jid) for jid in map(self.stanza_sender, stanzas) if jid]
+
+    def accept(self, stanza):
+        """Checks stanza with :attr:`filters`."""
+        for stanza_filter in self.filters:
+            if not stanza_filter(stanza):
+                return False
+        return True
+
+    def dispatch_stanza(self, stanza):
+        """Passes accepted stanza to the app."""
         environ = self.setup_environ(stanza)
         # we don't want handle our own stanzas like presence
         if environ['app.jid'] == environ['xmpp.jid']:
@@ -184,44 +398,124 @@ class XmppWsgiServer(object):
         # skip empty messages
         if environ['xmpp.stanza'] == 'message' and not environ['xmpp.body']:
             return
-        self.app.logger.debug(pformat(environ))
-        self.xmppwsgi_app(environ, [])
-
-    def xmppwsgi_app(self, environ, notification_queue=None):
-        """Calls bounded XMPPWSGI app with request-related environ."""
-        with self.app_ctx:
-            with self.app.request_context(environ):
-                response = self.app(environ, notification_queue)
-                self.dispatch_app_response(environ, response)
-                self.dispatch_notification_queue(notification_queue)
-
-    def dispatch_app_response(self, environ, response):
-        """Response object dispatcher."""
-        rv = None
+        logger = self.app.logger
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(pformat(dict(environ.items())))
+        self.dispatcher.dispatch(environ)
+
+    def xmppwsgi_app(self, environ, notification_queue=None, app_ctx=None):
+        """Calls bounded XMPPWSGI app with request-related environ.
+
+        Worker threads pass their own `app_ctx`, by default the server one
+        is used. Generator view is suspended when it yields a command which
+        returns unfinished :class:`~xmppflask.server.helpers.Future` and
+        resumed once future is done, so waiting for IQ responses doesn't
+        block the thread.
+
+        :returns: Unfinished future the response is suspended on or None.
+        """
+        app_ctx = app_ctx or self.app_ctx
+        with self.dispatch_cycle():
+            with app_ctx:
+                with self.app.request_context(environ) as ctx:
+                    response = self.app(environ, notification_queue)
+                    future = self.dispatch_app_response(environ, response)
+                    if future is None:
+                        self.dispatch_notification_queue(
+                            notification_queue)
+        if future is not None:
+            self.suspend_app_response(environ, response, notification_queue,
+                                      ctx.session, future)
+        return future
+
+    def suspend_app_response(self, environ, response, notification_queue,
+                             session, future):
+        """Resumes app response once `future` is done. Response is resumed
+        by :attr:`dispatcher` in order with other stanzas of the same
+        sender and sees the request `session`, which is saved when the
+        response is over."""
+        def done(future):
+            self.dispatcher.resume(environ, partial(
+                self.resume_app_response, environ, response,
+                notification_queue, session, future))
+        future.add_done_callback(done)
+
+    def resume_app_response(self, environ, response, notification_queue,
+                            session, future, app_ctx=None):
+        """Runs app response suspended on `future` further.
+
+        :returns: Unfinished future the response is suspended on again or
+                  None.
+        """
+        exc = future.exception()
+        rv = future.result() if exc is None else None
+        ctx = self.app.request_context(environ)
+        ctx.session = session
+        try:
+            with self.dispatch_cycle():
+                with app_ctx or self.app_ctx:
+                    with ctx:
+                        future = self.dispatch_app_response(
+                            environ, response, rv, exc)
+                        if future is None:
+                            self.dispatch_notification_queue(
+                                notification_queue)
+        except Exception:
+            self.app.logger.exception('Error in resumed app response')
+            return None
+        if future is not None:
+            self.suspend_app_response(environ, response, notification_queue,
+                                      session, future)
+        return future
+
+    def dispatch_app_response(self, environ, response, rv=None, exc=None):
+        """Response object dispatcher. Sends `rv` or throws `exc` into
+        response first.
+
+        :returns: Unfinished :class:`~xmppflask.server.helpers.Future`
+                  response waits for or None when it's over.
+        """
         while True:
             try:
-                item = response.send(rv)
-            except StopIteration:
-                break
-            else:
-                if isinstance(item, basestring):
-                    cmd, payload = 'message', {'body': item}
+                if exc is not None:
+                    item, exc = response.throw(type(exc), exc), None
                 else:
-                    cmd, payload = item
-                    if isinstance(payload, basestring):
-                        payload = {'body': payload}
-                func = self.commands.get(cmd)
-                if func is None:
-                    raise ValueError('unknown command %r' % cmd)
-                if not isinstance(payload, Mapping):
-                    raise TypeError("command's payload should implement"
-                                    " Mapping interface, got: %r"
-                                    % type(payload))
-                rv = func(environ, payload)
+                    item = response.send(rv)
+            except StopIteration:
+                return None
+            if item is None:
+                rv = None  # bare ``yield`` sends nothing
+                continue
+            rv = self.run_command(environ, item)
+            if isinstance(rv, Future):
+                if not rv.done():
+                    return rv
+                exc = rv.exception()
+                rv = rv.result() if exc is None else None
+
+    def run_command(self, environ, item):
+        """Runs command yielded by app response and returns its result."""
+        if isinstance(item, basestring):
+            cmd, payload = 'message', {'body': item}
+        else:
+            cmd, payload = item
+            if isinstance(payload, basestring):
+                payload = {'body': payload}
+        func = self.commands.get(cmd)
+        if func is None:
+            raise ValueError('unknown command %r' % cmd)
+        if not isinstance(payload, Mapping):
+            raise TypeError("command's payload should implement"
+                            " Mapping interface, got: %r" % type(payload))
+        return func(environ, payload)
 
     def dispatch_notification_queue(self, queue):
         if not queue:
             return
-        for jid, resp in queue:
-            self.dispatch_app_response({'xmpp.jid': jid},
-                                       self.app.response_class(resp))
+        self._local.lane = LANE_BULK
+        try:
+            for jid, resp in queue:
+                self.dispatch_app_response({'xmpp.jid': jid},
+                                           self.app.response_class(resp))
+        finally:
+            del self._local.lane
@@ -89,7 +89,10 @@ class Standard(Capability):
         :param payload: IQ payload data.
         :type payload: dict
 
-        :returns: True
+        :returns: :class:`~xmppflask.server.helpers.Future` of response IQ.
+                  Generator views get the response itself by yielding the
+                  command, other callers may wait for it with
+                  ``future.result(timeout)``.
         """
         raise NotImplementedError
 
@@ -134,8 +137,11 @@ class Version(Capability):
         :param payload: Payload data.
         :type payload: dict
 
-        :returns: Software version info dict with keys: `os`, `name`, `version`
-        :rtype: dict
+        :returns: :class:`~xmppflask.server.helpers.Future` of software
+                  version info dict with keys: `os`, `name`, `version`.
+                  Generator views get the dict itself by yielding the
+                  command, other callers may wait for it with
+                  ``future.result(timeout)``.
         """
         raise NotImplementedError
 
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+    xmppflask.server.dispatch
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Strategies of running XMPPWSGI app for incoming stanzas.
+
+    :license: BSD
+"""
+
+import threading
+from collections import deque
+from itertools import chain
+from Queue import Queue, Full, Empty
+from ..jid import JID
+
+#: Wait until there is a free slot in the queue, which stalls the XMPP
+#: library event thread.
+OVERFLOW_BLOCK = 'block'
+#: Discard the oldest queued stanza to make room for the new one.
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+#: Discard the new stanza and reply to its sender with a message.
+OVERFLOW_REJECT = 'reject'
+
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_REJECT)
+
+_stop = object()
+
+
+class Dispatcher(object):
+    """Runs XMPPWSGI app right in the thread that received the stanza, e.g.
+    in XMPP library event loop. While app handles the stanza no other
+    stanzas are processed."""
+
+    #: Whether app could be run by several threads simultaneously.
+    multithread = False
+
+    def __init__(self, server):
+        self.server = server
+
+    def start(self):
+        """Prepares dispatcher to accept environs."""
+
+    def stop(self, wait=True):
+        """Stops accepting environs. If `wait` is set, blocks until all
+        accepted ones are handled."""
+
+    def dispatch(self, environ):
+        """Runs XMPPWSGI app for the environ."""
+        self.server.xmppwsgi_app(environ, [])
+
+    def resume(self, environ, continuation):
+        """Runs `continuation` of app response to the environ, which was
+        suspended waiting for a future. It's called with app context to
+        run within, or None for the server one."""
+        continuation(None)
+
+
+class ThreadPoolDispatcher(Dispatcher):
+    """Puts environs into bounded queue and returns immediately, so slow
+    views don't stall XMPP library event loop. Queue is served by `workers`
+    threads, each one runs app within its own
+    :class:`~xmppflask.ctx.AppContext`.
+
+    :param server: :class:`~xmppflask.server.XmppWsgiServer` instance.
+    :param workers: Number of worker threads.
+    :param queue_size: Maximum number of environs waiting for a worker.
+    :param overflow: What to do when queue is full, one of
+                     :data:`OVERFLOW_POLICIES`.
+    :param reject_message: Reply for rejected messages, if
+                           :data:`OVERFLOW_REJECT` policy is used. No reply
+                           is sent if it's empty or stanza is not a message.
+    """
+
+    multithread = True
+
+    def __init__(self, server, workers=4, queue_size=100,
+                 overflow=OVERFLOW_BLOCK, reject_message=None):
+        super(ThreadPoolDispatcher, self).__init__(server)
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy %r' % overflow)
+        if workers < 1:
+            raise ValueError('at least one worker is required')
+        self.size = workers
+        self.overflow = overflow
+        self.reject_message = reject_message
+        self.queue = Queue(queue_size)
+        #: Number of stanzas dropped by :data:`OVERFLOW_DROP_OLDEST`.
+        self.dropped = 0
+        #: Number of stanzas rejected by :data:`OVERFLOW_REJECT`.
+        self.rejected = 0
+        self._workers = []
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return bool(self._workers)
+
+    def start(self):
+        with self._lock:
+            if self._workers:
+                return
+            for idx in range(self.size):
+                worker = threading.Thread(target=self.work,
+                                          name='xmppflask-worker-%d' % idx)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def stop(self, wait=True):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self.queue.put(_stop)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def dispatch(self, environ):
+        if not self._workers:
+            self.start()
+        if self.overflow == OVERFLOW_BLOCK:
+            self.queue.put(environ)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(environ)
+            except Full:
+                pass
+            else:
+                return
+            if self.overflow == OVERFLOW_REJECT:
+                self.reject(environ)
+                return
+            try:
+                dropped = self.queue.get_nowait()
+            except Empty:
+                continue
+            # never lose workers shutdown signal or suspended responses
+            if dropped is _stop or callable(dropped):
+                self.queue.put(dropped)
+                self.reject(environ)
+                return
+            self.dropped += 1
+            self.server.app.logger.warning(
+                'Dispatch queue is full, dropped %s from %s',
+                dropped['xmpp.stanza'], dropped['xmpp.jid'])
+
+    def resume(self, environ, continuation):
+        """Queues `continuation` for workers, it's never dropped."""
+        self.queue.put(continuation)
+
+    def reject(self, environ):
+        """Discards the environ replying to the sender if possible."""
+        self.rejected += 1
+        self.server.app.logger.warning(
+            'Dispatch queue is full, rejected %s from %s',
+            environ['xmpp.stanza'], environ['xmpp.jid'])
+        if not self.reject_message or environ['xmpp.stanza'] != 'message':
+            return
+        send = self.server.commands.get('message')
+        if send is not None:
+            send(environ, {'body': self.reject_message})
+            self.server.flush()
+
+    def work(self):
+        """Worker thread loop."""
+        app_ctx = self.server.app.app_context()
+        while True:
+            environ = self.queue.get()
+            if environ is _stop:
+                break
+            if callable(environ):
+                environ(app_ctx)
+            else:
+                self.run(environ, app_ctx)
+
+    def run(self, environ, app_ctx):
+        """Runs app for the environ within worker `app_ctx`. Returns
+        unfinished future if app response is suspended on it."""
+        try:
+            return self.server.xmppwsgi_app(environ, [], app_ctx)
+        except Exception:
+            self.server.app.logger.exception(
+                'Failed to handle %s from %s',
+                environ['xmpp.stanza'], environ['xmpp.jid'])
+
+
+class KeyedThreadPoolDispatcher(ThreadPoolDispatcher):
+    """Thread pool which handles stanzas with the same :meth:`key` one by
+    one in order of arrival, while stanzas with different keys are handled
+    in parallel. Since key is a sender bare JID, views never race on the
+    same user session and groupchat messages of a MUC room (sent from
+    ``room@conference/nick``) are handled in order too.
+
+    Key stays busy while app response is suspended waiting for a future,
+    so the response is resumed before any later stanza of the same key is
+    handled.
+
+    `queue_size` limits total number of waiting stanzas. If the queue is
+    full, :data:`OVERFLOW_DROP_OLDEST` policy drops the oldest stanza of
+    the same key or, if there are none, of the key waiting the longest.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(KeyedThreadPoolDispatcher, self).__init__(*args, **kwargs)
+        self.capacity = self.queue.maxsize
+        self.queue = None
+        self._cond = threading.Condition(threading.Lock())
+        #: Waiting environs per key. Key is present while it's either
+        #: running or waiting in `_ready`.
+        self._backlog = {}
+        #: Keys with waiting environs which are not running.
+        self._ready = deque()
+        #: Keys being handled by workers, including suspended ones.
+        self._running = set()
+        #: Keys suspended until their continuation is resumed.
+        self._suspended = set()
+        #: Continuations of resumed keys, they go before the backlog.
+        self._resumed = {}
+        self._pending = 0
+        self._stopping = False
+
+    def key(self, environ):
+        """Returns the key environs are serialized by."""
+        return JID(environ['xmpp.jid']).bare
+
+    def queue_depth(self, key):
+        """Returns number of stanzas of the key, waiting or being handled."""
+        with self._cond:
+            return len(self._backlog.get(key, ())) + (key in self._running)
+
+    def queue_depths(self):
+        """Returns dict of :meth:`queue_depth` for each active key."""
+        with self._cond:
+            return dict((key, len(backlog) + (key in self._running))
+                        for key, backlog in self._backlog.iteritems())
+
+    def start(self):
+        with self._cond:
+            self._stopping = False
+        super(KeyedThreadPoolDispatcher, self).start()
+
+    def stop(self, wait=True):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def dispatch(self, environ):
+        if not self._workers:
+            self.start()
+        key = self.key(environ)
+        dropped = rejected = None
+        with self._cond:
+            while 0 < self.capacity <= self._pending:
+                if self.overflow == OVERFLOW_BLOCK:
+                    self._cond.wait()
+                elif self.overflow == OVERFLOW_REJECT:
+                    rejected = environ
+                    break
+                else:
+                    dropped = self._drop_oldest(key)
+            if rejected is None:
+                self._pending += 1
+                backlog = self._backlog.get(key)
+                if backlog is None:
+                    backlog = self._backlog[key] = deque()
+                    self._ready.append(key)
+                backlog.append(environ)
+                self._cond.notify_all()
+        if dropped is not None:
+            self.dropped += 1
+            self.server.app.logger.warning(
+                'Dispatch queue is full, dropped %s from %s',
+                dropped['xmpp.stanza'], dropped['xmpp.jid'])
+        if rejected is not None:
+            self.reject(rejected)
+
+    def resume(self, environ, continuation):
+        key = self.key(environ)
+        with self._cond:
+            self._resumed[key] = continuation
+            if key in self._suspended:
+                self._suspended.discard(key)
+                self._ready.appendleft(key)
+                self._cond.notify_all()
+
+    def _drop_oldest(self, key):
+        for victim in chain((key,), self._ready, self._running):
+            backlog = self._backlog.get(victim)
+            if backlog:
+                break
+        environ = backlog.popleft()
+        self._pending -= 1
+        if not backlog and victim not in self._running:
+            self._ready.remove(victim)
+            del self._backlog[victim]
+        return environ
+
+    def work(self):
+        app_ctx = self.server.app.app_context()
+        cond = self._cond
+        while True:
+            with cond:
+                while not self._ready and not self._stopping:
+                    cond.wait()
+                if not self._ready:
+                    break
+                key = self._ready.popleft()
+                continuation = self._resumed.pop(key, None)
+                if continuation is None:
+                    environ = self._backlog[key].popleft()
+                    self._pending -= 1
+                self._running.add(key)
+                cond.notify_all()
+            if continuation is None:
+                future = self.run(environ, app_ctx)
+            else:
+                future = continuation(app_ctx)
+            with cond:
+                if future is not None:
+                    # future could be done already, while still running
+                    if key in self._resumed:
+                        self._ready.appendleft(key)
+                    else:
+                        self._suspended.add(key)
+                else:
+                    self._running.discard(key)
+                    if self._backlog[key]:
+                        self._ready.append(key)
+                    else:
+                        del self._backlog[key]
+                cond.notify_all()
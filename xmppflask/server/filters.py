@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+    xmppflask.server.filters
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Filters of incoming stanzas. They run right on the stanza of XMPP
+    library, before environ is created and capabilities are asked to fill
+    it, so dropped stanzas cost just a few attribute lookups.
+
+    Filter is a callable which takes the stanza and returns False to drop
+    it. Stanza data is read with server accessors like
+    :meth:`~xmppflask.server.XmppWsgiServer.stanza_sender`.
+
+    :license: BSD
+"""
+
+from collections import deque
+
+
+class StanzaFilter(object):
+    """Base class for filters created by the server from app config.
+
+    :param server: :class:`~xmppflask.server.XmppWsgiServer` instance.
+    """
+
+    def __init__(self, server):
+        self.server = server
+
+    @property
+    def active(self):
+        """Whether filter has anything to do with current config, inactive
+        ones are not added to the chain."""
+        return True
+
+    def __call__(self, stanza):
+        return True
+
+
+class SelfEchoFilter(StanzaFilter):
+    """Drops stanzas sent by app own JID, e.g. own presence."""
+
+    def __call__(self, stanza):
+        jid = self.server.base_environ['app.jid']
+        return jid is None or self.server.stanza_sender(stanza) != unicode(jid)
+
+
+class EmptyBodyFilter(StanzaFilter):
+    """Drops messages without body, e.g. chat state notifications."""
+
+    def __call__(self, stanza):
+        return (self.server.stanza_kind(stanza) != u'message'
+                or bool(self.server.stanza_body(stanza)))
+
+
+class IgnoredTypesFilter(StanzaFilter):
+    """Drops stanzas of types from ``XMPPWSGI_IGNORED_TYPES`` config value,
+    e.g. ``error`` or ``headline``."""
+
+    def __init__(self, server):
+        super(IgnoredTypesFilter, self).__init__(server)
+        self.types = frozenset(server.app.config['XMPPWSGI_IGNORED_TYPES'])
+
+    @property
+    def active(self):
+        return bool(self.types)
+
+    def __call__(self, stanza):
+        return self.server.stanza_type(stanza) not in self.types
+
+
+class BlockedJidsFilter(StanzaFilter):
+    """Drops stanzas from bare JIDs listed in ``XMPPWSGI_BLOCKED_JIDS``
+    config value."""
+
+    def __init__(self, server):
+        super(BlockedJidsFilter, self).__init__(server)
+        self.jids = frozenset(
+            jid.lower() for jid in server.app.config['XMPPWSGI_BLOCKED_JIDS'])
+
+    @property
+    def active(self):
+        return bool(self.jids)
+
+    def __call__(self, stanza):
+        sender = self.server.stanza_sender(stanza)
+        if not sender:
+            return True
+        return sender.split('/', 1)[0].lower() not in self.jids
+
+
+class DuplicateIdFilter(StanzaFilter):
+    """Drops stanzas which sender and ID were seen among the last
+    ``XMPPWSGI_DUPLICATES_WINDOW`` ones, e.g. resent by the server after
+    stream resumption. Stanzas without ID are always passed."""
+
+    def __init__(self, server):
+        super(DuplicateIdFilter, self).__init__(server)
+        self.size = server.app.config['XMPPWSGI_DUPLICATES_WINDOW']
+        self._seen = set()
+        self._order = deque()
+
+    @property
+    def active(self):
+        return self.size > 0
+
+    def __call__(self, stanza):
+        stanza_id = self.server.stanza_id(stanza)
+        if not stanza_id:
+            return True
+        key = (self.server.stanza_sender(stanza), stanza_id)
+        if key in self._seen:
+            return False
+        self._seen.add(key)
+        self._order.append(key)
+        if len(self._order) > self.size:
+            self._seen.discard(self._order.popleft())
+        return True
+
+
+#: Filters used by servers which implement stanza accessors.
+DEFAULT_FILTERS = (SelfEchoFilter, EmptyBodyFilter, IgnoredTypesFilter,
+                   BlockedJidsFilter, DuplicateIdFilter)
@@ -9,6 +9,7 @@
     :license: BSD
 """
 
+import threading
 import uuid
 
 
@@ -28,3 +29,180 @@ def split_jid(jid):
 
 def gen_id(prefix='xmppflask'):
     return '{0}-{1}'.format(prefix, str(uuid.uuid4()).split('-')[0])
+
+
+class Future(object):
+    """Result of an operation which completes later, e.g. IQ round trip.
+
+    Commands may return it instead of blocking. Servers that support this
+    suspend generator view yielded such command and resume it with the
+    result (or throw the exception into it) once future is done. Callbacks
+    are called by the thread which completes the future.
+
+    Callers outside of generator views may wait for the result with
+    `timeout`, but not in the thread which is supposed to complete the
+    future, e.g. XMPP library event loop.
+    """
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    def done(self):
+        return self._done
+
+    def wait(self, timeout=None):
+        """Waits up to `timeout` seconds, forever if it's None, for the
+        future to be done. Returns whether it's done."""
+        return self._event.wait(timeout)
+
+    def result(self, timeout=0):
+        """Returns the result or raises the exception of the operation,
+        waiting for it up to `timeout` seconds."""
+        if not self._done and not self.wait(timeout):
+            raise RuntimeError('result is not ready yet')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=0):
+        if not self._done and not self.wait(timeout):
+            raise RuntimeError('result is not ready yet')
+        return self._exception
+
+    def set_result(self, value):
+        self._result = value
+        self._finish()
+
+    def set_exception(self, exc):
+        self._exception = exc
+        self._finish()
+
+    def add_done_callback(self, func):
+        """Calls `func` with the future once it's done."""
+        with self._lock:
+            if not self._done:
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _finish(self):
+        with self._lock:
+            if self._done:
+                raise RuntimeError('future is already done')
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+        self._event.set()
+        for func in callbacks:
+            func(self)
+
+
+class LazyEnviron(dict):
+    """XMPPWSGI environ which computes expensive values on first access.
+
+    Capabilities register such values with :meth:`lazy` instead of setting
+    them, e.g. raw stanza XML which is rarely needed by views but costs
+    whole stanza serialization. Plain keys are stored as usual, so item
+    access to them is as fast as for any dict. Value is computed once,
+    mapping methods like :meth:`get`, :meth:`items` or ``in`` operator
+    take lazy keys into account.
+
+    Note that ``dict(environ)`` and ``{}.update(environ)`` read the storage
+    directly and skip pending values, use :meth:`copy` instead.
+    """
+
+    __slots__ = ('_lazy',)
+
+    def __init__(self, *args, **kwargs):
+        super(LazyEnviron, self).__init__(*args, **kwargs)
+        self._lazy = {}
+
+    def lazy(self, key, func, *args):
+        """Sets `key` to be computed as ``func(*args)`` on first access."""
+        dict.pop(self, key, None)
+        self._lazy[key] = (func, args)
+
+    def __missing__(self, key):
+        try:
+            func, args = self._lazy.pop(key)
+        except KeyError:
+            raise KeyError(key)
+        value = self[key] = func(*args)
+        return value
+
+    def resolve(self):
+        """Computes all pending values."""
+        for key in list(self._lazy):
+            # values set explicitly win over pending ones
+            if not dict.__contains__(self, key):
+                self[key]
+        self._lazy.clear()
+        return self
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._lazy
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        if key in self._lazy:
+            self[key]
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def __delitem__(self, key):
+        if self._lazy.pop(key, None) is None or dict.__contains__(self, key):
+            dict.__delitem__(self, key)
+
+    def __len__(self):
+        return dict.__len__(self.resolve())
+
+    def __iter__(self):
+        return dict.__iter__(self.resolve())
+
+    def __eq__(self, other):
+        return dict.__eq__(self.resolve(), other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return dict.__repr__(self.resolve())
+
+    def keys(self):
+        return dict.keys(self.resolve())
+
+    def values(self):
+        return dict.values(self.resolve())
+
+    def items(self):
+        return dict.items(self.resolve())
+
+    def iterkeys(self):
+        return dict.iterkeys(self.resolve())
+
+    def itervalues(self):
+        return dict.itervalues(self.resolve())
+
+    def iteritems(self):
+        return dict.iteritems(self.resolve())
+
+    def copy(self):
+        environ = type(self)(self)
+        environ._lazy.update(self._lazy)
+        return environ
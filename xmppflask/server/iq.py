@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+    xmppflask.server.iq
+    ~~~~~~~~~~~~~~~~~~~
+
+    Tracking of sent IQ requests. Every request is registered in
+    :class:`PendingIqTable` by its ID and gets a
+    :class:`~xmppflask.server.helpers.Future`, which is completed when the
+    response arrives or fails when it doesn't in time. So any number of
+    requests could wait for responses over the same connection without
+    blocking the thread which sent them.
+
+    :license: BSD
+"""
+
+import itertools
+import threading
+import time
+from .helpers import Future
+from ..jid import JID
+
+
+class IqError(Exception):
+    """Thrown into the view when IQ request got an error response."""
+
+    def __init__(self, stanza):
+        super(IqError, self).__init__(stanza)
+        #: Error response stanza of XMPP library.
+        self.stanza = stanza
+
+
+class IqTimeout(Exception):
+    """Thrown into the view when IQ request got no response in time."""
+
+
+class TimerWheel(object):
+    """Hashed timing wheel: timers are put into `size` slots by their
+    deadline rounded to `tick` seconds, so scheduling and cancelling cost
+    the same for any number of timers and :meth:`advance` looks only at
+    slots of passed ticks. Timers fire not earlier than their deadline and
+    at most one tick later, given that wheel is advanced often enough.
+    """
+
+    def __init__(self, tick=0.1, size=512, clock=time.time):
+        self.tick = tick
+        self.size = size
+        self.clock = clock
+        self._slots = [{} for _ in xrange(size)]
+        self._seq = itertools.count()
+        self._current = int(clock() / tick)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay, func, *args):
+        """Schedules `func` call in `delay` seconds. Returns timer that
+        could be passed to :meth:`cancel`."""
+        deadline = self.clock() + delay
+        with self._lock:
+            tick = max(int(deadline / self.tick), self._current + 1)
+            timer = (deadline, next(self._seq), tick % self.size, func, args)
+            self._slots[timer[2]][timer[1]] = timer
+            self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        """Cancels timer, returns False if it has fired already."""
+        with self._lock:
+            if self._slots[timer[2]].pop(timer[1], None) is None:
+                return False
+            self._count -= 1
+            return True
+
+    def advance(self, now=None):
+        """Fires all timers with passed deadlines. Returns their number."""
+        if now is None:
+            now = self.clock()
+        fired = []
+        with self._lock:
+            target = int(now / self.tick)
+            first = max(self._current + 1, target - self.size + 1)
+            for tick in xrange(first, target + 1):
+                slot = self._slots[tick % self.size]
+                if not slot:
+                    continue
+                for seq, timer in slot.items():
+                    if timer[0] <= now:
+                        del slot[seq]
+                        fired.append(timer)
+            # timers of the current tick could be not due yet
+            self._current = target - 1 if self._slots[target % self.size] \
+                else target
+            self._count -= len(fired)
+        fired.sort()
+        for _, _, _, func, args in fired:
+            func(*args)
+        return len(fired)
+
+
+class PendingIqTable(object):
+    """Sent IQ requests waiting for responses by stanza ID.
+
+    :param timeout: Default seconds to wait for response.
+    :param wheel: :class:`TimerWheel` for timeouts.
+    """
+
+    def __init__(self, timeout=5, wheel=None):
+        self.timeout = timeout
+        self.wheel = wheel if wheel is not None else TimerWheel()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, iq_id):
+        return iq_id in self._pending
+
+    def register(self, iq_id, to, timeout=None):
+        """Registers IQ request with `iq_id` sent `to` JID.
+
+        :returns: :class:`~xmppflask.server.helpers.Future` of the response
+                  stanza, it fails with :exc:`IqError` or :exc:`IqTimeout`.
+        """
+        future = Future()
+        with self._lock:
+            if iq_id in self._pending:
+                raise RuntimeError('IQ %r is pending already' % iq_id)
+            timer = self.wheel.schedule(timeout or self.timeout,
+                                        self._expire, iq_id)
+            self._pending[iq_id] = (future, timer, to)
+        return future
+
+    def resolve(self, iq_id, sender, stanza, error=False):
+        """Completes request `iq_id` with response `stanza`, failing it with
+        :exc:`IqError` if it's an `error` one. Responses which don't come
+        from the JID request was sent to are ignored as spoofed.
+
+        :returns: True if response matched pending request
+        """
+        with self._lock:
+            pending = self._pending.get(iq_id)
+            if pending is None:
+                return False
+            future, timer, to = pending
+            if to is not None and JID(sender or '') != JID(to):
+                return False
+            del self._pending[iq_id]
+        self.wheel.cancel(timer)
+        if error:
+            future.set_exception(IqError(stanza))
+        else:
+            future.set_result(stanza)
+        return True
+
+    def expire(self, now=None):
+        """Fails requests which waited for too long."""
+        return self.wheel.advance(now)
+
+    def _expire(self, iq_id):
+        with self._lock:
+            pending = self._pending.pop(iq_id, None)
+        if pending is not None:
+            pending[0].set_exception(IqTimeout(iq_id))
+
+
+def map_future(future, func, default=None):
+    """Returns future of `func` applied to `future` result or of `default`
+    if it fails."""
+    mapped = Future()
+
+    def done(future):
+        if future.exception() is not None:
+            return mapped.set_result(default)
+        try:
+            mapped.set_result(func(future.result()))
+        except Exception as err:
+            mapped.set_exception(err)
+    future.add_done_callback(done)
+    return mapped
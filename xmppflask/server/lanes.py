@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+    xmppflask.server.lanes
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Priority lanes of outgoing stanzas. Replies to the user who is waiting
+    for them shouldn't be stuck behind mass notifications, so outgoing
+    stanzas are queued per lane and taken by weighted round robin: every
+    lane gets its share, higher weight lanes get more of it.
+
+    :license: BSD
+"""
+
+from collections import deque
+
+#: Messages produced while handling incoming stanza.
+LANE_REPLY = 'reply'
+#: Presence updates.
+LANE_PRESENCE = 'presence'
+#: Notifications for other users, e.g. from notification queue.
+LANE_BULK = 'bulk'
+
+DEFAULT_WEIGHTS = {LANE_REPLY: 8, LANE_PRESENCE: 2, LANE_BULK: 1}
+
+
+class WeightedLanes(object):
+    """FIFO queues by lane, :meth:`pop` takes items by smooth weighted
+    round robin, so of every ``sum(weights)`` pops each busy lane gets
+    about its weight of them, evenly interleaved.
+
+    :param weights: Dict of lane weights, unknown lanes have weight 1.
+    """
+
+    def __init__(self, weights=None):
+        self.weights = dict(DEFAULT_WEIGHTS if weights is None else weights)
+        self._queues = {}
+        self._current = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __nonzero__(self):
+        return self._size > 0
+
+    def depths(self):
+        """Returns dict of number of items per busy lane."""
+        return dict((lane, len(queue))
+                    for lane, queue in self._queues.iteritems() if queue)
+
+    def push(self, lane, item):
+        queue = self._queues.get(lane)
+        if queue is None:
+            queue = self._queues[lane] = deque()
+            self._current[lane] = 0
+        queue.append(item)
+        self._size += 1
+
+    def pop(self):
+        """Returns `(lane, item)` pair of the lane whose turn it is."""
+        if not self._size:
+            raise IndexError('pop from empty lanes')
+        best = None
+        total = 0
+        current = self._current
+        for lane, queue in self._queues.iteritems():
+            if not queue:
+                continue
+            weight = self.weights.get(lane, 1)
+            total += weight
+            current[lane] += weight
+            if best is None or current[lane] > current[best]:
+                best = lane
+        current[best] -= total
+        self._size -= 1
+        queue = self._queues[best]
+        item = queue.popleft()
+        if not queue:
+            current[best] = 0
+        return best, item
+
+    def drain(self):
+        """Pops all items, returns list of `(lane, item)` pairs."""
+        pop = self.pop
+        return [pop() for _ in xrange(self._size)]
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+    xmppflask.server.loopback
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    In-memory XMPPWSGI server without any network: stanzas are injected by
+    the caller and everything app sends is captured in memory. Runs the
+    whole pipeline (environ setup, capabilities, request context, routing,
+    sessions, response dispatching) for tests and benchmarks::
+
+        server = LoopbackWsgiServer(app)
+        server.connect('bot@example.com', None)
+        server.inject(Message('k.bx@ya.ru/home', u'ping'))
+        assert server.outbox[-1] == ('message', {'body': u'pong', ...})
+
+    :license: BSD
+"""
+
+import itertools
+from collections import deque
+import caps
+from . import XmppWsgiServer
+from .filters import DEFAULT_FILTERS
+from .lanes import LANE_PRESENCE
+from .. import JID
+
+
+class LoopbackStanza(object):
+    """Synthetic stanza with plain attributes."""
+
+    __slots__ = ('jid', 'type', 'body', 'id', 'delay')
+
+    #: Stanza element name.
+    name = None
+
+    def __init__(self, jid, body=None, type=None, id=None, delay=0):
+        self.jid = jid
+        self.body = body
+        self.type = type
+        self.id = id
+        self.delay = delay
+
+    def __unicode__(self):
+        return u'<%s from="%s" type="%s">%s</%s>' % (
+            self.name, self.jid, self.type, self.body, self.name)
+
+
+class Message(LoopbackStanza):
+    __slots__ = ()
+    name = 'message'
+
+    def __init__(self, jid, body=None, type='chat', id=None, delay=0):
+        super(Message, self).__init__(jid, body, type, id, delay)
+
+
+class Presence(LoopbackStanza):
+    __slots__ = ('show', 'priority')
+    name = 'presence'
+
+    def __init__(self, jid, status=None, type=None, show=None, priority=0,
+                 id=None, delay=0):
+        super(Presence, self).__init__(jid, status, type, id, delay)
+        self.show = show
+        self.priority = priority
+
+
+class Iq(LoopbackStanza):
+    __slots__ = ()
+    name = 'iq'
+
+
+class LoopbackClient(object):
+    """Stands for XMPP library client, collects what app sends.
+
+    :param maxlen: Maximum number of stored outgoing commands, the oldest
+                   ones are discarded. Counters are kept for all of them.
+    """
+
+    def __init__(self, maxlen=None):
+        #: Last sent `(command, payload)` pairs, payload includes ``to``.
+        self.outbox = deque(maxlen=maxlen)
+        #: Number of sent commands by command name.
+        self.sent = {}
+        #: Number of stream writes.
+        self.writes = 0
+
+    def send(self, command, payload):
+        self.write([(command, payload)])
+
+    def write(self, items):
+        """Captures `(command, payload)` pairs written at once."""
+        self.writes += 1
+        self.outbox.extend(items)
+        for command, _ in items:
+            self.sent[command] = self.sent.get(command, 0) + 1
+
+
+class LoopbackCapability(caps.Capability):
+    pass
+
+
+class LoopbackWsgiServer(XmppWsgiServer):
+    """XMPPWSGI server which runs app for injected synthetic stanzas."""
+
+    capability_class = LoopbackCapability
+    client_class = LoopbackClient
+
+    message_class = Message
+    presence_class = Presence
+    iq_class = Iq
+
+    filter_classes = DEFAULT_FILTERS
+
+    #: Maximum number of captured outgoing commands.
+    outbox_size = 10000
+
+    def __init__(self, *args, **kwargs):
+        self.module = None
+        self.xmpp = self.client_class(self.outbox_size)
+        super(LoopbackWsgiServer, self).__init__(*args, **kwargs)
+
+    def write_stanzas(self, stanzas):
+        self.xmpp.write(stanzas)
+
+    def stanza_sender(self, stanza):
+        return stanza.jid
+
+    def stanza_body(self, stanza):
+        return stanza.body
+
+    def stanza_type(self, stanza):
+        return stanza.type
+
+    def stanza_id(self, stanza):
+        return stanza.id
+
+    def stanza_recipient(self, stanza):
+        to = stanza[1].get('to')
+        return unicode(to) if to is not None else None
+
+    @property
+    def outbox(self):
+        return self.xmpp.outbox
+
+    def connect(self, jid, pwd, use_tls=True, use_ssl=False):
+        self.base_environ['app.jid'] = JID(jid)
+        self.session_start()
+
+    def session_start(self):
+        super(LoopbackWsgiServer, self).session_start()
+
+    def serve_forever(self):
+        pass
+
+    def inject(self, stanza):
+        """Handles stanza as if it came from the network."""
+        self.handle(stanza)
+
+    def inject_many(self, stanzas, batch=1):
+        """Handles all stanzas from iterable, returns their number. Stanzas
+        are handled by `batch` of them, as if they were read at once."""
+        if batch > 1:
+            return self._inject_batches(stanzas, batch)
+        handle = self.handle
+        count = 0
+        for stanza in stanzas:
+            handle(stanza)
+            count += 1
+        return count
+
+    def _inject_batches(self, stanzas, batch):
+        count = 0
+        stanzas = iter(stanzas)
+        while True:
+            chunk = list(itertools.islice(stanzas, batch))
+            if not chunk:
+                return count
+            self.handle_many(chunk)
+            count += len(chunk)
+
+
+class Standard(caps.Standard, LoopbackCapability):
+
+    def update_environ(self, environ, stanza):
+        environ['xmpp.id'] = stanza.id
+        environ['xmpp.jid'] = JID(stanza.jid)
+        environ['xmpp.stanza_type'] = stanza.type
+        environ.lazy('xmpp.xml', unicode, stanza)
+        environ['xmpp.body'] = stanza.body
+        if isinstance(stanza, self.server.presence_class):
+            environ['xmpp.priority'] = stanza.priority
+            environ['xmpp.status'] = stanza.show
+        return environ
+
+    def cmd_message(self, environ, payload):
+        """Captures XMPP message.
+
+        :param environ: XMPPWSGI environ.
+        :type environ: dict
+
+        :param payload: Message payload data.
+        :type payload: dict
+
+        :returns: True
+        """
+        payload = dict(payload)
+        payload.setdefault('to', environ['xmpp.jid'])
+        payload.setdefault('type', environ.get('xmpp.stanza_type', 'chat'))
+        self.server.queue_stanza(('message', payload))
+        return True
+
+    def cmd_presence(self, environ, payload):
+        """Captures XMPP presence event.
+
+        :param environ: XMPPWSGI environ.
+        :type environ: dict
+
+        :param payload: Presence payload data.
+        :type payload: dict
+
+        :returns: True
+        """
+        payload = dict(payload)
+        payload.setdefault('to', environ['xmpp.jid'])
+        self.server.queue_stanza(('presence', payload), LANE_PRESENCE)
+        return True
+
+    def cmd_iq(self, environ, payload):
+        """Captures XMPP IQ request, there is nobody to respond.
+
+        :returns: None
+        """
+        payload = dict(payload)
+        payload.setdefault('to', environ['xmpp.jid'])
+        self.server.flush()
+        self.client.send('iq', payload)
+
+
+class Delay(caps.Delay, LoopbackCapability):
+
+    def update_environ(self, environ, stanza):
+        if stanza.delay:
+            environ['xmpp.delay'] = stanza.delay
+
+
+class Version(caps.Version, LoopbackCapability):
+
+    def cmd_version(self, environ, payload):
+        """Returns loopback software version as remote user one.
+
+        :returns: Software version info dict with keys: `os`, `name`, `version`
+        :rtype: dict
+        """
+        self.server.flush()
+        self.client.send('version', {'jid': payload.get('jid',
+                                                        environ['xmpp.jid'])})
+        return {'os': self.os, 'name': self.software, 'version': self.version}
+
+
+class Muc(caps.Muc, LoopbackCapability):
+
+    def cmd_join_room(self, environ, payload):
+        """Captures MUC room join request.
+
+        :param environ: XMPPWSGI environ.
+        :type environ: dict
+
+        :param payload: Payload data.
+        :type payload: dict
+        """
+        payload = dict(payload)
+        payload.setdefault('to', u'%s/%s' % (payload['room'],
+                                             payload['nick']))
+        self.server.queue_stanza(('join_room', payload), LANE_PRESENCE)
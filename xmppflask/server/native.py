@@ -0,0 +1,751 @@
+# -*- coding: utf-8 -*-
+"""
+    xmppflask.server.native
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    XMPPWSGI server which speaks XMPP by itself, without third party XMPP
+    library. Stream is handled over non-blocking socket by :mod:`asyncore`
+    event loop and parsed incrementally as data comes.
+
+    Commands never block the loop. IQ requests return
+    :class:`~xmppflask.server.helpers.Future` and generator views that
+    yield such commands are suspended until the response arrives, so any
+    number of IQ round trips may be in flight at once::
+
+        @app.route('version')
+        def version():
+            info = yield 'version', {}
+            yield 'You use %(name)s %(version)s' % info
+
+    :license: BSD
+"""
+
+import asyncore
+import base64
+import datetime
+import fcntl
+import heapq
+import itertools
+import os
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+from functools import partial
+from xml.etree import ElementTree as etree
+from xml.sax.saxutils import quoteattr
+
+import caps
+from . import XmppWsgiServer
+from .filters import DEFAULT_FILTERS
+from .helpers import gen_id, maybe_unicode
+from .iq import IqError, IqTimeout, map_future
+from .lanes import LANE_PRESENCE
+from .xmlstream import XmlStream, Message, Presence, Iq, make_stanza, \
+    qname, split_qname, tostring, NS_CLIENT, NS_STREAM, NS_TLS, NS_SASL, \
+    NS_BIND, NS_SESSION, NS_DELAY, NS_LEGACY_DELAY, NS_VERSION, NS_MUC
+from .. import JID
+
+
+class StreamError(Exception):
+    """Raises when XMPP stream couldn't be established."""
+
+
+class Waker(asyncore.file_dispatcher):
+    """Pipe which wakes up event loop waiting for socket events, so work
+    scheduled from other threads is done without delay.
+
+    :internal:
+    """
+
+    def __init__(self, map_):
+        rfd, self._wfd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, rfd, map=map_)
+        os.close(rfd)  # dispatcher holds its own copy
+        flags = fcntl.fcntl(self._wfd, fcntl.F_GETFL)
+        fcntl.fcntl(self._wfd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def wake(self):
+        try:
+            os.write(self._wfd, 'x')
+        except OSError:
+            pass  # pipe is full, so loop is going to wake up anyway
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except (OSError, socket.error):
+            pass
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self._wfd)
+
+
+class ClientStream(asyncore.dispatcher):
+    """Client side of XMPP stream. Negotiates STARTTLS, SASL PLAIN
+    authentication and resource binding and then passes received stanzas
+    to handlers registered by :meth:`register_handler`.
+
+    :param jid: Account JID. Its resource is requested on binding.
+    :param password: Account password.
+    :param use_tls: Use STARTTLS if server offers it.
+    :param use_ssl: Encrypt connection right after it's established.
+    :param map_: :mod:`asyncore` socket map to serve stream in.
+    :param ssl_context: :class:`ssl.SSLContext` to encrypt connection with.
+                        Default one verifies server certificate.
+    :param logger: Logger for stream errors.
+    """
+
+    #: Resource to bind if account JID has none.
+    default_resource = 'xmppflask'
+    #: Seconds to wait for TLS handshake.
+    handshake_timeout = 30
+
+    def __init__(self, jid, password, use_tls=True, use_ssl=False,
+                 map_=None, ssl_context=None, logger=None):
+        asyncore.dispatcher.__init__(self, map=map_)
+        self.jid = JID(jid)
+        self.password = password
+        self.use_tls = use_tls
+        self.use_ssl = use_ssl
+        self.ssl_context = ssl_context
+        self.logger = logger
+        #: Whether stream is encrypted.
+        self.secure = False
+        self.authenticated = False
+        #: Whether stream is negotiated and stanzas could be sent.
+        self.ready = False
+        #: Reason why stream failed, if it did.
+        self.error = None
+        self.handlers = {}
+        #: Called with list of stanzas read at once instead of
+        #: :meth:`dispatch`, e.g. to prepare for all of them.
+        self.on_stanzas = None
+        self._received = None
+        self._out = []
+        self._session = False
+        self._negotiate = self.on_features
+        self._parser = XmlStream(self.stream_start, self.stream_element,
+                                 self.stream_end)
+
+    def register_handler(self, name, func):
+        """Registers `func` to be called with every received stanza of
+        `name`: ``message``, ``presence`` or ``iq``."""
+        self.handlers.setdefault(name, []).append(func)
+
+    def connect_to(self, address):
+        family, socktype, _, _, sockaddr = socket.getaddrinfo(
+            address[0], address[1], 0, socket.SOCK_STREAM)[0]
+        self.create_socket(family, socktype)
+        self.connect(sockaddr)
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._out.append(data)
+
+    def send_element(self, element):
+        self.write(tostring(element))
+
+    def send_stanza(self, stanza):
+        self.write(unicode(stanza))
+
+    def open_stream(self):
+        self._parser.reset()
+        self.write(u"<?xml version='1.0'?><stream:stream xmlns=%s "
+                   u"xmlns:stream=%s to=%s version='1.0'>"
+                   % (quoteattr(NS_CLIENT), quoteattr(NS_STREAM),
+                      quoteattr(self.jid.domain)))
+
+    def start_tls(self):
+        context = self.ssl_context or ssl.create_default_context()
+        sock = self.socket
+        sock.settimeout(self.handshake_timeout)
+        try:
+            sock = context.wrap_socket(sock,
+                                       server_hostname=self.jid.domain)
+        finally:
+            sock.setblocking(0)
+        self.del_channel()
+        self.set_socket(sock)
+        self.secure = True
+
+    def fail(self, reason):
+        if self.error is None:
+            self.error = reason
+        if self.logger is not None:
+            self.logger.error('XMPP stream failed: %s', reason)
+        self.close()
+
+    # asyncore interface
+
+    def writable(self):
+        return bool(self._out) or self.connecting
+
+    def handle_connect(self):
+        if self.use_ssl:
+            self.start_tls()
+        self.open_stream()
+
+    def handle_read(self):
+        try:
+            data = self.recv(65536)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        self._received = received = []
+        try:
+            while data:
+                try:
+                    self._parser.feed(data)
+                except etree.ParseError as err:
+                    self.fail('invalid XML: %s' % err)
+                    break
+                # TLS layer may keep decrypted data which select() won't see
+                pending = (self.secure and self.connected
+                           and self.socket.pending())
+                data = self.recv(pending) if pending else None
+        finally:
+            self._received = None
+        if received:
+            (self.on_stanzas or self.dispatch)(received)
+
+    def handle_write(self):
+        data = ''.join(self._out)
+        try:
+            sent = self.send(data)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        self._out = [data[sent:]] if sent < len(data) else []
+
+    def handle_close(self):
+        if self.error is None and not self.ready:
+            self.error = 'connection closed'
+        self.ready = False
+        self.close()
+
+    def handle_error(self):
+        if self.logger is not None:
+            self.logger.exception('XMPP stream error')
+        self.fail('internal error')
+
+    # XML stream callbacks
+
+    def stream_start(self, attrs):
+        self.stream_id = attrs.get('id')
+
+    def stream_end(self):
+        self.write('</stream:stream>')
+        self.handle_write()
+        self.handle_close()
+
+    def stream_element(self, element):
+        if element.tag == qname(NS_STREAM, 'error'):
+            condition = element[0].tag if len(element) else 'unknown'
+            return self.fail('stream error %s' % split_qname(condition)[1])
+        if not self.ready:
+            return self._negotiate(element)
+        stanza = make_stanza(element)
+        if stanza is None:
+            return
+        if self._received is not None:
+            self._received.append(stanza)
+        else:
+            self.dispatch([stanza])
+
+    def dispatch(self, stanzas):
+        """Passes received stanzas to registered handlers. Handler errors
+        are logged, they don't affect other stanzas and the stream."""
+        handlers = self.handlers
+        for stanza in stanzas:
+            for func in handlers.get(stanza.name, ()):
+                try:
+                    func(stanza)
+                except Exception:
+                    if self.logger is not None:
+                        self.logger.exception('Failed to handle %s from %s',
+                                              stanza.name, stanza.from_jid)
+
+    # Stream negotiation, RFC 6120
+
+    def on_features(self, features):
+        if features.tag != qname(NS_STREAM, 'features'):
+            return self.fail('unexpected %s' % features.tag)
+        if not self.secure and self.use_tls \
+                and features.find(qname(NS_TLS, 'starttls')) is not None:
+            self.send_element(etree.Element(qname(NS_TLS, 'starttls')))
+            self._negotiate = self.on_starttls
+        elif not self.authenticated:
+            mechanisms = [mech.text for mech
+                          in features.iter(qname(NS_SASL, 'mechanism'))]
+            if 'PLAIN' not in mechanisms:
+                return self.fail('PLAIN authentication is not supported')
+            auth = etree.Element(qname(NS_SASL, 'auth'), mechanism='PLAIN')
+            credentials = u'\0%s\0%s' % (self.jid.user, self.password)
+            auth.text = base64.b64encode(credentials.encode('utf-8'))
+            self.send_element(auth)
+            self._negotiate = self.on_auth
+        elif features.find(qname(NS_BIND, 'bind')) is not None:
+            self._session = \
+                features.find(qname(NS_SESSION, 'session')) is not None
+            iq = Iq(type='set', id=gen_id())
+            bind = iq.add_child('bind', NS_BIND)
+            resource = etree.SubElement(bind, qname(NS_BIND, 'resource'))
+            resource.text = self.jid.resource or self.default_resource
+            self.send_stanza(iq)
+            self._negotiate = self.on_bind
+        else:
+            self.fail('resource binding is not supported')
+
+    def on_starttls(self, element):
+        if element.tag != qname(NS_TLS, 'proceed'):
+            return self.fail('STARTTLS failed')
+        self.start_tls()
+        self.open_stream()
+        self._negotiate = self.on_features
+
+    def on_auth(self, element):
+        if element.tag != qname(NS_SASL, 'success'):
+            return self.fail('authentication failed')
+        self.authenticated = True
+        self.open_stream()
+        self._negotiate = self.on_features
+
+    def on_bind(self, element):
+        iq = make_stanza(element)
+        if not isinstance(iq, Iq) or iq.type != 'result':
+            return self.fail('resource binding failed')
+        jid = iq.find('bind', NS_BIND).findtext(qname(NS_BIND, 'jid'))
+        if jid:
+            self.jid = JID(jid)
+        if self._session:
+            iq = Iq(type='set', id=gen_id())
+            iq.add_child('session', NS_SESSION)
+            self.send_stanza(iq)
+            self._negotiate = self.on_session
+        else:
+            self.ready = True
+
+    def on_session(self, element):
+        iq = make_stanza(element)
+        if not isinstance(iq, Iq) or iq.type != 'result':
+            return self.fail('session establishment failed')
+        self.ready = True
+
+
+class NativeCapability(caps.Capability):
+    pass
+
+
+class NativeXmppWsgiServer(XmppWsgiServer):
+    """XMPPWSGI server based on :mod:`asyncore` event loop."""
+
+    capability_class = NativeCapability
+    stream_class = ClientStream
+
+    message_class = Message
+    presence_class = Presence
+    iq_class = Iq
+
+    filter_classes = DEFAULT_FILTERS
+
+    #: :class:`ssl.SSLContext` for encrypted connections. Default one
+    #: verifies server certificate.
+    ssl_context = None
+
+    def __init__(self, *args, **kwargs):
+        from . import xmlstream
+        self.module = xmlstream
+        self.socket_map = {}
+        #: Handlers of incoming ``get`` and ``set`` IQs by query namespace.
+        self.iq_handlers = {}
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._calls = deque()
+        self._waker = Waker(self.socket_map)
+        self._loop_thread = None
+        super(NativeXmppWsgiServer, self).__init__(*args, **kwargs)
+
+    def stanza_sender(self, stanza):
+        return stanza.get('from')
+
+    def stanza_body(self, stanza):
+        return stanza.child_text('body')
+
+    def stanza_type(self, stanza):
+        return stanza.get('type')
+
+    def stanza_id(self, stanza):
+        return stanza.get('id')
+
+    def stanza_recipient(self, stanza):
+        return stanza.get('to')
+
+    def connect(self, jid, pwd, use_tls=True, use_ssl=False, address=None,
+                timeout=30):
+        """Connects to the XMPP server, `address` is the account domain at
+        default port unless specified. Blocks until stream is negotiated.
+        """
+        stream = self.stream_class(jid, pwd, use_tls=use_tls, use_ssl=use_ssl,
+                                   map_=self.socket_map,
+                                   ssl_context=self.ssl_context,
+                                   logger=self.app.logger)
+        stream.on_stanzas = self.handle_stanzas
+        self.xmpp = stream
+        if address is None:
+            address = (stream.jid.domain, 5223 if use_ssl else 5222)
+        stream.connect_to(address)
+        deadline = time.time() + timeout
+        while not stream.ready:
+            if stream.error is not None:
+                raise StreamError(u'Unable to connect to %s: %s'
+                                  % (address[0], stream.error))
+            if time.time() > deadline:
+                stream.close()
+                raise StreamError(u'Unable to connect to %s: timed out'
+                                  % address[0])
+            self.poll(0.1)
+
+        self.base_environ['app.jid'] = stream.jid
+        self.base_environ['app.protocol'] = ('ssl' if use_ssl else
+                                             'tls' if stream.secure else
+                                             None)
+        self.session_start()
+
+    def handle_stanzas(self, stanzas):
+        """Handles stanzas read at once, sessions of their senders are
+        loaded and saved in a batch."""
+        jids = self.session_jids([stanza for stanza in stanzas
+                                  if stanza.name != 'iq'])
+        with self.app.session_interface.batch(self.app, jids):
+            self.xmpp.dispatch(stanzas)
+
+    def session_start(self):
+        super(NativeXmppWsgiServer, self).session_start()
+        self.send(self.presence_class())
+
+    def serve_forever(self):
+        try:
+            while self.xmpp is not None and self.xmpp.connected:
+                self.poll(1.0)
+        except KeyboardInterrupt:
+            pass
+
+    def poll(self, timeout=1.0):
+        """Runs single event loop iteration waiting for socket events no
+        longer than `timeout` seconds."""
+        self._loop_thread = threading.current_thread()
+        self.run_calls()
+        if self._calls:
+            timeout = 0
+        else:
+            if self._timers:
+                timeout = max(0, min(timeout,
+                                     self._timers[0][0] - time.time()))
+            if self.iq_table:
+                timeout = min(timeout, self.iq_table.wheel.tick)
+        asyncore.loop(timeout, map=self.socket_map, count=1)
+        self.run_timers()
+        self.iq_table.expire()
+        self.run_calls()
+
+    def in_loop(self):
+        """Checks if current thread runs the event loop."""
+        return threading.current_thread() is self._loop_thread
+
+    def call_soon_threadsafe(self, func, *args):
+        """Schedules `func` call in the event loop thread."""
+        self._calls.append(partial(func, *args))
+        self._waker.wake()
+
+    def call_later(self, delay, func, *args):
+        """Schedules `func` call in `delay` seconds. Returns timer that
+        could be passed to :meth:`cancel_timer`. Loop thread only."""
+        timer = [time.time() + delay, next(self._timer_seq),
+                 partial(func, *args)]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel_timer(self, timer):
+        timer[2] = None
+
+    def run_calls(self):
+        calls = self._calls
+        while calls:
+            self.safe_call(calls.popleft())
+
+    def run_timers(self):
+        timers = self._timers
+        now = time.time()
+        while timers and timers[0][0] <= now:
+            func = heapq.heappop(timers)[2]
+            if func is not None:
+                self.safe_call(func)
+
+    def safe_call(self, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            self.app.logger.exception('Error in event loop callback')
+
+    def send(self, stanza):
+        """Sends stanza right away after queued ones. Could be called from
+        any thread."""
+        self.flush()
+        if self.in_loop():
+            self.xmpp.send_stanza(stanza)
+        else:
+            self.call_soon_threadsafe(self.xmpp.send_stanza, stanza)
+
+    def write_stanzas(self, stanzas):
+        data = u''.join(unicode(stanza) for stanza in stanzas)
+        if self.in_loop():
+            self.xmpp.write(data)
+        else:
+            self.call_soon_threadsafe(self.xmpp.write, data)
+
+    def send_iq(self, iq, timeout=None):
+        """Sends IQ request after queued stanzas through the rate limiter,
+        timeout includes time it waits there. Could be called from any
+        thread.
+
+        :returns: :class:`~xmppflask.server.helpers.Future` of response
+                  :class:`~xmppflask.server.xmlstream.Iq` which fails with
+                  :exc:`~xmppflask.server.iq.IqError` or
+                  :exc:`~xmppflask.server.iq.IqTimeout`.
+        """
+        if iq.id is None:
+            iq.set('id', gen_id())
+        future = self.track_iq(iq.id, iq.to, timeout)
+        self.queue_stanza(iq)
+        self.flush()
+        return future
+
+    def handle_iq(self, stanza):
+        """Completes pending IQ requests with responses and passes requests
+        to :attr:`iq_handlers`."""
+        if stanza.type in ('result', 'error'):
+            self.resolve_iq(stanza)
+            return
+        query = stanza.query
+        handler = None
+        if query is not None:
+            handler = self.iq_handlers.get(split_qname(query.tag)[0])
+        if handler is None:
+            self.send(stanza.make_error('service-unavailable'))
+        else:
+            handler(stanza)
+
+
+class Standard(caps.Standard, NativeCapability):
+
+    def __init__(self, server):
+        super(Standard, self).__init__(server)
+        self.client.register_handler('message', self.handle_message)
+        self.client.register_handler('presence', self.handle_presence)
+        self.client.register_handler('iq', self.handle_iq)
+
+    def handle_iq(self, stanza):
+        """Handles XMPP iq stanza."""
+        return self.server.handle_iq(stanza)
+
+    def update_environ(self, environ, stanza):
+        environ['xmpp.id'] = maybe_unicode(stanza.id)
+
+        environ['xmpp.jid'] = JID(stanza.from_jid or u'')
+        environ['xmpp.stanza_type'] = maybe_unicode(stanza.type)
+
+        environ.lazy('xmpp.xml', unicode, stanza)
+        if isinstance(stanza, self.server.message_class):
+            environ['xmpp.body'] = maybe_unicode(stanza.body)
+        elif isinstance(stanza, self.server.presence_class):
+            environ.lazy('xmpp.priority', getattr, stanza, 'priority')
+            environ['xmpp.body'] = maybe_unicode(stanza.status)
+            environ['xmpp.status'] = maybe_unicode(stanza.show)
+
+        return environ
+
+    def cmd_message(self, environ, payload):
+        """Sends XMPP message.
+
+        :param environ: XMPPWSGI environ.
+        :type environ: dict
+
+        :param payload: Message payload data.
+        :type payload: dict
+
+        :returns: True
+        """
+        to_jid = JID(payload.get('to', environ['xmpp.jid']))
+
+        if environ['xmpp.stanza_type'] == 'groupchat':
+            to_jid = to_jid.bare
+        else:
+            to_jid = to_jid.full
+
+        msg = self.server.message_class(to=to_jid, id=gen_id(),
+                                        type=environ['xmpp.stanza_type'])
+        msg.add_child('body', text=payload['body'])
+        self.server.queue_stanza(msg)
+        return True
+
+    def cmd_presence(self, environ, payload):
+        """Sends XMPP presence event.
+
+        :param environ: XMPPWSGI environ.
+        :type environ: dict
+
+        :param payload: Presence payload data.
+        :type payload: dict
+
+        :returns: True
+        """
+        to_jid = payload.get('to', environ['xmpp.jid'])
+        if to_jid == 'all':
+            to_jid = None
+        elif isinstance(to_jid, JID):
+            to_jid = to_jid.full
+
+        presence = self.server.presence_class(to=to_jid)
+        if 'type' not in payload:
+            pass
+        elif payload['type'] in ('available',):
+            pass
+        elif payload['type'] in ('unavailable', 'subscribe', 'subscribed',
+                                 'unsubscribe', 'unsubscribed', 'probe'):
+            presence.set('type', payload['type'])
+        else:
+            presence.add_child('show', text=payload['type'])
+            if payload.get('status'):
+                presence.add_child('status', text=payload['status'])
+        self.server.queue_stanza(presence, LANE_PRESENCE)
+        return True
+
+    def cmd_iq(self, environ, payload):
+        """Sends XMPP IQ request.
+
+        :param environ: XMPPWSGI environ.
+        :type environ: dict
+
+        :param payload: IQ payload data: `to` (sender by default), `type`
+                        (``get`` by default) and either `query` namespace
+                        of empty query element or `xml` payload element.
+        :type payload: dict
+
+        :returns: :class:`~xmppflask.server.helpers.Future` of response IQ
+        """
+        to_jid = payload.get('to', environ['xmpp.jid'])
+        if isinstance(to_jid, JID):
+            to_jid = to_jid.full
+
+        iq = self.server.iq_class(type=payload.get('type', 'get'), to=to_jid)
+        if 'xml' in payload:
+            xml = payload['xml']
+            if isinstance(xml, basestring):
+                xml = etree.fromstring(xml)
+            iq.element.append(xml)
+        elif 'query' in payload:
+            iq.add_child('query', payload['query'])
+        return self.server.send_iq(iq, payload.get('timeout'))
+
+
+class Delay(caps.Delay, NativeCapability):
+
+    def update_environ(self, environ, stanza):
+        delay = stanza.find('delay', NS_DELAY)
+        if delay is not None:
+            stamp, fmt = delay.get('stamp', '')[:19], '%Y-%m-%dT%H:%M:%S'
+        else:
+            delay = stanza.find('x', NS_LEGACY_DELAY)
+            if delay is None:
+                return
+            stamp, fmt = delay.get('stamp', ''), '%Y%m%dT%H:%M:%S'
+        environ.lazy('xmpp.delay', self.parse_delay,
+                     environ['xmpp.timestamp'], stamp, fmt)
+
+    def parse_delay(self, timestamp, stamp, fmt):
+        try:
+            delay = time.mktime(
+                datetime.datetime.strptime(stamp, fmt).utctimetuple())
+        except ValueError:
+            return 0
+        return timestamp - delay
+
+
+class Version(caps.Version, NativeCapability):
+
+    def __init__(self, *args, **kwargs):
+        super(Version, self).__init__(*args, **kwargs)
+        self.server.iq_handlers[NS_VERSION] = self.handle_version_query
+
+    def handle_version_query(self, iq):
+        """Replies to software version request."""
+        if iq.type != 'get':
+            return self.server.send(iq.make_error('bad-request', 'modify'))
+        result = iq.make_result()
+        query = result.add_child('query', NS_VERSION)
+        for name, value in (('name', self.software),
+                            ('version', self.version),
+                            ('os', self.os)):
+            etree.SubElement(query, qname(NS_VERSION, name)).text = value
+        self.server.send(result)
+
+    def cmd_version(self, environ, payload):
+        """Returns software version of remote user.
+
+        :param environ: XMPPWSGI environ.
+        :type environ: dict
+
+        :param payload: Payload data.
+        :type payload: dict
+
+        :returns: :class:`~xmppflask.server.helpers.Future` of software
+                  version info dict with keys: `os`, `name`, `version` or
+                  None if remote user didn't tell it
+        """
+        jid = payload.get('jid', environ['xmpp.jid'])
+        if isinstance(jid, JID):
+            jid = jid.full
+
+        iq = self.server.iq_class(type='get', to=jid)
+        iq.add_child('query', NS_VERSION)
+        return map_future(self.server.send_iq(iq), self.version_info)
+
+    def version_info(self, response):
+        info = {
+            'os': None,
+            'name': None,
+            'version': None
+        }
+        query = response.find('query', NS_VERSION)
+        for prop in query if query is not None else ():
+            name = split_qname(prop.tag)[1]
+            if name in info:
+                info[name] = prop.text
+        return info
+
+
+class Muc(caps.Muc, NativeCapability):
+
+    def cmd_join_room(self, environ, payload):
+        """Joins to the specified MUC room.
+
+        :param environ: XMPPWSGI environ.
+        :type environ: dict
+
+        :param payload: Payload data.
+        :type payload: dict
+        """
+        jid = JID(payload['room'])
+        jid.resource = payload['nick']
+        presence = self.server.presence_class(to=jid.full)
+        x = presence.add_child('x', NS_MUC)
+        etree.SubElement(x, qname(NS_MUC, 'history'), maxchars='0')
+        if payload.get('password'):
+            etree.SubElement(x, qname(NS_MUC, 'password')).text = \
+                payload['password']
+        self.server.queue_stanza(presence, LANE_PRESENCE)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+    xmppflask.server.ratelimit
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Outgoing stanzas rate limiting. XMPP servers shape client traffic and
+    may disconnect ones which send too much at once, so stanzas over the
+    limit are held back and written later at the permitted rate.
+
+    :license: BSD
+"""
+
+import threading
+import time
+from collections import deque
+from .lanes import WeightedLanes
+
+
+def bare_jid(jid):
+    """Returns bare part of JID string, keeps None as is."""
+    return jid.split('/', 1)[0] if jid else jid
+
+
+class TokenBucket(object):
+    """Allows `rate` events per second on average and up to `burst` of them
+    at once.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        """Returns seconds to wait till the next event is allowed."""
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class OutboundRateLimiter(object):
+    """Passes outgoing stanzas through global and per recipient token
+    buckets. Stanzas over the limit are queued and written by background
+    thread as soon as buckets allow. Queued stanzas are taken from
+    :class:`~xmppflask.server.lanes.WeightedLanes`, so replies overtake
+    bulk notifications; stanzas for the same bare recipient JID are
+    written in order regardless of lanes, so e.g. MUC join presence goes
+    before messages to the room.
+
+    :param write: Callable which writes list of stanzas to the stream.
+    :param recipient: Callable which returns stanza recipient.
+    :param rate: Overall stanzas per second, zero for no limit.
+    :param burst: Overall stanzas which could be sent at once.
+    :param recipient_rate: Stanzas per second for a single recipient, zero
+                           for no limit.
+    :param recipient_burst: Stanzas which could be sent to a single
+                            recipient at once.
+    :param weights: Lane weights, see
+                    :class:`~xmppflask.server.lanes.WeightedLanes`.
+    """
+
+    #: Seconds between removals of idle recipient buckets.
+    prune_interval = 60
+
+    def __init__(self, write, recipient, rate=0, burst=1, recipient_rate=0,
+                 recipient_burst=1, weights=None, clock=time.time):
+        self.write = write
+        self.recipient = recipient
+        self.clock = clock
+        now = clock()
+        self.bucket = TokenBucket(rate, burst, now) if rate else None
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.buckets = {}
+        #: Number of stanzas waiting to be sent now.
+        self.queued = 0
+        #: Number of stanzas written after waiting.
+        self.delayed = 0
+        #: Total seconds stanzas spent waiting.
+        self.wait_time = 0.0
+        #: The longest wait of a stanza in seconds.
+        self.max_wait = 0.0
+        #: Waiting stanzas by `(lane, recipient)` key.
+        self._waiting = {}
+        #: Sequence numbers of waiting stanzas by bare recipient.
+        self._order = {}
+        self._seq = 0
+        #: Keys with waiting stanzas.
+        self._keys = WeightedLanes(weights)
+        self._pruned = now
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        """Starts thread which writes queued stanzas."""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self.run,
+                                            name='xmppflask-ratelimit')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stops the thread, queued stanzas stay queued."""
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._stopped = True
+            self._cond.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def stats(self):
+        """Returns dict of metrics: number of `queued` stanzas and of them
+        per lane in `lanes`, number of `delayed` ones written after
+        waiting, their average and maximum wait in seconds."""
+        with self._cond:
+            lanes = {}
+            for (lane, _), waiting in self._waiting.iteritems():
+                lanes[lane] = lanes.get(lane, 0) + len(waiting)
+            return {
+                'queued': self.queued,
+                'lanes': lanes,
+                'delayed': self.delayed,
+                'wait_avg': self.wait_time / self.delayed if self.delayed
+                            else 0.0,
+                'wait_max': self.max_wait,
+            }
+
+    def send(self, stanzas):
+        """Writes stanzas allowed by the limits, queues the rest.
+
+        :param stanzas: List of `(lane, stanza)` pairs.
+        """
+        with self._cond:
+            now = self.clock()
+            for lane, stanza in stanzas:
+                recipient = self.recipient(stanza)
+                key = (lane, recipient)
+                waiting = self._waiting.get(key)
+                if waiting is None:
+                    waiting = self._waiting[key] = deque()
+                    self._keys.push(lane, key)
+                self._seq += 1
+                waiting.append((self._seq, stanza, now))
+                order = self._order.get(bare_jid(recipient))
+                if order is None:
+                    order = self._order[bare_jid(recipient)] = deque()
+                order.append(self._seq)
+                self.queued += 1
+            released = self._release(now)[0]
+            if released:
+                self.write(released)
+            if self.queued:
+                self._cond.notify()
+            if now - self._pruned > self.prune_interval:
+                self._prune(now)
+
+    def drain(self):
+        """Writes queued stanzas allowed by the limits by now. Returns
+        seconds till the next one could be written or None if nothing is
+        queued."""
+        with self._cond:
+            now = self.clock()
+            released, next_in = self._release(now)
+            if released:
+                self.write(released)
+            if now - self._pruned > self.prune_interval:
+                self._prune(now)
+            return next_in
+
+    def run(self):
+        """Background thread loop."""
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                if not self.queued:
+                    self._cond.wait()
+                    continue
+            delay = self.drain()
+            if delay:
+                with self._cond:
+                    if not self._stopped:
+                        self._cond.wait(delay)
+
+    def _release(self, now):
+        """Takes queued stanzas allowed by now, one by one in lanes order.
+        Returns them and seconds till the next one is allowed."""
+        released = []
+        blocked = []
+        # keys behind earlier stanza for the same bare JID in other lane
+        behind = {}
+        next_in = None
+        keys = self._keys
+        while keys:
+            lane, key = keys.pop()
+            waiting = self._waiting[key]
+            bare = bare_jid(key[1])
+            order = self._order[bare]
+            if waiting[0][0] != order[0]:
+                behind.setdefault(bare, []).append((lane, key))
+                continue
+            delay = self._delay(key[1], now)
+            if delay:
+                blocked.append((lane, key))
+                next_in = delay if next_in is None else min(next_in, delay)
+                if self.bucket is not None and self.bucket.delay(now):
+                    break  # nothing else could be sent either
+                continue
+            self._take(key[1])
+            _, stanza, queued_at = waiting.popleft()
+            order.popleft()
+            if not order:
+                del self._order[bare]
+            released.append(stanza)
+            self.queued -= 1
+            if queued_at < now:
+                wait = now - queued_at
+                self.delayed += 1
+                self.wait_time += wait
+                self.max_wait = max(self.max_wait, wait)
+            if waiting:
+                keys.push(lane, key)
+            else:
+                del self._waiting[key]
+            for lane, key in behind.pop(bare, ()):
+                keys.push(lane, key)
+        for lane, key in blocked:
+            keys.push(lane, key)
+        for held in behind.itervalues():
+            for lane, key in held:
+                keys.push(lane, key)
+        return released, next_in
+
+    def _delay(self, recipient, now):
+        delay = self.bucket.delay(now) if self.bucket is not None else 0
+        if self.recipient_rate:
+            bucket = self.buckets.get(recipient)
+            if bucket is None:
+                bucket = self.buckets[recipient] = TokenBucket(
+                    self.recipient_rate, self.recipient_burst, now)
+            delay = max(delay, bucket.delay(now))
+        return delay
+
+    def _take(self, recipient):
+        if self.bucket is not None:
+            self.bucket.take()
+        if self.recipient_rate:
+            self.buckets[recipient].take()
+
+    def _prune(self, now):
+        """Forgets full buckets of recipients without queued stanzas, they
+        would be recreated in the same state."""
+        self._pruned = now
+        waiting = set(recipient for _, recipient in self._waiting)
+        for recipient, bucket in self.buckets.items():
+            if recipient not in waiting and bucket.full(now):
+                del self.buckets[recipient]
@@ -10,12 +10,23 @@
 """
 
 import time
+from xml.etree import ElementTree as etree
 import caps
 from . import XmppWsgiServer
-from .helpers import maybe_unicode
+from .filters import DEFAULT_FILTERS
+from .helpers import gen_id, maybe_unicode
+from .iq import map_future
+from .lanes import LANE_PRESENCE
 from .. import JID
 
 sleekxmpp = __import__('sleekxmpp')
+# this module shadows sleekxmpp package for implicit relative imports
+Callback = __import__('sleekxmpp.xmlstream.handler',
+                      fromlist=['Callback']).Callback
+StanzaPath = __import__('sleekxmpp.xmlstream.matcher',
+                        fromlist=['StanzaPath']).StanzaPath
+
+NS_VERSION = 'jabber:iq:version'
 
 
 class SleekXmppCapability(caps.Capability):
@@ -26,6 +37,7 @@ class SleekXmppWsgiServer(XmppWsgiServer):
     """XMPPWSGI server based on SleekXMPP library."""
 
     capability_class = SleekXmppCapability
+    filter_classes = DEFAULT_FILTERS
 
     def __init__(self, *args, **kwargs):
         self.module = sleekxmpp
@@ -34,6 +46,45 @@ class SleekXmppWsgiServer(XmppWsgiServer):
         self.iq_class = sleekxmpp.Iq
         super(SleekXmppWsgiServer, self).__init__(*args, **kwargs)
 
+    def write_stanzas(self, stanzas):
+        if len(stanzas) == 1:
+            if isinstance(stanzas[0], self.iq_class):
+                # responses are tracked by the server, don't wait for them
+                return stanzas[0].send(block=False)
+            return stanzas[0].send()
+        self.xmpp.send_raw(u''.join(unicode(stanza) for stanza in stanzas))
+
+    def send_iq(self, iq, timeout=None):
+        """Sends IQ request after queued stanzas through the rate limiter,
+        timeout includes time it waits there.
+
+        :returns: :class:`~xmppflask.server.helpers.Future` of response
+                  :class:`sleekxmpp.Iq` which fails with
+                  :exc:`~xmppflask.server.iq.IqError` or
+                  :exc:`~xmppflask.server.iq.IqTimeout`.
+        """
+        if not iq['id']:
+            iq['id'] = gen_id()
+        future = self.track_iq(iq['id'], self.stanza_recipient(iq), timeout)
+        self.queue_stanza(iq)
+        self.flush()
+        return future
+
+    def stanza_sender(self, stanza):
+        return stanza.xml.get('from')
+
+    def stanza_body(self, stanza):
+        return stanza.xml.findtext('{%s}body' % stanza.namespace)
+
+    def stanza_type(self, stanza):
+        return stanza.xml.get('type')
+
+    def stanza_id(self, stanza):
+        return stanza.xml.get('id')
+
+    def stanza_recipient(self, stanza):
+        return stanza.xml.get('to')
+
     def connect(self, jid, pwd, use_tls=True, use_ssl=False):
         self.xmpp = self.module.ClientXMPP(jid, pwd)
 
@@ -49,6 +100,8 @@ class SleekXmppWsgiServer(XmppWsgiServer):
 
     def session_start(self, session):
         super(SleekXmppWsgiServer, self).session_start()
+        self.xmpp.schedule('xmppflask iq expiry', self.iq_table.wheel.tick,
+                           self.iq_table.expire, repeat=True)
         self.xmpp.send_presence()
 
     def serve_forever(self):
@@ -62,6 +115,14 @@ class Standard(caps.Standard, SleekXmppCapability):
         self.client.register_plugin('xep_0030')
         self.client.add_event_handler('message', self.handle_message)
         self.client.add_event_handler('presence', self.handle_presence)
+        for typ in ('result', 'error'):
+            self.client.register_handler(Callback(
+                'XmppFlask IQ %s' % typ, StanzaPath('iq@type=%s' % typ),
+                self.handle_iq_response))
+
+    def handle_iq_response(self, stanza):
+        """Completes pending IQ request."""
+        self.server.resolve_iq(stanza)
 
     def update_environ(self, environ, stanza):
         environ['xmpp.id'] = maybe_unicode(stanza['id'])
@@ -70,11 +131,11 @@ class Standard(caps.Standard, SleekXmppCapability):
         environ['xmpp.jid'] = JID(jid.full)
         environ['xmpp.stanza_type'] = maybe_unicode(stanza['type'])
 
-        environ['xmpp.xml'] = unicode(stanza)
+        environ.lazy('xmpp.xml', unicode, stanza)
         if isinstance(stanza, self.server.message_class):
             environ['xmpp.body'] = maybe_unicode(stanza['body'])
         elif isinstance(stanza, self.server.presence_class):
-            environ['xmpp.priority'] = stanza['priority']
+            environ.lazy('xmpp.priority', stanza.__getitem__, 'priority')
             environ['xmpp.body'] = maybe_unicode(stanza['status'])
             environ['xmpp.status'] = maybe_unicode(stanza['show'])
 
@@ -96,10 +157,10 @@ class Standard(caps.Standard, SleekXmppCapability):
         else:
             to_jid = to_jid.full
 
-        self.client.send_message(
+        self.server.queue_stanza(self.client.make_message(
             mto=to_jid,
             mbody=payload['body'],
-            mtype=environ['xmpp.stanza_type'])
+            mtype=environ['xmpp.stanza_type']))
         return True
 
     def cmd_presence(self, environ, payload):
@@ -120,21 +181,48 @@ class Standard(caps.Standard, SleekXmppCapability):
         elif isinstance(to_jid, JID):
             to_jid = to_jid.full
 
+        make_presence = self.client.make_presence
         if 'type' not in payload:
-            self.client.send_presence(pto=to_jid)
+            presence = make_presence(pto=to_jid)
         elif payload['type'] in ('available', 'unavailable'):
-            self.client.send_presence(pto=to_jid, ptype=payload['type'])
+            presence = make_presence(pto=to_jid, ptype=payload['type'])
         elif payload['type'] in ('subscribe', 'subscribed',
                                  'unsubscribe', 'unsubscribed', 'probe'):
-            self.client.send_presence(pto=to_jid, ptype=payload['type'])
+            presence = make_presence(pto=to_jid, ptype=payload['type'])
         else:
-            self.client.send_presence(pto=to_jid,
-                                      pstatus=payload.get('status', ''),
-                                      pshow=payload['type'])
+            presence = make_presence(pto=to_jid,
+                                     pstatus=payload.get('status', ''),
+                                     pshow=payload['type'])
+        self.server.queue_stanza(presence, LANE_PRESENCE)
         return True
 
     def cmd_iq(self, environ, payload):
-        raise NotImplementedError
+        """Sends XMPP IQ request.
+
+        :param environ: XMPPWSGI environ.
+        :type environ: dict
+
+        :param payload: IQ payload data: `to` (sender by default), `type`
+                        (``get`` by default) and either `query` namespace
+                        of empty query element or `xml` payload element.
+        :type payload: dict
+
+        :returns: :class:`~xmppflask.server.helpers.Future` of response IQ
+        """
+        to_jid = payload.get('to', environ['xmpp.jid'])
+        if isinstance(to_jid, JID):
+            to_jid = to_jid.full
+
+        iq = self.client.make_iq(id=gen_id(), ito=to_jid,
+                                 itype=payload.get('type', 'get'))
+        if 'xml' in payload:
+            xml = payload['xml']
+            if isinstance(xml, basestring):
+                xml = etree.fromstring(xml)
+            iq.xml.append(xml)
+        elif 'query' in payload:
+            iq['query'] = payload['query']
+        return self.server.send_iq(iq, payload.get('timeout'))
 
 
 class Delay(caps.Delay, SleekXmppCapability):
@@ -146,11 +234,12 @@ class Delay(caps.Delay, SleekXmppCapability):
     def update_environ(self, environ, stanza):
         if 'delay' not in stanza.plugins:
             return
+        environ.lazy('xmpp.delay', self.parse_delay,
+                     environ['xmpp.timestamp'], stanza.plugins['delay'])
 
-        delay = time.mktime(
-            stanza.plugins['delay'].get_stamp().utctimetuple()
-        )
-        environ['xmpp.delay'] = environ['xmpp.timestamp'] - delay
+    def parse_delay(self, timestamp, delay):
+        delay = time.mktime(delay.get_stamp().utctimetuple())
+        return timestamp - delay
 
 
 class Version(caps.Version, SleekXmppCapability):
@@ -172,21 +261,29 @@ class Version(caps.Version, SleekXmppCapability):
         :param payload: Payload data.
         :type payload: dict
 
-        :returns: Software version info dict with keys: `os`, `name`, `version`
-        :rtype: dict
+        :returns: :class:`~xmppflask.server.helpers.Future` of software
+                  version info dict with keys: `os`, `name`, `version` or
+                  None if remote user didn't tell it
         """
         jid = payload.get('jid', environ['xmpp.jid'])
         if isinstance(jid, JID):
             jid = jid.full
 
-        try:
-            resp = self.client.plugin['xep_0092'].get_version(jid)
-            if resp:
-                return resp
-        except Exception:
-            self.app.logger.exception('Failed to retrieve version info for %s',
-                                      jid)
-            return None
+        iq = self.client.make_iq_get(queryxmlns=NS_VERSION, ito=jid)
+        return map_future(self.server.send_iq(iq), self.version_info)
+
+    def version_info(self, response):
+        info = {
+            'os': None,
+            'name': None,
+            'version': None
+        }
+        query = response.xml.find('{%s}query' % NS_VERSION)
+        for prop in query if query is not None else ():
+            name = prop.tag.split('}', 1)[-1]
+            if name in info:
+                info[name] = prop.text
+        return info
 
 
 class Muc(caps.Muc, SleekXmppCapability):
@@ -204,6 +301,7 @@ class Muc(caps.Muc, SleekXmppCapability):
         :param payload: Payload data.
         :type payload: dict
         """
+        self.server.flush()
         self.client.plugin['xep_0045'].joinMUC(
             room=payload['room'],
             nick=payload['nick'],
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+    xmppflask.server.xmlstream
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Incremental XMPP stream parser and stanza objects used by
+    :mod:`xmppflask.server.native` engine.
+
+    :license: BSD
+"""
+
+from xml.etree import ElementTree as etree
+from xml.sax.saxutils import escape, quoteattr
+
+NS_CLIENT = 'jabber:client'
+NS_STREAM = 'http://etherx.jabber.org/streams'
+NS_TLS = 'urn:ietf:params:xml:ns:xmpp-tls'
+NS_SASL = 'urn:ietf:params:xml:ns:xmpp-sasl'
+NS_BIND = 'urn:ietf:params:xml:ns:xmpp-bind'
+NS_SESSION = 'urn:ietf:params:xml:ns:xmpp-session'
+NS_STANZAS = 'urn:ietf:params:xml:ns:xmpp-stanzas'
+NS_XML = 'http://www.w3.org/XML/1998/namespace'
+NS_DELAY = 'urn:xmpp:delay'
+NS_LEGACY_DELAY = 'jabber:x:delay'
+NS_VERSION = 'jabber:iq:version'
+NS_MUC = 'http://jabber.org/protocol/muc'
+
+
+def qname(ns, name):
+    """Returns ElementTree tag for element `name` in namespace `ns`."""
+    return '{%s}%s' % (ns, name)
+
+
+def split_qname(tag):
+    """Returns `(namespace, name)` pair for ElementTree tag."""
+    if tag[:1] == '{':
+        ns, name = tag[1:].split('}', 1)
+        return ns, name
+    return None, tag
+
+
+def tostring(element, parent_ns=NS_CLIENT):
+    """Serializes element to unicode string. Namespace is declared with
+    ``xmlns`` attribute only if it differs from `parent_ns`, so stanzas are
+    rendered as they should be within ``jabber:client`` stream."""
+    ns, name = split_qname(element.tag)
+    parts = [u'<', name]
+    if ns is not None and ns != parent_ns:
+        parts.append(u' xmlns=%s' % quoteattr(ns))
+    else:
+        ns = parent_ns
+    for key, value in sorted(element.items()):
+        attr_ns, attr = split_qname(key)
+        if attr_ns == NS_XML:
+            attr = 'xml:' + attr
+        parts.append(u' %s=%s' % (attr, quoteattr(value)))
+    if element.text is None and not len(element):
+        parts.append(u'/>')
+    else:
+        parts.append(u'>')
+        if element.text:
+            parts.append(escape(element.text))
+        for child in element:
+            parts.append(tostring(child, ns))
+            if child.tail:
+                parts.append(escape(child.tail))
+        parts.append(u'</%s>' % name)
+    return u''.join(parts)
+
+
+class XmlStream(object):
+    """Incremental XMPP stream parser. Data is fed by chunks as it comes
+    from the socket, every complete top level element (stanza, stream
+    features, SASL nonzas etc.) is passed to `on_element` as
+    :class:`~xml.etree.ElementTree.Element`.
+
+    :param on_start: Called with stream header attributes.
+    :param on_element: Called with every complete top level element.
+    :param on_end: Called when the stream is closed by the peer.
+    """
+
+    def __init__(self, on_start, on_element, on_end):
+        self.on_start = on_start
+        self.on_element = on_element
+        self.on_end = on_end
+        self.reset()
+
+    def reset(self):
+        """Prepares parser for the new stream, e.g. after STARTTLS or SASL
+        authentication."""
+        self._parser = etree.XMLParser(target=self)
+        self._builder = None
+        self._depth = 0
+
+    def feed(self, data):
+        self._parser.feed(data)
+
+    # ElementTree parser target interface
+
+    def start(self, tag, attrib):
+        self._depth += 1
+        if self._depth == 1:
+            self.on_start(attrib)
+            return
+        if self._depth == 2:
+            self._builder = etree.TreeBuilder()
+        self._builder.start(tag, attrib)
+
+    def end(self, tag):
+        self._depth -= 1
+        if not self._depth:
+            self.on_end()
+            return
+        element = self._builder.end(tag)
+        if self._depth == 1:
+            self._builder = None
+            self.on_element(element)
+
+    def data(self, data):
+        if self._builder is not None:
+            self._builder.data(data)
+
+    def close(self):
+        pass
+
+
+class Stanza(object):
+    """Thin wrapper over stanza :class:`~xml.etree.ElementTree.Element`."""
+
+    #: Stanza element name.
+    name = None
+
+    def __init__(self, element=None, **attrs):
+        if element is None:
+            element = etree.Element(qname(NS_CLIENT, self.name))
+        self.element = element
+        for key, value in attrs.items():
+            if value is not None:
+                element.set(key, unicode(value))
+
+    def __unicode__(self):
+        return tostring(self.element)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def get(self, key, default=None):
+        return self.element.get(key, default)
+
+    def set(self, key, value):
+        if value is None:
+            self.element.attrib.pop(key, None)
+        else:
+            self.element.set(key, unicode(value))
+
+    @property
+    def id(self):
+        return self.get('id')
+
+    @property
+    def from_jid(self):
+        return self.get('from')
+
+    @property
+    def to(self):
+        return self.get('to')
+
+    @property
+    def type(self):
+        return self.get('type')
+
+    def find(self, name, ns=NS_CLIENT):
+        """Returns first child element `name` from namespace `ns`."""
+        return self.element.find(qname(ns, name))
+
+    def child_text(self, name, ns=NS_CLIENT):
+        child = self.find(name, ns)
+        if child is not None:
+            return child.text
+
+    def add_child(self, name, ns=NS_CLIENT, text=None, **attrs):
+        child = etree.SubElement(self.element, qname(ns, name), attrs)
+        child.text = text
+        return child
+
+
+class Message(Stanza):
+    name = 'message'
+
+    @property
+    def body(self):
+        return self.child_text('body')
+
+
+class Presence(Stanza):
+    name = 'presence'
+
+    @property
+    def show(self):
+        return self.child_text('show')
+
+    @property
+    def status(self):
+        return self.child_text('status')
+
+    @property
+    def priority(self):
+        try:
+            return int(self.child_text('priority') or 0)
+        except ValueError:  # malformed by remote client
+            return 0
+
+
+class Iq(Stanza):
+    name = 'iq'
+
+    @property
+    def query(self):
+        """Returns payload element of the IQ, if any."""
+        for child in self.element:
+            if child.tag != qname(NS_CLIENT, 'error'):
+                return child
+
+    def make_result(self):
+        """Returns empty result IQ for this one."""
+        return Iq(type='result', id=self.id, to=self.from_jid)
+
+    def make_error(self, condition, type='cancel'):
+        """Returns error IQ for this one with specified stanza error
+        `condition`, e.g. ``service-unavailable``."""
+        iq = Iq(type='error', id=self.id, to=self.from_jid)
+        error = iq.add_child('error', type=type)
+        etree.SubElement(error, qname(NS_STANZAS, condition))
+        return iq
+
+
+STANZA_CLASSES = dict((qname(NS_CLIENT, cls.name), cls)
+                      for cls in (Message, Presence, Iq))
+
+
+def make_stanza(element):
+    """Wraps top level stream element into :class:`Stanza` or returns None
+    if it's not a stanza."""
+    cls = STANZA_CLASSES.get(element.tag)
+    if cls is not None:
+        return cls(element)
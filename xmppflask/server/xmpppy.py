@@ -13,7 +13,10 @@ import datetime
 import time
 import caps
 from . import XmppWsgiServer
+from .filters import DEFAULT_FILTERS
 from .helpers import maybe_unicode, gen_id
+from .iq import map_future
+from .lanes import LANE_PRESENCE
 from .. import JID
 
 import xmpp
@@ -27,6 +30,7 @@ class XmpppyWsgiServer(XmppWsgiServer):
     """XMPPWSGI server based on xmpppy library."""
 
     capability_class = XmpppyCapability
+    filter_classes = DEFAULT_FILTERS
 
     def __init__(self, *args, **kwargs):
         self.module = xmpp
@@ -35,6 +39,42 @@ class XmpppyWsgiServer(XmppWsgiServer):
         self.iq_class = xmpp.Iq
         super(XmpppyWsgiServer, self).__init__(*args, **kwargs)
 
+    def write_stanzas(self, stanzas):
+        if len(stanzas) == 1:
+            return self.xmpp.send(stanzas[0])
+        self.xmpp.send(u''.join(unicode(stanza) for stanza in stanzas))
+
+    def send_iq(self, iq, timeout=None):
+        """Sends IQ request after queued stanzas through the rate limiter,
+        timeout includes time it waits there.
+
+        :returns: :class:`~xmppflask.server.helpers.Future` of response
+                  :class:`xmpp.Iq` which fails with
+                  :exc:`~xmppflask.server.iq.IqError` or
+                  :exc:`~xmppflask.server.iq.IqTimeout`.
+        """
+        if not iq.getID():
+            iq.setID(gen_id())
+        future = self.track_iq(iq.getID(), self.stanza_recipient(iq), timeout)
+        self.queue_stanza(iq)
+        self.flush()
+        return future
+
+    def stanza_sender(self, stanza):
+        return stanza.getAttr('from')
+
+    def stanza_body(self, stanza):
+        return stanza.getTagData('body')
+
+    def stanza_type(self, stanza):
+        return stanza.getAttr('type')
+
+    def stanza_id(self, stanza):
+        return stanza.getAttr('id')
+
+    def stanza_recipient(self, stanza):
+        return stanza.getAttr('to')
+
     def connect(self, jid, pwd, use_tls=True, use_ssl=False):
         jid = JID(jid)
         user, server, password = jid.user, jid.domain, pwd
@@ -61,9 +101,17 @@ class XmpppyWsgiServer(XmppWsgiServer):
         self.xmpp.sendInitPresence()
 
     def serve_forever(self):
+        iq_table = self.iq_table
+
         def step_on(conn):
             try:
-                conn.Process(1)
+                timeout = 1
+                if iq_table is not None and len(iq_table) > 0:
+                    # wake up often enough to expire pending IQs in time
+                    timeout = iq_table.wheel.tick
+                conn.Process(timeout)
+                if iq_table is not None:
+                    iq_table.expire()
             except KeyboardInterrupt:
                 return False
             return True
@@ -80,6 +128,14 @@ class Standard(caps.Standard, XmpppyCapability):
                                     lambda c, s: self.handle_message(s))
         self.client.RegisterHandler('presence',
                                     lambda c, s: self.handle_presence(s))
+        for typ in ('result', 'error'):
+            self.client.RegisterHandler('iq', self.handle_iq_response,
+                                        typ=typ)
+
+    def handle_iq_response(self, conn, stanza):
+        """Completes pending IQ request."""
+        if self.server.resolve_iq(stanza):
+            raise xmpp.NodeProcessed
 
     def update_environ(self, environ, stanza):
         environ['xmpp.id'] = maybe_unicode(maybe_unicode(stanza.getID()))
@@ -87,11 +143,11 @@ class Standard(caps.Standard, XmpppyCapability):
         environ['xmpp.jid'] = JID(str(stanza.getFrom()))
         environ['xmpp.stanza_type'] = maybe_unicode(stanza.getType())
 
-        environ['xmpp.xml'] = unicode(stanza)
+        environ.lazy('xmpp.xml', unicode, stanza)
         if isinstance(stanza, self.server.message_class):
             environ['xmpp.body'] = maybe_unicode(stanza.getBody())
         elif isinstance(stanza, self.server.presence_class):
-            environ['xmpp.priority'] = stanza.getPriority()
+            environ.lazy('xmpp.priority', stanza.getPriority)
             environ['xmpp.body'] = maybe_unicode(stanza.getStatus())
             environ['xmpp.status'] = maybe_unicode(stanza.getShow())
 
@@ -118,7 +174,7 @@ class Standard(caps.Standard, XmpppyCapability):
         msg = self.server.message_class(to_jid, payload['body'])
         msg.setType(environ['xmpp.stanza_type'])
         msg.setID(gen_id())
-        self.client.send(msg)
+        self.server.queue_stanza(msg)
         return True
 
     def cmd_presence(self, environ, payload):
@@ -151,11 +207,35 @@ class Standard(caps.Standard, XmpppyCapability):
         else:
             presence = presence_cls(to=to_jid, status=payload.get('status', ''),
                                     show=payload['type'])
-        self.client.send(presence)
+        self.server.queue_stanza(presence, LANE_PRESENCE)
         return True
 
     def cmd_iq(self, environ, payload):
-        raise NotImplementedError
+        """Sends XMPP IQ request.
+
+        :param environ: XMPPWSGI environ.
+        :type environ: dict
+
+        :param payload: IQ payload data: `to` (sender by default), `type`
+                        (``get`` by default) and either `query` namespace
+                        of empty query element or `xml` payload element.
+        :type payload: dict
+
+        :returns: :class:`~xmppflask.server.helpers.Future` of response IQ
+        """
+        to_jid = payload.get('to', environ['xmpp.jid'])
+        if isinstance(to_jid, JID):
+            to_jid = to_jid.full
+
+        iq = self.server.iq_class(typ=payload.get('type', 'get'), to=to_jid)
+        if 'xml' in payload:
+            xml = payload['xml']
+            if isinstance(xml, basestring):
+                xml = xmpp.simplexml.XML2Node(xml)
+            iq.addChild(node=xml)
+        elif 'query' in payload:
+            iq.setQueryNS(payload['query'])
+        return self.server.send_iq(iq, payload.get('timeout'))
 
 
 class Delay(caps.Delay, XmpppyCapability):
@@ -163,11 +243,15 @@ class Delay(caps.Delay, XmpppyCapability):
     def update_environ(self, environ, stanza):
         delay = stanza.getTimestamp()
         if delay:
-            delay = time.mktime(
-                datetime.datetime.strptime(delay,
-                                           '%Y%m%dT%H:%M:%S').utctimetuple()
-            )
-            environ['xmpp.delay'] = environ['xmpp.timestamp'] - delay
+            environ.lazy('xmpp.delay', self.parse_delay,
+                         environ['xmpp.timestamp'], delay)
+
+    def parse_delay(self, timestamp, delay):
+        delay = time.mktime(
+            datetime.datetime.strptime(delay,
+                                       '%Y%m%dT%H:%M:%S').utctimetuple()
+        )
+        return timestamp - delay
 
 
 class Version(caps.Version, XmpppyCapability):
@@ -184,31 +268,26 @@ class Version(caps.Version, XmpppyCapability):
         :param payload: Payload data.
         :type payload: dict
 
-        :returns: Software version info dict with keys: `os`, `name`, `version`
-        :rtype: dict
+        :returns: :class:`~xmppflask.server.helpers.Future` of software
+                  version info dict with keys: `os`, `name`, `version` or
+                  None if remote user didn't tell it
         """
         jid = payload.get('jid', environ['xmpp.jid'])
         if isinstance(jid, JID):
             jid = jid.full
 
-        iq = self.server.iq_class('get')
-        iq.setID(gen_id())
-        iq.addChild('query', {}, [], 'jabber:iq:version')
-        iq.setTo(jid)
-        res = self.client.SendAndWaitForResponse(iq, timeout=5)
-
-        if res is None:
-            return
-        if res.getType() != 'result':
-            return
+        iq = self.server.iq_class('get', to=jid)
+        iq.setQueryNS(xmpp.NS_VERSION)
+        return map_future(self.server.send_iq(iq), self.version_info)
 
+    def version_info(self, response):
         info = {
             'os': None,
             'name': None,
             'version': None
         }
 
-        for prop in res.getQueryChildren():
+        for prop in response.getQueryChildren() or ():
             name = prop.getName()
             if name in info:
                 info[name] = prop.getData()
@@ -234,4 +313,4 @@ class Muc(caps.Muc, XmpppyCapability):
         body.addChild('history', {'maxchars': '0'})
         if payload.get('password'):
             body.setTagData('password', payload['password'])
-        self.client.send(presence)
+        self.server.queue_stanza(presence, LANE_PRESENCE)
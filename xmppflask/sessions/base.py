@@ -9,6 +9,7 @@
     :license: BSD
 """
 
+from contextlib import contextmanager
 from ..thirdparty.werkzeug import ModificationTrackingDict
 
 
@@ -51,6 +52,13 @@ class Session(ModificationTrackingDict, SessionMixin):
     #: reflects the ``'_jid'`` key that points whom this session belongs to.
     jid = property(_get_jid, _set_jid)
 
+    @property
+    def should_save(self):
+        """True if the session should be saved. Changes of mutable values
+        inside the session are not tracked, set :attr:`modified` to `True`
+        for them."""
+        return self.modified
+
 
 class NullSession(Session):
     """Dummy NullSession that does nothing."""
@@ -70,6 +78,11 @@ class SessionInterface(object):
 
     null_session_class = NullSession
 
+    #: Number of sessions written by :meth:`save_session`.
+    saved = 0
+    #: Number of unchanged sessions which writes were skipped.
+    skipped = 0
+
     _storage = None
 
     def make_null_session(self, app):
@@ -111,9 +124,44 @@ class SessionInterface(object):
         at the end of the request.  This is still called during a request
         context so if you absolutely need access to the request you can do
         that.
+
+        Counts the write in :meth:`stats`, so implementations should call
+        it first.
         """
+        self.saved += 1
         return None
 
+    def should_save_session(self, app, session):
+        """Checks if the session was changed during the request and has to
+        be saved. Otherwise :meth:`refresh_session` is called instead of
+        :meth:`save_session`."""
+        return getattr(session, 'should_save', True)
+
+    def refresh_session(self, app, session, response):
+        """This is called for unchanged sessions at the end of the request,
+        e.g. to prolong their lifetime. Only counts the skipped write in
+        :meth:`stats` by default, so implementations should call it
+        first."""
+        self.skipped += 1
+        return None
+
+    @contextmanager
+    def batch(self, app, jids):
+        """Context manager for handling of stanzas which arrived together.
+        Backends may load sessions of `jids` at once and write sessions
+        saved within the batch at once. Does nothing by default."""
+        yield
+
+    def stats(self):
+        """Returns dict of metrics: number of `saved` sessions, `skipped`
+        writes of unchanged ones and `skip_ratio` of them."""
+        total = self.saved + self.skipped
+        return {
+            'saved': self.saved,
+            'skipped': self.skipped,
+            'skip_ratio': float(self.skipped) / total if total else 0.0,
+        }
+
     @property
     def storage(self):
         """Session storage proxy."""
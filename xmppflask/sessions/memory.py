@@ -9,7 +9,9 @@
     :license: BSD
 """
 
+import heapq
 import time
+from collections import Mapping, OrderedDict
 from threading import Lock
 from . import Session, SessionInterface
 
@@ -20,11 +22,6 @@ class MemorySession(Session):
 
     _timestamp = None
 
-    @property
-    def should_save(self):
-        """True if the session should be saved."""
-        return self.modified
-
     @property
     def timestamp(self):
         """Last session update timestamp."""
@@ -36,28 +33,194 @@ class MemorySession(Session):
         return super(Session, self).on_update()
 
 
+class MemorySessionShard(object):
+    """Part of in-memory sessions with its own lock, expiration index and
+    LRU order. Used by :class:`MemorySessionInterface`.
+
+    :param max_sessions: Maximum number of sessions in the shard.
+    """
+
+    def __init__(self, max_sessions=None):
+        self.max_sessions = max_sessions
+        #: Number of sessions evicted to stay within :attr:`max_sessions`.
+        self.evictions = 0
+        #: Sessions by jid.
+        self.sessions = {}
+        self.lock = Lock()
+        #: Heap of `(expiration time, jid)` pairs, some could be outdated.
+        self.expiry = []
+        #: Actual expiration time of indexed sessions by jid.
+        self.deadlines = {}
+        #: Jids of non permanent sessions, least recently used first.
+        self.lru = OrderedDict()
+
+    def open(self, interface, app, jid):
+        """Returns stored session of `jid` if it's not expired."""
+        with self.lock:
+            session = self.sessions.get(jid)
+            if session is None:
+                return None
+            if interface.is_session_expired(app, session):
+                self.drop(jid)
+                return None
+            if jid in self.lru:
+                self.lru[jid] = self.lru.pop(jid)
+            return session
+
+    def save(self, interface, app, session):
+        jid = session.jid
+        with self.lock:
+            self.sessions[jid] = session
+            self.index(app, jid, session)
+            self.lru.pop(jid, None)
+            if not session.permanent:
+                self.lru[jid] = None
+            if self.max_sessions is not None:
+                while len(self.sessions) > self.max_sessions and self.lru:
+                    self.drop(self.lru.popitem(last=False)[0])
+                    self.evictions += 1
+
+    def cleanup(self, interface, app):
+        """Drops expired sessions."""
+        # quick check without the lock: heap could be changed or replaced
+        # meanwhile, the worst outcome is a cleanup done at the next call
+        expiry = self.expiry
+        try:
+            if expiry[0][0] >= time.time():
+                return
+        except IndexError:
+            return
+        with self.lock:
+            now = time.time()
+            while self.expiry and self.expiry[0][0] < now:
+                deadline, jid = heapq.heappop(self.expiry)
+                if self.deadlines.get(jid) != deadline:
+                    continue  # session was saved again since then
+                del self.deadlines[jid]
+                session = self.sessions.get(jid)
+                if session is None:
+                    continue
+                if interface.is_session_expired(app, session):
+                    self.drop(jid)
+                else:
+                    # updated, but not saved yet
+                    self.index(app, jid, session)
+
+    def drop(self, jid):
+        self.sessions.pop(jid, None)
+        self.deadlines.pop(jid, None)
+        self.lru.pop(jid, None)
+
+    def index(self, app, jid, session):
+        if session.permanent or session.timestamp is None:
+            self.deadlines.pop(jid, None)
+            return
+        deadline = session.timestamp + app.session_ttl
+        if self.deadlines.get(jid) == deadline:
+            return
+        self.deadlines[jid] = deadline
+        heapq.heappush(self.expiry, (deadline, jid))
+        if len(self.expiry) > 2 * len(self.deadlines) + 64:
+            # drop outdated entries of often saved sessions
+            self.expiry = [(deadline, jid) for jid, deadline
+                           in self.deadlines.iteritems()]
+            heapq.heapify(self.expiry)
+
+
+class ShardedStorage(Mapping):
+    """Read-only mapping of sessions by jid over all shards."""
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    def shard(self, jid):
+        return self.shards[hash(jid) % len(self.shards)]
+
+    def __getitem__(self, jid):
+        return self.shard(jid).sessions[jid]
+
+    def __contains__(self, jid):
+        return jid in self.shard(jid).sessions
+
+    def __iter__(self):
+        for shard in self.shards:
+            for jid in shard.sessions.keys():
+                yield jid
+
+    def __len__(self):
+        return sum(len(shard.sessions) for shard in self.shards)
+
+
 class MemorySessionInterface(SessionInterface):
-    """The session interface that keeps all sessions in memory."""
+    """The session interface that keeps all sessions in memory.
+
+    Sessions are split into shards by jid hash, each with its own lock, so
+    concurrent workers rarely wait for each other. Non permanent sessions
+    are indexed by their expiration time, so cleanup on every request looks
+    only at sessions which are actually expired.
+
+    :param max_sessions: Maximum number of stored sessions. When it's
+                         exceeded, least recently used non permanent
+                         sessions are evicted. The limit is split between
+                         shards, so eviction order is approximate and a
+                         shard may evict sessions before the total number
+                         of them reaches the limit. Permanent sessions are
+                         never evicted and may exceed it. Unlimited by
+                         default.
+    :type max_sessions: int
+
+    :param shards: Number of shards. Default: 16.
+    :type shards: int
+    """
 
     session_class = MemorySession
-
-    def __init__(self, *args, **kwargs):
-        self._storage = {}
-        self._lock = Lock()
+    shard_class = MemorySessionShard
+
+    def __init__(self, max_sessions=None, shards=16, *args, **kwargs):
+        self.max_sessions = max_sessions
+        if max_sessions is not None:
+            shards = max(1, min(shards, max_sessions))
+            # shard limits sum up to max_sessions exactly
+            quota, rest = divmod(max_sessions, shards)
+            limits = [quota + (idx < rest) for idx in xrange(shards)]
+        else:
+            limits = [None] * shards
+        self.shards = [self.shard_class(limit) for limit in limits]
+        self._storage = ShardedStorage(self.shards)
+        self._cleanup_turn = 0
         super(MemorySessionInterface, self).__init__(*args, **kwargs)
 
+    @property
+    def evictions(self):
+        """Number of sessions evicted to stay within :attr:`max_sessions`."""
+        return sum(shard.evictions for shard in self.shards)
+
+    def stats(self):
+        """Returns dict of metrics: number of `resident` sessions and of
+        `evictions` besides common ones."""
+        stats = super(MemorySessionInterface, self).stats()
+        stats.update(resident=len(self.storage), evictions=self.evictions)
+        return stats
+
     def open_session(self, app, request):
-        self.cleanup(app)
         jid = request.environ['xmpp.jid']
-        session = self.storage.get(jid)
+        shard = self.storage.shard(jid)
+        self._cleanup_step(app, shard)
+        session = shard.open(self, app, jid)
         if session is None:
             session = self.session_class()
             session.jid = jid
+            session.modified = False  # nothing to keep yet
         return session
 
     def save_session(self, app, session, response):
-        self.storage[session.jid] = session
-        self.cleanup(app)
+        super(MemorySessionInterface, self).save_session(app, session,
+                                                         response)
+        shard = self.storage.shard(session.jid)
+        shard.save(self, app, session)
+        # the same object is opened next time, track changes from now on
+        session.modified = False
+        self._cleanup_step(app, shard)
 
     def is_session_expired(self, app, session):
         if session.permanent:
@@ -67,7 +230,13 @@ class MemorySessionInterface(SessionInterface):
         return session.timestamp + app.session_ttl < time.time()
 
     def cleanup(self, app):
-        with self._lock:
-            for key, session in self.storage.items():
-                if self.is_session_expired(app, session):
-                    del self.storage[key]
+        for shard in self.shards:
+            shard.cleanup(self, app)
+
+    def _cleanup_step(self, app, shard):
+        """Cleans up `shard` of the current request and the next one of the
+        others in turn, so every shard is looked at within a few requests
+        while a request doesn't pay for all of them."""
+        shard.cleanup(self, app)
+        self._cleanup_turn = (self._cleanup_turn + 1) % len(self.shards)
+        self.shards[self._cleanup_turn].cleanup(self, app)
@@ -11,12 +11,29 @@
 
 redis = __import__('redis')
 import json
+import threading
+from contextlib import contextmanager
 from . import Session, SessionInterface
+from ..jid import JID
+
+#: Marks session which is being prefetched.
+_LOADING = object()
 
 
 class RedisSessionInterface(SessionInterface):
     """Session interface that uses Redis as session storage.
 
+    Connections are taken from a pool, so the interface could be shared by
+    worker threads. Within :meth:`batch` sessions of all senders are loaded
+    by a single ``MGET`` and saved sessions are written by a single
+    pipeline at the end; outside of it writes are pipelined per request.
+    Sessions waiting to be written are served from memory, so the next
+    request of the same sender always sees them.
+
+    Servers run batches around handing stanzas over to the dispatcher, so
+    with ``XMPPWSGI_WORKERS`` views run after the batch is over: sessions
+    are still prefetched, but they are written per request.
+
     :param host: Redis server host. Default: 'localhost'.
     :type host: str
 
@@ -26,37 +43,164 @@ class RedisSessionInterface(SessionInterface):
     :param namespace: Key namespace. Should contains placeholder for JID value.
                       Example: ``myapp:%s``
     :type namespace: str
+
+    :param max_connections: Connection pool size, threads wait for a free
+                            connection when it's exhausted. Default: 10.
+    :type max_connections: int
+
+    :param socket_timeout: Seconds to wait for Redis response.
+    :type socket_timeout: float
+
+    :param socket_connect_timeout: Seconds to wait for connection.
+    :type socket_connect_timeout: float
+
+    :param client: Ready Redis client to use instead, e.g. in-process fake.
     """
     session_class = Session
+    connection_pool_class = redis.BlockingConnectionPool
 
     #: Default redis key namespace. Should contains placeholder for jid mixin.
     #: Note, that key collisions are possible if you'll launch two or more
     #  XmppFlask apps against single Redis server with same namespace value.
     namespace = 'xmppflask:sessions:%s'
 
-    def __init__(self, host='localhost', port=6379, namespace=None):
+    def __init__(self, host='localhost', port=6379, namespace=None,
+                 max_connections=10, socket_timeout=None,
+                 socket_connect_timeout=None, client=None):
         self.namespace = namespace or self.namespace
-        self._storage = redis.Redis(host, port)
+        if client is None:
+            options = {}
+            if socket_connect_timeout is not None:
+                options['socket_connect_timeout'] = socket_connect_timeout
+            pool = self.connection_pool_class(
+                host=host, port=port, max_connections=max_connections,
+                socket_timeout=socket_timeout, **options)
+            client = redis.Redis(connection_pool=pool)
+        self._storage = client
+        #: Number of round trips to Redis.
+        self.round_trips = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        #: Commands to write by key: `(value, ttl)` to set, `(None, ttl)`
+        #: to refresh TTL only.
+        self._writes = {}
+        #: Serialized sessions loaded by :meth:`batch`.
+        self._prefetched = {}
+
+    def session_key(self, jid):
+        """Returns storage key of `jid` session, the same one for JID
+        objects and strings."""
+        return self.namespace % JID(jid).full
 
     def open_session(self, app, request):
         jid = request.environ['xmpp.jid']
-        key = self.namespace % jid
-        session = self.storage.get(key)
+        key = self.session_key(jid)
+        with self._lock:
+            write = self._writes.get(key)
+            session = self._prefetched.pop(key, _LOADING)
+        if write is not None and write[0] is not None:
+            session = write[0]
+        elif session is _LOADING:
+            self.round_trips += 1
+            session = self.storage.get(key)
         if session is None:
-            return self.session_class(_jid=jid)
+            return self.new_session(jid)
         try:
             return self.session_class(**json.loads(session))
         except ValueError: # in case of invalid serialized session
             app.logger.error('Malformed session loaded: %r' % session)
-            return self.session_class(_jid=jid)
+            return self.new_session(jid)
+
+    def new_session(self, jid):
+        session = self.session_class(_jid=jid)
+        session.new = True
+        return session
 
     def save_session(self, app, session, response):
-        key = self.namespace % session.jid
-        if session.permanent:
-            self.storage[key] = json.dumps(session)
-        else:
-            self.storage.setex(key, json.dumps(session), app.session_ttl)
+        super(RedisSessionInterface, self).save_session(app, session,
+                                                        response)
+        key = self.session_key(session.jid)
+        ttl = None if session.permanent else app.session_ttl
+        with self._lock:
+            self._writes[key] = (json.dumps(session, default=unicode), ttl)
+            self._prefetched.pop(key, None)
+        if not getattr(self._local, 'batches', 0):
+            self.flush()
+
+    def refresh_session(self, app, session, response):
+        """Prolongs lifetime of unchanged stored session without writing
+        it."""
+        super(RedisSessionInterface, self).refresh_session(app, session,
+                                                           response)
+        if session.new or session.permanent:
+            return
+        key = self.session_key(session.jid)
+        with self._lock:
+            if key not in self._writes:
+                self._writes[key] = (None, app.session_ttl)
+        if not getattr(self._local, 'batches', 0):
+            self.flush()
+
+    @contextmanager
+    def batch(self, app, jids):
+        keys = list(set(self.session_key(jid) for jid in jids))
+        self.prefetch(keys)
+        self._local.batches = getattr(self._local, 'batches', 0) + 1
+        try:
+            yield
+        finally:
+            self._local.batches -= 1
+            if not self._local.batches:
+                self.flush()
+
+    def prefetch(self, keys):
+        """Loads sessions by `keys` with a single ``MGET``."""
+        with self._lock:
+            # writes stay in `_writes` until they are done, MGET sent while
+            # they are in flight could be served before them, so their keys
+            # are opened from memory or loaded once the write is over
+            keys = [key for key in keys if key not in self._writes]
+            # sessions prefetched before and not opened yet are forgotten,
+            # so the cache doesn't grow with stanzas which were filtered out
+            self._prefetched = dict.fromkeys(keys, _LOADING)
+        if not keys:
+            return
+        self.round_trips += 1
+        values = self.storage.mget(keys)
+        with self._lock:
+            prefetched = self._prefetched
+            for key, value in zip(keys, values):
+                # skip sessions saved since MGET was sent
+                if prefetched.get(key) is _LOADING:
+                    prefetched[key] = value
+
+    def flush(self):
+        """Writes saved and refreshed sessions with a single pipeline."""
+        with self._lock:
+            if not self._writes:
+                return
+            writes = self._writes.items()
+        pipe = self.storage.pipeline(transaction=False)
+        for key, (value, ttl) in writes:
+            if value is None:
+                pipe.expire(key, ttl)
+            else:
+                pipe.set(key, value, ex=ttl)
+        self.round_trips += 1
+        pipe.execute()
+        with self._lock:
+            for key, write in writes:
+                # keep ones which were saved again meanwhile
+                if self._writes.get(key) is write:
+                    del self._writes[key]
+
+    def stats(self):
+        """Returns dict of metrics: number of `round_trips` to Redis besides
+        common ones."""
+        stats = super(RedisSessionInterface, self).stats()
+        stats['round_trips'] = self.round_trips
+        return stats
 
     def is_session_expired(self, app, session):
-        key = self.namespace % session.jid
+        key = self.session_key(session.jid)
         return self.storage.ttl(key) != -1
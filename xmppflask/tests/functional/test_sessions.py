@@ -9,7 +9,9 @@
     :license: BSD
 """
 
-from xmppflask.tests.helpers import unittest
+import threading
+import mock
+from xmppflask.tests.helpers import unittest, FakeRedis
 import xmppflask
 
 
@@ -21,6 +23,10 @@ class MemorySessionTestCase(unittest.TestCase):
         self.app = xmppflask.XmppFlask(__name__)
         self.app.session_interface = MemorySessionInterface()
 
+    def indexed(self, interface):
+        return sorted(jid for shard in interface.shards
+                      for jid in shard.deadlines)
+
     def test_session_basic(self):
         """Basic test about Session initialization."""
         environ = {'xmpp.body': 'ping', 'xmpp.jid': 'k.bx@ya.ru'}
@@ -93,3 +99,223 @@ class MemorySessionTestCase(unittest.TestCase):
 
         # session was expired and all his data should be erased
         self.assertEquals(session['times_pinged'], 1)
+
+    def test_cleanup_expired_sessions_only(self):
+        from xmppflask.sessions import MemorySessionInterface
+        interface = MemorySessionInterface(shards=1)
+        self.app.session_interface = interface
+
+        @self.app.route(u'ping')
+        def ping():
+            from xmppflask.globals import session
+            session['pinged'] = True
+            if session.jid == 'admin@ya.ru':
+                session.permanent = True
+            return u'pong'
+
+        with mock.patch('time.time', return_value=1000):
+            for jid in ('k.bx@ya.ru', 'kxepal@ya.ru', 'admin@ya.ru'):
+                self.app({'xmpp.body': 'ping', 'xmpp.jid': jid})
+        with mock.patch('time.time', return_value=2000):
+            self.app({'xmpp.body': 'ping', 'xmpp.jid': 'kxepal@ya.ru'})
+        self.assertEqual(self.indexed(interface),
+                         ['k.bx@ya.ru', 'kxepal@ya.ru'])
+
+        with mock.patch('time.time', return_value=1000 + self.app.session_ttl
+                                                  + 1):
+            self.app({'xmpp.body': 'ping', 'xmpp.jid': 'other@ya.ru'})
+        self.assertEqual(sorted(interface.storage),
+                         ['admin@ya.ru', 'kxepal@ya.ru', 'other@ya.ru'])
+        self.assertEqual(self.indexed(interface),
+                         ['kxepal@ya.ru', 'other@ya.ru'])
+
+    def test_cleanup_while_heap_is_emptied(self):
+        from xmppflask.sessions.memory import MemorySessionShard
+
+        class Emptied(list):
+            # another thread popped the last entry right after the check
+            def __len__(self):
+                return 1
+
+        shard = MemorySessionShard()
+        shard.expiry = Emptied()
+        shard.cleanup(self.app.session_interface, self.app)
+
+    def test_evict_least_recently_used_sessions(self):
+        from xmppflask.sessions import MemorySessionInterface
+        interface = MemorySessionInterface(max_sessions=3, shards=1)
+        self.app.session_interface = interface
+
+        @self.app.route(u'ping')
+        def ping():
+            from xmppflask.globals import session
+            session['pinged'] = True
+            if session.jid == 'admin@ya.ru':
+                session.permanent = True
+            return u'pong'
+
+        for jid in ('admin@ya.ru', 'k.bx@ya.ru', 'kxepal@ya.ru',
+                    'k.bx@ya.ru', 'other@ya.ru'):
+            self.app({'xmpp.body': 'ping', 'xmpp.jid': jid})
+        self.assertEqual(sorted(interface.storage),
+                         ['admin@ya.ru', 'k.bx@ya.ru', 'other@ya.ru'])
+        stats = interface.stats()
+        self.assertEqual(stats['resident'], 3)
+        self.assertEqual(stats['evictions'], 1)
+
+    def test_max_sessions_is_total_limit(self):
+        from xmppflask.sessions import MemorySessionInterface
+        interface = MemorySessionInterface(max_sessions=100, shards=16)
+        self.app.session_interface = interface
+
+        @self.app.route(u'ping')
+        def ping():
+            from xmppflask.globals import session
+            session['pinged'] = True
+            return u'pong'
+
+        for idx in range(1000):
+            self.app({'xmpp.body': 'ping', 'xmpp.jid': 'user%d@ya.ru' % idx})
+        stats = interface.stats()
+        self.assertTrue(0 < stats['resident'] <= 100)
+        self.assertEqual(stats['resident'] + stats['evictions'], 1000)
+
+    def test_concurrent_sessions_of_many_jids(self):
+        interface = self.app.session_interface
+
+        @self.app.route(u'ping')
+        def ping():
+            from xmppflask.globals import session
+            session['pinged'] = session.get('pinged', 0) + 1
+            return u'pong'
+
+        def worker(idx):
+            for num in range(50):
+                jid = 'user%d-%d@ya.ru' % (idx, num)
+                self.app({'xmpp.body': 'ping', 'xmpp.jid': jid})
+                self.app({'xmpp.body': 'ping', 'xmpp.jid': jid})
+
+        workers = [threading.Thread(target=worker, args=(idx,))
+                   for idx in range(8)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(len(interface.storage), 400)
+        self.assertEqual(interface.storage['user3-7@ya.ru']['pinged'], 2)
+        self.assertTrue(all(shard.sessions for shard in interface.shards))
+
+    def test_skip_saving_unchanged_sessions(self):
+        interface = self.app.session_interface
+
+        @self.app.route(u'set <value>')
+        def set_value(value):
+            from xmppflask.globals import session
+            session['value'] = value
+            return u'ok'
+
+        @self.app.route(u'get')
+        def get_value():
+            from xmppflask.globals import session
+            return session.get('value', u'none')
+
+        with mock.patch.object(interface, 'save_session',
+                               wraps=interface.save_session) as save:
+            self.assertEqual(list(self.app({'xmpp.body': 'get',
+                                            'xmpp.jid': 'k.bx@ya.ru'})),
+                             [u'none'])
+            self.app({'xmpp.body': 'set 42', 'xmpp.jid': 'k.bx@ya.ru'})
+            self.assertEqual(list(self.app({'xmpp.body': 'get',
+                                            'xmpp.jid': 'k.bx@ya.ru'})),
+                             [u'42'])
+            self.app({'xmpp.body': 'get', 'xmpp.jid': 'k.bx@ya.ru'})
+        self.assertEqual(save.call_count, 1)
+        self.assertEqual(interface.storage.keys(), ['k.bx@ya.ru'])
+        stats = interface.stats()
+        self.assertEqual((stats['saved'], stats['skipped']), (1, 3))
+        self.assertEqual(stats['skip_ratio'], 0.75)
+
+    def test_interface_counts_saves(self):
+        interface = self.app.session_interface
+        session = interface.session_class()
+        session.jid = 'k.bx@ya.ru'
+        interface.save_session(self.app, session, None)
+        interface.refresh_session(self.app, session, None)
+        stats = interface.stats()
+        self.assertEqual((stats['saved'], stats['skipped']), (1, 1))
+
+
+class RedisSessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from xmppflask.sessions import RedisSessionInterface
+
+        self.redis = FakeRedis()
+        self.app = xmppflask.XmppFlask(__name__)
+        self.app.session_interface = RedisSessionInterface(client=self.redis)
+
+        @self.app.route(u'count')
+        def count():
+            from xmppflask.globals import session
+            session['count'] = session.get('count', 0) + 1
+            return unicode(session['count'])
+
+        @self.app.route(u'get')
+        def get():
+            from xmppflask.globals import session
+            return unicode(session.get('count'))
+
+    def request(self, body, jid='k.bx@ya.ru'):
+        return list(self.app({'xmpp.body': body, 'xmpp.jid': jid}))[0]
+
+    def test_save_and_refresh(self):
+        self.assertEqual(self.request('get'), u'None')
+        self.assertEqual(self.redis.data, {})  # untouched new session
+        self.assertEqual(self.request('count'), u'1')
+        self.assertEqual(self.request('count'), u'2')
+        key = 'xmppflask:sessions:k.bx@ya.ru'
+        self.assertEqual(self.redis.ttl(key), self.app.session_ttl)
+        self.redis.expire(key, 10)
+        self.assertEqual(self.request('get'), u'2')
+        self.assertEqual(self.redis.ttl(key), self.app.session_ttl)
+        stats = self.app.session_interface.stats()
+        self.assertEqual((stats['saved'], stats['skipped']), (2, 2))
+
+    def test_batch(self):
+        interface = self.app.session_interface
+        jids = ['user%d@ya.ru' % idx for idx in range(10)]
+        for jid in jids:
+            self.request('count', jid)
+        self.redis.round_trips = 0
+        with interface.batch(self.app, jids):
+            for jid in jids:
+                self.assertEqual(self.request('count', jid), u'2')
+            # saved, but not written yet, session is served from memory
+            self.assertEqual(self.request('count', jids[0]), u'3')
+            self.assertEqual(self.redis.round_trips, 1)
+        self.assertEqual(self.redis.round_trips, 2)
+        self.assertEqual(interface.flush(), None)
+        self.assertEqual(self.redis.round_trips, 2)
+        self.assertEqual(self.request('get', jids[0]), u'3')
+        self.assertEqual(self.request('get', jids[1]), u'2')
+
+    def test_prefetch_while_write_in_flight(self):
+        interface = self.app.session_interface
+        self.request('count')
+        pipeline = self.redis.pipeline
+
+        def racing_pipeline(transaction=True):
+            pipe = pipeline(transaction)
+            execute = pipe.execute
+
+            def racing_execute():
+                # MGET of another thread is served before the write
+                self.redis.pipeline = pipeline
+                interface.prefetch(['xmppflask:sessions:k.bx@ya.ru'])
+                return execute()
+            pipe.execute = racing_execute
+            return pipe
+        self.redis.pipeline = racing_pipeline
+
+        self.assertEqual(self.request('count'), u'2')
+        self.assertEqual(self.request('get'), u'2')
@@ -2,6 +2,7 @@
 
 import logging
 import sys
+import time
 
 if sys.version_info >= (2, 7):
     unittest = __import__('unittest')
@@ -9,3 +10,83 @@ else:
     unittest = __import__('unittest2')
 
 logging.disable(logging.CRITICAL)
+
+
+class FakeRedis(object):
+    """In-process stand-in for :class:`redis.Redis` with commands used by
+    sessions. Every command or pipeline execution counts as a round trip.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.data = {}
+        self.expires = {}
+        self.round_trips = 0
+
+    def _alive(self, key):
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= self.clock():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def _set(self, key, value, ex=None):
+        self.data[key] = value
+        if ex is None:
+            self.expires.pop(key, None)
+        else:
+            self.expires[key] = self.clock() + ex
+        return True
+
+    def _expire(self, key, seconds):
+        if not self._alive(key):
+            return False
+        self.expires[key] = self.clock() + seconds
+        return True
+
+    def get(self, key):
+        self.round_trips += 1
+        return self.data[key] if self._alive(key) else None
+
+    def mget(self, keys):
+        self.round_trips += 1
+        return [self.data[key] if self._alive(key) else None for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.round_trips += 1
+        return self._set(key, value, ex)
+
+    def expire(self, key, seconds):
+        self.round_trips += 1
+        return self._expire(key, seconds)
+
+    def ttl(self, key):
+        self.round_trips += 1
+        if not self._alive(key):
+            return -2
+        if key not in self.expires:
+            return -1
+        return int(round(self.expires[key] - self.clock()))
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def set(self, key, value, ex=None):
+        self.commands.append((self.client._set, (key, value, ex)))
+        return self
+
+    def expire(self, key, seconds):
+        self.commands.append((self.client._expire, (key, seconds)))
+        return self
+
+    def execute(self):
+        self.client.round_trips += 1
+        commands, self.commands = self.commands, []
+        return [func(*args) for func, args in commands]
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+    XMPP library based servers
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Smoke tests of servers for xmpppy and SleekXMPP, which are run without
+    connection: stanzas are captured instead of being written.
+
+    :license: BSD
+"""
+
+import mock
+from xmppflask.tests.helpers import unittest
+from xmppflask import XmppFlask
+from xmppflask.server.iq import IqError
+
+try:
+    import xmpp
+except ImportError:
+    xmpp = None
+
+try:
+    import sleekxmpp
+except ImportError:
+    sleekxmpp = None
+
+NS_VERSION = 'jabber:iq:version'
+
+
+class ImportTestCase(unittest.TestCase):
+
+    def test_native(self):
+        from xmppflask.server.native import NativeXmppWsgiServer
+
+    def test_loopback(self):
+        from xmppflask.server.loopback import LoopbackWsgiServer
+
+    @unittest.skipIf(xmpp is None, 'xmpppy is not installed')
+    def test_xmpppy(self):
+        from xmppflask.server.xmpppy import XmpppyWsgiServer
+
+    @unittest.skipIf(sleekxmpp is None, 'SleekXMPP is not installed')
+    def test_sleekxmpp(self):
+        from xmppflask.server.sleekxmpp import SleekXmppWsgiServer
+
+
+class EngineTestCase(unittest.TestCase):
+
+    environ = {'xmpp.jid': 'k.bx@ya.ru/home', 'xmpp.stanza_type': 'chat'}
+
+    def setUp(self):
+        self.app = XmppFlask('xmppflask.test')
+
+
+@unittest.skipIf(xmpp is None, 'xmpppy is not installed')
+class XmpppyServerTestCase(EngineTestCase):
+
+    def setUp(self):
+        super(XmpppyServerTestCase, self).setUp()
+        from xmppflask.server import xmpppy
+        self.server = xmpppy.XmpppyWsgiServer(self.app)
+        self.server.xmpp = mock.Mock()
+        self.server.register_capability(xmpppy.Standard)
+        self.server.register_capability(xmpppy.Version)
+
+    def sent(self):
+        return self.server.xmpp.send.call_args[0][0]
+
+    def test_cmd_iq(self):
+        future = self.server.commands['iq'](self.environ,
+                                            {'query': 'urn:xmpp:ping'})
+        request = self.sent()
+        self.assertEqual(request.getQueryNS(), 'urn:xmpp:ping')
+        self.assertEqual(request.getAttr('to'), 'k.bx@ya.ru/home')
+        self.assertFalse(future.done())
+        error = xmpp.Iq('error', attrs={'id': request.getID(),
+                                        'from': 'k.bx@ya.ru/home'})
+        self.assertTrue(self.server.resolve_iq(error))
+        self.assertTrue(isinstance(future.exception(), IqError))
+
+    def test_serve_forever_waits_less_for_pending_iq(self):
+        timeouts = []
+
+        def process(timeout):
+            timeouts.append(timeout)
+            raise KeyboardInterrupt
+        self.server.xmpp.Process.side_effect = process
+        self.server.serve_forever()
+        self.server.commands['iq'](self.environ, {'query': 'urn:xmpp:ping'})
+        self.server.serve_forever()
+        self.assertEqual(timeouts, [1, self.server.iq_table.wheel.tick])
+
+    def test_cmd_version(self):
+        future = self.server.commands['version'](self.environ, {})
+        request = self.sent()
+        response = xmpp.Iq('result', NS_VERSION,
+                           attrs={'id': request.getID(),
+                                  'from': 'k.bx@ya.ru/home'})
+        response.getTag('query').setTagData('name', 'Psi')
+        response.getTag('query').setTagData('version', '1.0')
+        self.assertTrue(self.server.resolve_iq(response))
+        self.assertEqual(future.result(),
+                         {'name': 'Psi', 'version': '1.0', 'os': None})
+
+
+@unittest.skipIf(sleekxmpp is None, 'SleekXMPP is not installed')
+class SleekXmppServerTestCase(EngineTestCase):
+
+    def setUp(self):
+        super(SleekXmppServerTestCase, self).setUp()
+        from xmppflask.server import sleekxmpp as engine
+        self.server = engine.SleekXmppWsgiServer(self.app)
+        self.server.xmpp = sleekxmpp.ClientXMPP('bot@localhost', 'secret')
+        self.server.register_capability(engine.Standard)
+        self.server.register_capability(engine.Version)
+        self.written = []
+        self.server.write_stanzas = self.written.extend
+
+    def test_cmd_version(self):
+        future = self.server.commands['version'](self.environ, {})
+        request, = self.written
+        self.assertEqual(request['to'], 'k.bx@ya.ru/home')
+        response = self.server.xmpp.make_iq_result(request['id'],
+                                                   ifrom='k.bx@ya.ru/home')
+        response['query'] = NS_VERSION
+        self.assertTrue(self.server.resolve_iq(response))
+        self.assertEqual(future.result(),
+                         {'name': None, 'version': None, 'os': None})
+
+    def test_spoofed_response_ignored(self):
+        future = self.server.commands['iq'](self.environ,
+                                            {'query': 'urn:xmpp:ping'})
+        request, = self.written
+        response = self.server.xmpp.make_iq_result(request['id'],
+                                                   ifrom='evil@ya.ru')
+        self.assertFalse(self.server.resolve_iq(response))
+        self.assertFalse(future.done())
+
+
+if __name__ == '__main__':
+    unittest.main()
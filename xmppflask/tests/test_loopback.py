@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+    XmppFlask Tests
+    ~~~~~~~~~~~~~~~
+
+    Test loopback XMPPWSGI server.
+
+    :license: BSD
+"""
+
+import threading
+import time
+
+import mock
+from xmppflask.tests.helpers import unittest, FakeRedis
+from xmppflask import XmppFlask
+from xmppflask.notification import notify
+from xmppflask.sessions import MemorySessionInterface
+from xmppflask.server.loopback import LoopbackWsgiServer, Message, Presence
+
+
+class LoopbackServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = XmppFlask('xmppflask.test')
+        self.app.session_interface = MemorySessionInterface()
+        self.server = LoopbackWsgiServer(self.app)
+
+    def test_reply_captured(self):
+        @self.app.route(u'ping')
+        def ping():
+            return u'pong'
+
+        self.server.connect('bot@ya.ru', None)
+        self.server.inject(Message('k.bx@ya.ru/home', u'ping'))
+        cmd, payload = self.server.outbox[-1]
+        self.assertEqual(cmd, 'message')
+        self.assertEqual(payload['body'], u'pong')
+        self.assertEqual(payload['to'], 'k.bx@ya.ru/home')
+        self.assertEqual(payload['type'], 'chat')
+
+    def test_full_pipeline(self):
+        @self.app.route(u'count')
+        def count():
+            from xmppflask import session
+            session['count'] = session.get('count', 0) + 1
+            return u'%d' % session['count']
+
+        @self.app.route(u'version')
+        def version():
+            info = yield 'version', {}
+            yield u'%(name)s' % info
+
+        @self.app.route_presence()
+        def presence():
+            return 'presence', {'type': 'available'}
+
+        self.server.connect('bot@ya.ru', None)
+        handled = self.server.inject_many([
+            Message('k.bx@ya.ru/home', u'count'),
+            Message('k.bx@ya.ru/home', u'count'),
+            Message('kxepal@ya.ru/work', u'count'),
+            Message('k.bx@ya.ru/home', u'version'),
+            Presence('k.bx@ya.ru/home', show='away'),
+            Message('bot@ya.ru', u'count'),  # own echo is skipped
+        ])
+        self.assertEqual(handled, 6)
+        bodies = [payload.get('body') for _, payload in self.server.outbox]
+        self.assertEqual(bodies, [u'1', u'2', u'1', None, u'XmppFlask', None])
+        self.assertEqual(self.server.xmpp.sent,
+                         {'message': 4, 'version': 1, 'presence': 1})
+
+    def test_session_changed_by_generator_view(self):
+        @self.app.route(u'count')
+        def count():
+            from xmppflask import session
+            session['count'] = session.get('count', 0) + 1
+            yield u'%d' % session['count']
+
+        self.server.connect('bot@ya.ru', None)
+        self.server.inject_many(Message('k.bx@ya.ru/home', u'count')
+                                for _ in range(3))
+        bodies = [payload['body'] for _, payload in self.server.outbox]
+        self.assertEqual(bodies, [u'1', u'2', u'3'])
+        stats = self.app.session_interface.stats()
+        self.assertEqual((stats['saved'], stats['skipped']), (3, 0))
+        self.assertEqual(stats['resident'], 1)
+
+    def test_bare_yield_is_skipped(self):
+        @self.app.route(u'wait')
+        def wait():
+            yield u'one'
+            rv = yield
+            yield u'two %r' % rv
+
+        self.server.connect('bot@ya.ru', None)
+        self.server.inject(Message('k.bx@ya.ru/home', u'wait'))
+        bodies = [payload['body'] for _, payload in self.server.outbox]
+        self.assertEqual(bodies, [u'one', u'two None'])
+
+    def test_batch_sessions(self):
+        from xmppflask.sessions import RedisSessionInterface
+        redis = FakeRedis()
+        self.app.session_interface = RedisSessionInterface(client=redis)
+
+        @self.app.route(u'count')
+        def count():
+            from xmppflask import session
+            session['count'] = session.get('count', 0) + 1
+            return u'%d' % session['count']
+
+        self.server.connect('bot@ya.ru', None)
+        stanzas = [Message('user%d@ya.ru/home' % (idx % 4), u'count')
+                   for idx in range(8)]
+        self.assertEqual(self.server.inject_many(stanzas, batch=8), 8)
+        bodies = [payload['body'] for _, payload in self.server.outbox]
+        self.assertEqual(bodies, [u'1'] * 4 + [u'2'] * 4)
+        self.assertEqual(redis.round_trips, 2)  # MGET and pipeline
+
+    def test_outbox_size(self):
+        @self.app.route(u'ping')
+        def ping():
+            return u'pong'
+
+        self.server.connect('bot@ya.ru', None)
+        self.server.xmpp.outbox = type(self.server.outbox)(maxlen=2)
+        self.server.inject_many(Message('k.bx@ya.ru', u'ping')
+                                for _ in range(5))
+        self.assertEqual(len(self.server.outbox), 2)
+        self.assertEqual(self.server.xmpp.sent['message'], 5)
+
+
+class SendBatchingTestCase(unittest.TestCase):
+
+    def make_server(self, **config):
+        app = XmppFlask('xmppflask.test')
+        app.config.update(config)
+
+        @app.route(u'broadcast')
+        def broadcast():
+            for idx in range(5):
+                yield 'message', {'body': u'%d' % idx,
+                                  'to': u'user%d@ya.ru' % idx}
+
+        @app.route(u'announce')
+        def announce():
+            for idx in range(3):
+                notify(u'user%d@ya.ru' % idx, u'news')
+            return u'announced'
+
+        @app.route(u'version')
+        def version():
+            yield u'asking'
+            info = yield 'version', {}
+            yield info['name']
+
+        @app.route(u'join')
+        def join():
+            yield 'join_room', {'room': u'room@muc', 'nick': u'bot'}
+            yield 'message', {'to': u'room@muc', 'type': 'groupchat',
+                              'body': u'hello'}
+
+        @app.route(u'fail')
+        def fail():
+            yield u'one'
+            yield u'two'
+            raise ValueError('failed')
+
+        server = LoopbackWsgiServer(app)
+        server.connect('bot@ya.ru', None)
+        return server
+
+    def test_one_write_per_dispatch_cycle(self):
+        server = self.make_server()
+        server.inject(Message('k.bx@ya.ru/home', u'broadcast'))
+        self.assertEqual(server.xmpp.writes, 1)
+        self.assertEqual([payload['body'] for _, payload in server.outbox],
+                         [u'0', u'1', u'2', u'3', u'4'])
+
+    def test_batch_size_cap(self):
+        server = self.make_server(XMPPWSGI_SEND_BATCH=2)
+        server.inject(Message('k.bx@ya.ru/home', u'broadcast'))
+        self.assertEqual(server.xmpp.writes, 3)
+        self.assertEqual(server.xmpp.sent, {'message': 5})
+
+    def test_batching_disabled(self):
+        server = self.make_server(XMPPWSGI_SEND_BATCH=0)
+        server.inject(Message('k.bx@ya.ru/home', u'broadcast'))
+        self.assertEqual(server.xmpp.writes, 5)
+
+    def test_unbatched_writes_dont_overlap(self):
+        server = self.make_server(XMPPWSGI_SEND_BATCH=0)
+        writing = []
+        overlaps = []
+        write = server.xmpp.write
+
+        def slow_write(items):
+            writing.append(None)
+            overlaps.append(len(writing) > 1)
+            time.sleep(0.001)
+            writing.pop()
+            write(items)
+        server.xmpp.write = slow_write
+
+        def send():
+            for idx in range(20):
+                server.queue_stanza(('message', {'body': u'%d' % idx}))
+        senders = [threading.Thread(target=send) for _ in range(4)]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        self.assertEqual(len(overlaps), 80)
+        self.assertFalse(any(overlaps))
+
+    def test_join_goes_before_room_message(self):
+        server = self.make_server()
+        server.inject(Message('k.bx@ya.ru/home', u'join'))
+        self.assertEqual([cmd for cmd, _ in server.outbox],
+                         ['join_room', 'message'])
+
+    def test_rate_limited_join_goes_before_room_message(self):
+        server = self.make_server(XMPPWSGI_RATE_LIMIT=1,
+                                  XMPPWSGI_RATE_BURST=1)
+        self.addCleanup(server.rate_limiter.stop)
+        server.inject(Message('k.bx@ya.ru/home', u'join'))
+        self.assertEqual([cmd for cmd, _ in server.outbox], ['join_room'])
+        self.assertEqual(server.rate_limiter.stats()['lanes'], {'reply': 1})
+
+    def test_flushed_when_view_fails(self):
+        server = self.make_server()
+        self.assertRaises(ValueError, server.inject,
+                          Message('k.bx@ya.ru/home', u'fail'))
+        self.assertEqual([payload['body'] for _, payload in server.outbox],
+                         [u'one', u'two'])
+        self.assertFalse(server._outgoing)
+
+    def test_written_outside_dispatch_cycle(self):
+        server = self.make_server()
+        send = server.commands['message']
+        send({'xmpp.jid': 'k.bx@ya.ru/home'}, {'body': u'hello'})
+        self.assertEqual(server.xmpp.writes, 1)
+        self.assertEqual(server.xmpp.sent, {'message': 1})
+
+    def test_flushed_before_direct_send(self):
+        server = self.make_server()
+        server.inject(Message('k.bx@ya.ru/home', u'version'))
+        self.assertEqual([cmd for cmd, _ in server.outbox],
+                         ['message', 'version', 'message'])
+
+    def test_rate_limited_stanzas_are_queued(self):
+        server = self.make_server(XMPPWSGI_RATE_LIMIT=1,
+                                  XMPPWSGI_RATE_BURST=2)
+        self.addCleanup(server.rate_limiter.stop)
+        server.inject(Message('k.bx@ya.ru/home', u'broadcast'))
+        self.assertEqual(server.xmpp.sent, {'message': 2})
+        self.assertEqual(server.rate_limiter.stats()['queued'], 3)
+
+    def test_notifications_go_after_replies(self):
+        server = self.make_server(XMPPWSGI_RATE_LIMIT=1,
+                                  XMPPWSGI_RATE_BURST=1)
+        self.addCleanup(server.rate_limiter.stop)
+        server.inject(Message('k.bx@ya.ru/home', u'announce'))
+        self.assertEqual(server.outbox[0][1]['body'], u'announced')
+        self.assertEqual(server.rate_limiter.stats()['lanes'], {'bulk': 3})
+
+
+class StanzaFiltersTestCase(unittest.TestCase):
+
+    def make_server(self, **config):
+        app = XmppFlask('xmppflask.test')
+        app.config.update(config)
+
+        @app.route(u'ping')
+        def ping():
+            return u'pong'
+
+        server = LoopbackWsgiServer(app)
+        server.connect('bot@ya.ru/xmppflask', None)
+        server.setup_environ = mock.Mock(wraps=server.setup_environ)
+        return server
+
+    def test_dropped_before_environ_setup(self):
+        server = self.make_server()
+        server.inject_many([Message('bot@ya.ru/xmppflask', u'ping'),
+                            Message('k.bx@ya.ru/home', u''),
+                            Message('k.bx@ya.ru/home', u'ping')])
+        self.assertEqual(server.setup_environ.call_count, 1)
+        self.assertEqual(server.xmpp.sent, {'message': 1})
+
+    def test_ignored_types(self):
+        server = self.make_server(XMPPWSGI_IGNORED_TYPES=('error',))
+        server.inject(Message('k.bx@ya.ru/home', u'ping', type='error'))
+        server.inject(Message('k.bx@ya.ru/home', u'ping'))
+        self.assertEqual(server.xmpp.sent, {'message': 1})
+
+    def test_blocked_jids(self):
+        server = self.make_server(XMPPWSGI_BLOCKED_JIDS=['Spam@ya.ru'])
+        server.inject(Message('spam@ya.ru/bot', u'ping'))
+        server.inject(Message('k.bx@ya.ru/home', u'ping'))
+        self.assertEqual(server.outbox[-1][1]['to'], 'k.bx@ya.ru/home')
+        self.assertEqual(server.xmpp.sent, {'message': 1})
+
+    def test_duplicate_ids(self):
+        server = self.make_server(XMPPWSGI_DUPLICATES_WINDOW=2)
+        server.inject_many([Message('k.bx@ya.ru/home', u'ping', id='1'),
+                            Message('k.bx@ya.ru/home', u'ping', id='1'),
+                            Message('kxepal@ya.ru/work', u'ping', id='1'),
+                            Message('k.bx@ya.ru/home', u'ping', id='2'),
+                            Message('k.bx@ya.ru/home', u'ping', id='3'),
+                            Message('k.bx@ya.ru/home', u'ping', id='1'),
+                            Message('k.bx@ya.ru/home', u'ping')])
+        self.assertEqual(server.xmpp.sent, {'message': 6})
+
+    def test_inactive_filters_are_skipped(self):
+        server = self.make_server()
+        self.assertEqual([type(f).__name__ for f in server.filters],
+                         ['SelfEchoFilter', 'EmptyBodyFilter'])
+
+    def test_custom_filter(self):
+        server = self.make_server()
+        server.add_filter(lambda stanza: stanza.body != u'ping')
+        server.inject(Message('k.bx@ya.ru/home', u'ping'))
+        self.assertFalse(server.setup_environ.called)
+
+    def test_environ_formatted_only_for_debug(self):
+        server = self.make_server(DEBUG=False)
+        with mock.patch('xmppflask.server.base.pformat') as pformat:
+            server.inject(Message('k.bx@ya.ru/home', u'ping'))
+            self.assertFalse(pformat.called)
+            with mock.patch.object(server.app.logger, 'isEnabledFor',
+                                   return_value=True):
+                server.inject(Message('k.bx@ya.ru/home', u'ping'))
+            self.assertTrue(pformat.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+    XmppFlask Tests
+    ~~~~~~~~~~~~~~~
+
+    Test native XMPPWSGI server against in-process XMPP server stand-in.
+
+    :license: BSD
+"""
+
+import base64
+import socket
+import threading
+import time
+from Queue import Queue, Empty
+from xml.etree import ElementTree as etree
+from xmppflask.tests.helpers import unittest
+from xmppflask import XmppFlask
+from xmppflask.server.helpers import Future
+from xmppflask.server.native import NativeXmppWsgiServer, IqError, \
+    IqTimeout, StreamError
+from xmppflask.server.xmlstream import XmlStream, Iq, Message, make_stanza, \
+    qname, tostring, NS_SASL, NS_BIND, NS_SESSION, NS_VERSION
+
+
+class StandInXmppServer(object):
+    """Minimal XMPP server for single client: SASL PLAIN authentication,
+    resource binding and session, then it records received stanzas and
+    answers version requests unless told to keep silent."""
+
+    def __init__(self, password='secret', version=('Psi', '1.0', 'Linux')):
+        self.password = password
+        self.version = version
+        self.received = Queue()
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.address = self.listener.getsockname()
+        self.conn = None
+        self.authenticated = False
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        for sock in (self.conn, self.listener):
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                sock.close()
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.conn.sendall(data)
+
+    def serve(self):
+        try:
+            self.conn, _ = self.listener.accept()
+        except socket.error:
+            return
+        self.parser = XmlStream(self.stream_start,
+                                lambda element: self.element(element),
+                                lambda: None)
+        while True:
+            try:
+                data = self.conn.recv(4096)
+            except socket.error:
+                return
+            if not data:
+                return
+            self.parser.feed(data)
+
+    def stream_start(self, attrs):
+        self.write(u"<?xml version='1.0'?><stream:stream xmlns='jabber:client'"
+                   u" xmlns:stream='http://etherx.jabber.org/streams'"
+                   u" from='localhost' id='s1' version='1.0'>")
+        if not self.authenticated:
+            self.write(u"<stream:features><mechanisms xmlns='%s'>"
+                       u"<mechanism>PLAIN</mechanism></mechanisms>"
+                       u"</stream:features>" % NS_SASL)
+        else:
+            self.write(u"<stream:features><bind xmlns='%s'/>"
+                       u"<session xmlns='%s'/></stream:features>"
+                       % (NS_BIND, NS_SESSION))
+
+    def element(self, element):
+        if element.tag == qname(NS_SASL, 'auth'):
+            _, user, password = base64.b64decode(element.text).split('\0')
+            if password == self.password:
+                self.authenticated = True
+                self.parser.reset()
+                self.write(u"<success xmlns='%s'/>" % NS_SASL)
+            else:
+                self.write(u"<failure xmlns='%s'><not-authorized/>"
+                           u"</failure>" % NS_SASL)
+            return
+        stanza = make_stanza(element)
+        if isinstance(stanza, Iq):
+            if stanza.find('bind', NS_BIND) is not None:
+                result = Iq(type='result', id=stanza.id)
+                bind = result.add_child('bind', NS_BIND)
+                etree.SubElement(bind, qname(NS_BIND, 'jid')).text = \
+                    u'bot@localhost/xmppflask'
+                return self.write(unicode(result))
+            if stanza.find('session', NS_SESSION) is not None:
+                return self.write(unicode(Iq(type='result', id=stanza.id)))
+            if stanza.find('query', NS_VERSION) is not None \
+                    and stanza.type == 'get' and self.version:
+                result = Iq(type='result', id=stanza.id, to=stanza.from_jid,
+                            **{'from': stanza.to})
+                query = result.add_child('query', NS_VERSION)
+                for name, value in zip(('name', 'version', 'os'),
+                                       self.version):
+                    etree.SubElement(query, qname(NS_VERSION, name)).text = \
+                        value
+                self.delayed(result)
+                return
+        self.received.put(stanza)
+
+    def delayed(self, stanza):
+        """Sends stanza after next one is received, to be sure that
+        client hasn't been waiting for it."""
+        element = self.element
+
+        def send_after(next_element):
+            del self.element
+            element(next_element)
+            self.write(unicode(stanza))
+        self.element = send_after
+
+
+class XmlStreamTestCase(unittest.TestCase):
+
+    def test_parse_by_chunks(self):
+        events = []
+        stream = XmlStream(events.append,
+                           lambda el: events.append(tostring(el)),
+                           lambda: events.append('end'))
+        data = (u"<?xml version='1.0'?><stream:stream xmlns='jabber:client'"
+                u" xmlns:stream='http://etherx.jabber.org/streams' id='1'>"
+                u"<message from='a@b/c' type='chat'><body>ping п</body>"
+                u"<delay xmlns='urn:xmpp:delay' stamp='2014'/></message>"
+                u"</stream:stream>").encode('utf-8')
+        for idx in range(len(data)):
+            stream.feed(data[idx:idx + 1])
+        self.assertEqual(events, [
+            {'id': '1'},
+            u"<message from=\"a@b/c\" type=\"chat\"><body>ping п</body>"
+            u"<delay xmlns=\"urn:xmpp:delay\" stamp=\"2014\"/></message>",
+            'end'])
+
+    def test_make_stanza(self):
+        msg = make_stanza(etree.fromstring(
+            "<message xmlns='jabber:client' id='1'><body>hi</body></message>"))
+        self.assertTrue(isinstance(msg, Message))
+        self.assertEqual(msg.body, 'hi')
+        self.assertEqual(make_stanza(etree.Element('features')), None)
+
+    def test_presence_priority(self):
+        def priority(text):
+            return make_stanza(etree.fromstring(
+                "<presence xmlns='jabber:client'>%s</presence>" % text
+            )).priority
+        self.assertEqual(priority('<priority>5</priority>'), 5)
+        self.assertEqual(priority(''), 0)
+        self.assertEqual(priority('<priority>high</priority>'), 0)
+
+    def test_iq_error(self):
+        iq = Iq(type='get', id='42', **{'from': 'k.bx@ya.ru/home'})
+        self.assertEqual(
+            unicode(iq.make_error('service-unavailable')),
+            u'<iq id="42" to="k.bx@ya.ru/home" type="error">'
+            u'<error type="cancel"><service-unavailable xmlns='
+            u'"urn:ietf:params:xml:ns:xmpp-stanzas"/></error></iq>')
+
+
+class NativeServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = XmppFlask('xmppflask.test')
+        self.stand_in = StandInXmppServer()
+        self.addCleanup(self.stand_in.close)
+        self.server = NativeXmppWsgiServer(self.app)
+        self.server.iq_timeout = 0.2
+
+    def connect(self):
+        self.server.connect('bot@localhost', 'secret', use_tls=False,
+                            address=self.stand_in.address, timeout=5)
+        self.addCleanup(self.server.xmpp.close)
+        presence = self.receive()
+        self.assertEqual(presence.name, 'presence')
+
+    def send(self, body, jid='k.bx@ya.ru/home'):
+        self.stand_in.write(u"<message from='%s' to='bot@localhost' "
+                            u"type='chat' id='m1'><body>%s</body></message>"
+                            % (jid, body))
+
+    def poll_until(self, predicate, timeout=5):
+        deadline = time.time() + timeout
+        while not predicate() and time.time() < deadline:
+            self.server.poll(0.05)
+
+    def receive(self, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self.server.poll(0.05)
+            try:
+                return self.stand_in.received.get_nowait()
+            except Empty:
+                pass
+        self.fail('nothing received')
+
+    def test_connect(self):
+        self.connect()
+        self.assertEqual(self.server.base_environ['app.jid'],
+                         'bot@localhost/xmppflask')
+        self.assertEqual(self.server.base_environ['app.protocol'], None)
+        self.assertTrue(self.app.route_map.frozen)
+
+    def test_authentication_failed(self):
+        self.assertRaises(StreamError, self.server.connect, 'bot@localhost',
+                          'wrong', use_tls=False,
+                          address=self.stand_in.address, timeout=5)
+
+    def test_reply(self):
+        @self.app.route(u'ping')
+        def ping():
+            return u'pong'
+
+        self.connect()
+        self.send(u'ping')
+        reply = self.receive()
+        self.assertEqual(reply.body, u'pong')
+        self.assertEqual(reply.to, u'k.bx@ya.ru/home')
+        self.assertEqual(reply.type, u'chat')
+
+    def test_view_error_keeps_stream(self):
+        @self.app.route(u'fail')
+        def fail():
+            raise ValueError('boom')
+
+        @self.app.route(u'ping')
+        def ping():
+            return u'pong'
+
+        self.connect()
+        self.send(u'fail')
+        self.send(u'ping')
+        self.assertEqual(self.receive().body, u'pong')
+        self.assertTrue(self.server.xmpp.connected)
+
+    def test_views_wait_iq_without_blocking(self):
+        @self.app.route(u'version')
+        def version():
+            info = yield 'version', {}
+            yield u'%(name)s %(version)s' % info
+
+        @self.app.route(u'ping')
+        def ping():
+            return u'pong'
+
+        self.connect()
+        self.send(u'version')
+        # version response is sent only after the stand-in gets the next
+        # stanza, so other users are served while view waits for it
+        self.send(u'ping', 'kxepal@ya.ru/work')
+        self.assertEqual(self.receive().body, u'pong')
+        self.assertEqual(self.receive().body, u'Psi 1.0')
+
+    def test_iq_timeout(self):
+        self.stand_in.version = None
+        errors = []
+
+        @self.app.route(u'version')
+        def version():
+            info = yield 'version', {}
+            yield u'%r' % info
+            try:
+                yield 'iq', {'query': NS_VERSION}
+            except IqTimeout:
+                errors.append(IqTimeout)
+
+        self.connect()
+        self.send(u'version')
+        self.receive()
+        self.assertEqual(self.receive().body, u'None')
+        self.receive()
+        self.poll_until(lambda: errors)
+        self.assertEqual(errors, [IqTimeout])
+        self.assertEqual(len(self.server.iq_table), 0)
+
+    def test_iq_error_response(self):
+        results = []
+
+        @self.app.route(u'iq')
+        def iq():
+            try:
+                yield 'iq', {'query': 'urn:xmpp:ping'}
+            except IqError as err:
+                results.append(err.stanza.type)
+
+        self.connect()
+        self.send(u'iq')
+        request = self.receive()
+        error = request.make_error('feature-not-implemented')
+        error.set('from', request.to)
+        self.stand_in.write(unicode(error))
+        self.poll_until(lambda: results)
+        self.assertEqual(results, ['error'])
+
+    def test_iq_waits_for_rate_limit(self):
+        self.app.config['XMPPWSGI_RECIPIENT_RATE_LIMIT'] = 5
+        self.app.config['XMPPWSGI_RECIPIENT_RATE_BURST'] = 1
+        self.server = NativeXmppWsgiServer(self.app)
+
+        @self.app.route(u'ping')
+        def ping():
+            yield u'pinging'
+            yield 'iq', {'query': 'urn:xmpp:ping'}
+
+        self.connect()
+        self.addCleanup(self.server.rate_limiter.stop)
+        self.send(u'ping')
+        self.assertEqual(self.receive().body, u'pinging')
+        request = self.receive()
+        self.assertEqual(request.name, 'iq')
+        self.assertEqual(self.server.rate_limiter.stats()['delayed'], 1)
+        self.assertTrue(request.id in self.server.iq_table)
+
+    def test_spoofed_iq_response_ignored(self):
+        self.connect()
+        future = self.server.send_iq(Iq(type='get', to='k.bx@ya.ru/home'))
+        request = self.receive()
+        self.stand_in.write(u"<iq type='result' id='%s' from='evil@ya.ru'/>"
+                            % request.id)
+        self.server.poll(0.1)
+        self.assertFalse(future.done())
+
+    def test_answer_version_request(self):
+        self.connect()
+        self.stand_in.write(u"<iq type='get' id='v1' from='k.bx@ya.ru/home'>"
+                            u"<query xmlns='%s'/></iq>" % NS_VERSION)
+        result = self.receive()
+        self.assertEqual(result.type, 'result')
+        self.assertEqual(result.id, 'v1')
+        query = result.find('query', NS_VERSION)
+        self.assertEqual(query.findtext(qname(NS_VERSION, 'name')),
+                         'XmppFlask')
+
+    def test_unknown_iq_request(self):
+        self.connect()
+        self.stand_in.write(u"<iq type='get' id='u1' from='k.bx@ya.ru/home'>"
+                            u"<query xmlns='urn:unknown'/></iq>")
+        result = self.receive()
+        self.assertEqual(result.type, 'error')
+
+    def test_send_from_other_thread(self):
+        self.connect()
+        sender = threading.Thread(target=self.server.send,
+                                  args=(Message(to='k.bx@ya.ru'),))
+        sender.start()
+        sender.join()
+        self.assertEqual(self.receive().to, 'k.bx@ya.ru')
+
+
+class FutureTestCase(unittest.TestCase):
+
+    def test_callbacks(self):
+        future = Future()
+        calls = []
+        future.add_done_callback(calls.append)
+        self.assertRaises(RuntimeError, future.result)
+        future.set_result(42)
+        future.add_done_callback(calls.append)
+        self.assertEqual(calls, [future, future])
+        self.assertEqual(future.result(), 42)
+        self.assertRaises(RuntimeError, future.set_result, 43)
+
+    def test_exception(self):
+        future = Future()
+        future.set_exception(ValueError('boom'))
+        self.assertTrue(isinstance(future.exception(), ValueError))
+        self.assertRaises(ValueError, future.result)
+
+    def test_wait_for_result(self):
+        future = Future()
+        self.assertRaises(RuntimeError, future.result, 0.01)
+        threading.Thread(target=future.set_result, args=(42,)).start()
+        self.assertEqual(future.result(5), 42)
+
+
+if __name__ == '__main__':
+    unittest.main()
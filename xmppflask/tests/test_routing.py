@@ -203,3 +203,486 @@ class RoutingFunctionality(unittest.TestCase):
                          ('pong', {'host': 'example.com.'}))
         self.assertEqual(adapter.match('pong foo tail'),
                          ('pong', {'host': 'foo'}))
+
+
+class CompiledRoutingFunctionality(unittest.TestCase):
+
+    def make_rules(self):
+        return [
+            Rule(u'ping', endpoint='ping'),
+            Rule(u'ping me', endpoint='ping_me'),
+            Rule(u'ping <user>', endpoint='ping_user'),
+            Rule(u'ping <user> <int:n> times', endpoint='ping_times'),
+            Rule(u'weather in <string(maxlength=10):city>',
+                 endpoint='weather_in_city'),
+            Rule(u'pong <host>', endpoint='pong', strict=False),
+            Rule(u'admin', from_jid='.*@xmpp.ru', endpoint='admin'),
+            Rule(u'admin', endpoint='not_admin'),
+            Rule(u'ping', event_type='presence', endpoint='presence_ping'),
+            Rule(None, event_type='presence', endpoint='presence'),
+            Rule(u'topic', type='groupchat', endpoint='topic'),
+        ]
+
+    def assertSameMatch(self, linear, compiled, *args, **kwargs):
+        try:
+            expected = linear.bind().match(*args, **kwargs)
+        except NotFound:
+            self.assertRaises(NotFound, compiled.bind().match,
+                              *args, **kwargs)
+        else:
+            self.assertEqual(compiled.bind().match(*args, **kwargs),
+                             expected)
+
+    def test_same_matches_as_linear(self):
+        linear = Map(self.make_rules())
+        compiled = Map(self.make_rules(), compiled=True)
+        for message in [u'ping', u'ping me', u'ping k_bx', u'ping k_bx 3 times',
+                        u'ping k_bx many times', u'weather in Kiev',
+                        u'weather in Llanfairpwllgwyngyll', u'pong foo tail',
+                        u'say pong foo', u'topic', u'', u'unknown']:
+            for event_type in (None, 'message', 'presence'):
+                for type in (None, 'chat', 'groupchat'):
+                    self.assertSameMatch(linear, compiled, message,
+                                         event_type=event_type, type=type)
+
+    def test_rejected_winner_falls_back_to_next_rule(self):
+        rmap = Map(self.make_rules(), compiled=True)
+        adapter = rmap.bind()
+        self.assertEqual(adapter.match(u'admin', from_jid='foo@xmpp.ru'),
+                         ('admin', {}))
+        self.assertEqual(adapter.match(u'admin', from_jid='foo@bar'),
+                         ('not_admin', {}))
+
+    def test_return_rule(self):
+        rmap = Map(self.make_rules(), compiled=True)
+        rule, args = rmap.bind().match(u'ping k_bx', return_rule=True)
+        self.assertEqual(rule.endpoint, 'ping_user')
+        self.assertEqual(args, {'user': 'k_bx'})
+
+    def test_many_rules_split_over_several_regexes(self):
+        rules = []
+        for idx in range(300):
+            rules.append(Rule(u'<a> cmd%d <b>' % idx, endpoint='cmd%d' % idx))
+        rmap = Map(rules, compiled=True)
+        rmap.update()
+        adapter = rmap.bind()
+        self.assertEqual(adapter.match(u'x cmd0 y'),
+                         ('cmd0', {'a': 'x', 'b': 'y'}))
+        self.assertEqual(adapter.match(u'x cmd299 y'),
+                         ('cmd299', {'a': 'x', 'b': 'y'}))
+        self.assertRaises(NotFound, adapter.match, u'x cmd300 y')
+        compiled, = rmap.bucket()._compiled_candidates.values()
+        self.assertTrue(len(compiled._chunks) > 1)
+
+    def test_few_candidates_matched_one_by_one(self):
+        rules = []
+        for idx in range(300):
+            rules.append(Rule(u'cmd%d <a>' % idx, endpoint='cmd%d' % idx))
+        rmap = Map(rules, compiled=True)
+        rmap.update()
+        self.assertEqual(rmap.bind().match(u'cmd299 x'),
+                         ('cmd299', {'a': 'x'}))
+        self.assertEqual(rmap.bucket()._compiled_candidates, {})
+
+    def test_recompiled_after_add(self):
+        rmap = Map([Rule(u'ping', endpoint='ping')], compiled=True)
+        adapter = rmap.bind()
+        self.assertRaises(NotFound, adapter.match, u'pong')
+        rmap.add(Rule(u'pong', endpoint='pong'))
+        self.assertEqual(adapter.match(u'pong'), ('pong', {}))
+
+
+class PrefixTrieTestCase(unittest.TestCase):
+
+    def test_candidates_by_literal_prefix(self):
+        rmap = Map([
+            Rule(u'ping', endpoint='ping'),
+            Rule(u'ping <user>', endpoint='ping_user'),
+            Rule(u'pong', endpoint='pong'),
+            Rule(u'help', endpoint='help'),
+        ])
+        rmap.update()
+        endpoints = lambda message: [
+            rule.endpoint for rule in rmap.bucket().prefix_trie.candidates(message)]
+        self.assertEqual(endpoints(u'ping k_bx'), ['ping_user', 'ping'])
+        self.assertEqual(endpoints(u'pong'), ['pong'])
+        self.assertEqual(endpoints(u'help me'), ['help'])
+        self.assertEqual(endpoints(u'cities'), [])
+        self.assertEqual(endpoints(u''), [])
+
+    def test_rules_without_prefix_keep_their_order(self):
+        rmap = Map([
+            Rule(u'<user> ping', endpoint='user_ping'),
+            Rule(u'ping <user>', endpoint='ping_user'),
+            Rule(u'pong <host>', endpoint='pong', strict=False),
+            Rule(u'weather in <city>', endpoint='weather'),
+            Rule(None, endpoint='empty'),
+        ])
+        rmap.update()
+        order = [rule.endpoint for rule in rmap._sorted_rules]
+        for message in (u'ping k_bx', u'weather in Kiev', u'foo', u''):
+            candidates = [rule.endpoint
+                          for rule in rmap.bucket().prefix_trie.candidates(message)]
+            self.assertEqual(candidates,
+                             [endpoint for endpoint in order
+                              if endpoint in candidates])
+            for endpoint in ('user_ping', 'pong', 'empty'):
+                self.assertTrue(endpoint in candidates)
+
+        adapter = rmap.bind()
+        self.assertEqual(adapter.match(u'k_bx ping'),
+                         ('user_ping', {'user': 'k_bx'}))
+        self.assertEqual(adapter.match(u'say pong foo'),
+                         ('pong', {'host': 'foo'}))
+        self.assertEqual(adapter.match(u''), ('empty', {}))
+
+
+class RuleBucketsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.map = Map([
+            Rule(u'ping', event_type='message', endpoint='ping'),
+            Rule(u'ping me', event_type='message', type='chat',
+                 endpoint='ping_me'),
+            Rule(u'<any(u"ping", u"pong"):cmd> me', endpoint='any_me'),
+            Rule(None, event_type='presence', endpoint='presence'),
+            Rule(None, event_type='presence', type='unavailable',
+                 endpoint='gone'),
+        ])
+        self.map.update()
+
+    def endpoints(self, event_type=None, type=None):
+        return [rule.endpoint
+                for rule in self.map.bucket(event_type, type).rules]
+
+    def test_presence_skips_message_rules(self):
+        self.assertEqual(self.endpoints('presence'),
+                         ['any_me', 'presence', 'gone'])
+        self.assertEqual(self.endpoints('presence', 'unavailable'),
+                         ['any_me', 'presence', 'gone'])
+        self.assertEqual(self.endpoints('presence', 'subscribe'),
+                         ['any_me', 'presence'])
+
+    def test_wildcard_rules_merged_in_priority_order(self):
+        self.assertEqual(self.endpoints('message', 'chat'),
+                         ['any_me', 'ping_me', 'ping'])
+        self.assertEqual(self.endpoints('message', 'groupchat'),
+                         ['any_me', 'ping'])
+        adapter = self.map.bind()
+        self.assertEqual(adapter.match(u'ping me', event_type='message',
+                                       type='chat'),
+                         ('any_me', {'cmd': 'ping'}))
+        self.assertEqual(adapter.match(u'ping', event_type='message',
+                                       type='groupchat'), ('ping', {}))
+
+    def test_unknown_types_get_wildcard_rules_only(self):
+        self.assertEqual(self.endpoints('iq'), ['any_me'])
+        self.assertEqual(self.endpoints('iq', 'result'), ['any_me'])
+
+    def test_no_filter_gets_all_rules(self):
+        self.assertEqual(len(self.endpoints()), 5)
+
+    def test_buckets_updated_after_add(self):
+        self.map.add(Rule(u'ping', event_type='iq', endpoint='iq_ping'))
+        self.assertEqual(self.map.bind().match(u'ping', event_type='iq'),
+                         ('iq_ping', {}))
+
+
+class JidPatternTestCase(unittest.TestCase):
+
+    jids = ['foo@bar', 'foo@bar.ru', 'foo@bar/home', '_foo@bar', 'bar',
+            'foo@xmpp.ru', 'bar@xmpp.ru/res', 'foo@xmppXru', 'xmpp.ru']
+
+    def assertLikeRegex(self, pattern, kind):
+        from xmppflask.routing import JidPattern
+        import re
+
+        jid_pattern = JidPattern(pattern)
+        self.assertEqual(jid_pattern.kind, kind)
+        for jid in self.jids:
+            self.assertEqual(bool(jid_pattern.match(jid)),
+                             bool(re.match(pattern, jid)),
+                             (pattern, jid))
+
+    def test_plain_string(self):
+        self.assertLikeRegex('foo@bar', 'prefix')
+
+    def test_any_user_of_domain(self):
+        self.assertLikeRegex(r'.*@xmpp\.ru', 'contains')
+
+    def test_regex(self):
+        self.assertLikeRegex('.*@xmpp.ru', 'regex')
+        self.assertLikeRegex('foo@bar$', 'regex')
+        self.assertLikeRegex('(foo|bar)@.*', 'regex')
+
+    def test_rules_share_compiled_pattern(self):
+        rmap = Map([
+            Rule(u'ban <user>', from_jid='admin@localhost', endpoint='ban'),
+            Rule(u'kick <user>', from_jid='admin@localhost', endpoint='kick'),
+        ])
+        self.assertTrue(rmap._rules[0]._from_jid is rmap._rules[1]._from_jid)
+
+        adapter = rmap.bind()
+        self.assertEqual(adapter.match(u'kick foo',
+                                       from_jid='admin@localhost/home'),
+                         ('kick', {'user': 'foo'}))
+        self.assertRaises(NotFound, adapter.match, u'kick foo',
+                          from_jid='foo@localhost/home')
+
+
+class MatchCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.map = Map([
+            Rule(u'ping', endpoint='ping'),
+            Rule(u'ping <user>', endpoint='ping_user'),
+        ], match_cache_size=2)
+        self.adapter = self.map.bind()
+
+    def test_hits_and_misses(self):
+        cache = self.map.match_cache
+        self.assertEqual(self.adapter.match(u'ping'), ('ping', {}))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertEqual(self.adapter.match(u'ping'), ('ping', {}))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertRaises(NotFound, self.adapter.match, u'pong')
+        self.assertRaises(NotFound, self.adapter.match, u'pong')
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_bounded(self):
+        cache = self.map.match_cache
+        self.adapter.match(u'ping')
+        self.adapter.match(u'ping foo')
+        self.adapter.match(u'ping')
+        self.adapter.match(u'ping bar')
+        self.assertEqual(len(cache), 2)
+        self.adapter.match(u'ping')
+        self.assertEqual(cache.hits, 2)
+        self.adapter.match(u'ping foo')
+        self.assertEqual(cache.hits, 2)
+
+    def test_cached_arguments_are_not_shared(self):
+        endpoint, args = self.adapter.match(u'ping foo')
+        args['user'] = 'bar'
+        self.assertEqual(self.adapter.match(u'ping foo'),
+                         ('ping_user', {'user': 'foo'}))
+
+    def test_invalidated_on_add(self):
+        self.assertRaises(NotFound, self.adapter.match, u'pong')
+        self.map.add(Rule(u'pong', endpoint='pong'))
+        self.map.update()
+        self.assertEqual(len(self.map.match_cache), 0)
+        self.assertEqual(self.adapter.match(u'pong'), ('pong', {}))
+
+    def test_sender_jid_is_part_of_key_for_restricted_rules(self):
+        self.map.add(Rule(u'kick <user>', from_jid='admin@localhost',
+                          endpoint='kick'))
+        self.assertEqual(self.adapter.match(u'kick foo',
+                                            from_jid='admin@localhost'),
+                         ('kick', {'user': 'foo'}))
+        self.assertRaises(NotFound, self.adapter.match, u'kick foo',
+                          from_jid='foo@localhost')
+
+
+class RuleOrderingTestCase(unittest.TestCase):
+
+    def make_rules(self):
+        import random
+
+        rnd = random.Random(42)
+        words = [u'ping', u'pong', u'weather in', u'help', u'p', u'ping me']
+        parts = [u'<user>', u'<int:n>', u'<string:text>', u'<float:f>',
+                 u'<any(u"a", u"b"):ab>']
+        rules = []
+        for idx in range(300):
+            chunks = []
+            used = set()
+            for _ in range(rnd.randint(0, 3)):
+                if rnd.random() < 0.5:
+                    chunks.append(rnd.choice(words))
+                else:
+                    part = rnd.choice(parts)
+                    if part in used:
+                        continue
+                    used.add(part)
+                    chunks.append(part)
+            defaults = None
+            if rnd.random() < 0.2:
+                defaults = {'extra': idx}
+            rules.append(Rule(u' '.join(chunks), defaults=defaults,
+                              endpoint='e%d' % rnd.randint(0, 20)))
+        return rules
+
+    def test_same_order_as_match_compare(self):
+        rmap = Map(self.make_rules())
+        expected = sorted(rmap._rules, cmp=lambda a, b: a.match_compare(b))
+        self.assertEqual(rmap._sorted_rules, expected)
+
+        for endpoint, rules in rmap._rules_by_endpoint.items():
+            self.assertEqual(
+                rules, sorted(rules, cmp=lambda a, b: a.match_compare(b)))
+
+    def test_incremental_add_keeps_order(self):
+        rmap = Map()
+        for rule in self.make_rules():
+            rmap.add(rule)
+            rmap.update()
+        expected = sorted(rmap._rules, cmp=lambda a, b: a.match_compare(b))
+        self.assertEqual(rmap._sorted_rules, expected)
+
+    def test_registration_order_kept(self):
+        rules = self.make_rules()
+        rmap = Map(rules)
+        self.assertEqual(rmap._rules, rules)
+
+
+class FrozenMapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.map = Map([Rule(u'ping', endpoint='ping')])
+
+    def test_freeze(self):
+        self.assertFalse(self.map.frozen)
+        self.map.freeze()
+        self.assertTrue(self.map.frozen)
+        adapter = self.map.bind()
+        self.assertEqual(adapter.match(u'ping'), ('ping', {}))
+        self.assertEqual(adapter.build('ping'), u'ping')
+
+    def test_add_to_frozen_map(self):
+        self.map.freeze()
+        self.assertRaises(RuntimeError, self.map.add,
+                          Rule(u'pong', endpoint='pong'))
+
+    def test_thaw(self):
+        adapter = self.map.bind()
+        self.map.freeze()
+        index = self.map._index
+        self.map.thaw()
+        self.assertFalse(self.map.frozen)
+        self.map.add(Rule(u'pong', endpoint='pong'))
+        # old index stays in place until replaced as a whole
+        self.assertTrue(self.map._index is index)
+        self.assertEqual(adapter.match(u'pong'), ('pong', {}))
+        self.assertFalse(self.map._index is index)
+        self.map.freeze()
+        self.assertEqual(adapter.match(u'pong'), ('pong', {}))
+
+    def test_index_is_replaced_atomically(self):
+        import threading
+
+        adapter = self.map.bind()
+        errors = []
+
+        def dispatch():
+            for _ in range(500):
+                try:
+                    adapter.match(u'ping')
+                except Exception, err:
+                    errors.append(err)
+
+        workers = [threading.Thread(target=dispatch) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for idx in range(200):
+            self.map.add(Rule(u'cmd%d <arg>' % idx, endpoint='cmd%d' % idx))
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(adapter.match(u'cmd199 x'),
+                         ('cmd199', {'arg': 'x'}))
+
+
+class EndpointBuilderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.map = Map([
+            Rule(u'help', endpoint='help'),
+            Rule(u'help <topic>', endpoint='help'),
+            Rule(u'ping', defaults={'user': 'k_bx'}, endpoint='ping'),
+            Rule(u'ping <user>', endpoint='ping'),
+            Rule(u'ping <user> <int:n> times', endpoint='ping'),
+        ])
+        self.adapter = self.map.bind()
+
+    def test_picks_rule_by_given_arguments(self):
+        self.assertEqual(self.adapter.build('help'), u'help')
+        self.assertEqual(self.adapter.build('help', {'topic': 'ping'}),
+                         u'help ping')
+        self.assertEqual(self.adapter.build('ping'), u'ping')
+        self.assertEqual(self.adapter.build('ping', {'user': 'kxepal'}),
+                         u'ping kxepal')
+        self.assertEqual(self.adapter.build('ping', {'user': 'kxepal',
+                                                     'n': 3}),
+                         u'ping kxepal 3 times')
+
+    def test_same_result_as_suitable_for_scan(self):
+        index = self.map.update()
+        for values in ({}, {'topic': 'x'}, {'user': 'k_bx'}, {'user': 'x'},
+                       {'user': 'x', 'n': 2}, {'n': 2}, {'user': 'k_bx',
+                                                         'topic': 'x'}):
+            for endpoint, rules in index.rules_by_endpoint.items():
+                expected = None
+                for rule in rules:
+                    if rule.suitable_for(values):
+                        expected = rule.build(values)
+                        if expected is not None:
+                            break
+                self.assertEqual(index.builders[endpoint].build(values),
+                                 expected, (endpoint, values))
+
+    def test_static_messages_rendered_once(self):
+        builder = self.map.update().builders['help']
+        static = [entry[-1] for entry in builder._entries]
+        self.assertEqual(static, [None, u'help'])
+
+    def test_unknown_endpoint(self):
+        from xmppflask.routing import BuildError
+        self.assertRaises(BuildError, self.adapter.build, 'pong')
+
+
+class ConvertersTestCase(unittest.TestCase):
+
+    def make_rules(self):
+        return [
+            Rule(u'page <int(min_=1, max_=10):page>', endpoint='page'),
+            Rule(u'page <int(fixed_digits=4):page>', endpoint='page4'),
+            Rule(u'page <page>', endpoint='page_any'),
+            Rule(u'move <float:x> <float:y>', endpoint='move'),
+            Rule(u'say <string(length=3):word> to <any(a, b):who>',
+                 endpoint='say'),
+        ]
+
+    def test_to_python_applied(self):
+        adapter = Map(self.make_rules()).bind()
+        self.assertEqual(adapter.match(u'page 5'), ('page', {'page': 5}))
+        self.assertEqual(adapter.match(u'move 1.5 2.0'),
+                         ('move', {'x': 1.5, 'y': 2.0}))
+        self.assertEqual(adapter.match(u'say hey to b'),
+                         ('say', {'word': u'hey', 'who': u'b'}))
+
+    def test_validation_falls_through(self):
+        for compiled in (False, True):
+            adapter = Map(self.make_rules(), compiled=compiled).bind()
+            self.assertEqual(adapter.match(u'page 11'),
+                             ('page_any', {'page': u'11'}))
+            self.assertEqual(adapter.match(u'page 0042'),
+                             ('page4', {'page': 42}))
+            self.assertEqual(adapter.match(u'page 0'),
+                             ('page_any', {'page': u'0'}))
+            self.assertRaises(NotFound, adapter.match, u'say heya to a')
+
+    def test_identity_converters_skipped(self):
+        rule = Rule(u'say <string(length=3):word> to <any(a, b):who> '
+                    u'<int:n>')
+        Map([rule])
+        plan = dict((name, to_python)
+                    for _, name, to_python in rule._conversions)
+        self.assertTrue(plan['word'] is None)
+        self.assertTrue(plan['who'] is None)
+        self.assertEqual(plan['n'], rule._converters['n'].to_python)
+
+    def test_unicode_converter_bound_to_map(self):
+        rule = Rule(u'say <string(length=3):word>')
+        rmap = Map([rule])
+        self.assertTrue(rule._converters['word'].map is rmap)
@@ -10,11 +10,20 @@
 """
 
 import sys
+import threading
 import time
 import mock
 from xmppflask.tests.helpers import unittest
 from xmppflask import XmppFlask
 from xmppflask.server import XmppWsgiServer, Capability, CapabilityNotFound
+from xmppflask.server.dispatch import Dispatcher, ThreadPoolDispatcher, \
+    KeyedThreadPoolDispatcher
+from xmppflask.server.helpers import Future, LazyEnviron
+from xmppflask.server.iq import IqError, IqTimeout, PendingIqTable, TimerWheel
+from xmppflask.server.lanes import (WeightedLanes, LANE_BULK, LANE_PRESENCE,
+                                    LANE_REPLY)
+from xmppflask.server.ratelimit import OutboundRateLimiter
+from xmppflask.sessions import MemorySessionInterface
 
 
 class TestServerCapability(Capability):
@@ -120,6 +129,13 @@ class XmppWsgiServerTestCase(unittest.TestCase):
         self.assertEqual(ts, utcts)
         self.assertNotEqual(ts, localts)
 
+    def test_session_start_freezes_route_map(self):
+        class Standard(TestServerCapability):
+            name = 'std'
+
+        self.server.session_start()
+        self.assertTrue(self.server.app.route_map.frozen)
+
     def test_register_capability(self):
         class Feature(TestServerCapability):
             name = 'very useful'
@@ -218,6 +234,22 @@ class XmppWsgiServerTestCase(unittest.TestCase):
         environ = self.server.setup_environ(Message())
         self.assertEqual(environ['test'], 'passed')
 
+    def test_capabilities_defer_environ_values(self):
+        calls = []
+
+        class SoFeature(TestServerCapability):
+            name = 'very userful'
+
+            def update_environ(self, environ, stanza):
+                environ.lazy('xmpp.xml', lambda: calls.append(1) or '<m/>')
+
+        self.server.register_capability(SoFeature(mock.Mock()))
+        environ = self.server.setup_environ(Message())
+        self.assertEqual(calls, [])
+        self.assertEqual(environ['xmpp.xml'], '<m/>')
+        self.assertEqual(environ['xmpp.xml'], '<m/>')
+        self.assertEqual(calls, [1])
+
     def test_dispatch_app_response(self):
         def message(environ, payload):
             self.assertEqual('ping', payload['body'])
@@ -312,6 +344,29 @@ class XmppWsgiServerTestCase(unittest.TestCase):
         environ = {'xmpp.jid': 'k.bx@ya.ru', 'xmpp.body': 'appctx'}
         self.server.xmppwsgi_app(environ, [])
 
+    def test_suspend_generator_on_unfinished_future(self):
+        app = self.server.app
+        future = Future()
+        results = []
+
+        @app.route('wait')
+        def wait():
+            from xmppflask import g
+            g.answer = yield 'ask', {}
+            yield 'got %s' % g.answer
+
+        def message(environ, payload):
+            results.append(payload['body'])
+
+        self.server.commands['ask'] = lambda environ, payload: future
+        self.server.commands['message'] = message
+
+        environ = {'xmpp.jid': 'k.bx@ya.ru', 'xmpp.body': 'wait'}
+        self.server.xmppwsgi_app(environ, [])
+        self.assertEqual(results, [])
+        future.set_result(42)
+        self.assertEqual(results, ['got 42'])
+
     def test_handle(self):
         class Feature(TestServerCapability):
             name = 'feature'
@@ -379,5 +434,419 @@ class XmppWsgiServerTestCase(unittest.TestCase):
         self.server.handle(Message())
 
 
+class DispatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = XmppFlask('xmppflask.test')
+        self.app.config['XMPPWSGI_WORKERS'] = 1
+        self.app.config['XMPPWSGI_QUEUE_SIZE'] = 1
+        self.replies = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.done = threading.Semaphore(0)
+
+        @self.app.route('slow <n>')
+        def slow(n):
+            self.entered.set()
+            self.release.wait(5)
+            return 'done %s' % n
+
+        @self.app.route('fail')
+        def fail():
+            raise ValueError('boom')
+
+        @self.app.route('ping')
+        def ping():
+            from xmppflask import g
+            return '%s %d' % (threading.current_thread().name,
+                              id(g._get_current_object()))
+
+    def make_server(self, **config):
+        self.app.config.update(config)
+        server = TestXmppWsgiServer(self.app)
+
+        def message(environ, payload):
+            self.replies.append(payload['body'])
+            self.done.release()
+        server.commands['message'] = message
+        self.addCleanup(self.release.set)
+        return server
+
+    def environ(self, body, jid='k.bx@ya.ru/home', type='chat'):
+        return {'xmpp.jid': jid, 'xmpp.body': body,
+                'xmpp.stanza': 'message', 'xmpp.stanza_type': type}
+
+    def wait_replies(self, count):
+        for _ in range(count):
+            self.done.acquire()
+
+    def watch_waits(self, dispatcher):
+        """Returns event which is set every time a thread waits for
+        `dispatcher` condition, i.e. it has nothing to do or is blocked."""
+        waiting = threading.Event()
+        cond = dispatcher._cond
+        wait = cond.wait
+
+        def watched(*args):
+            waiting.set()
+            return wait(*args)
+        cond.wait = watched
+        return waiting
+
+    def test_sync_by_default(self):
+        self.app.config['XMPPWSGI_WORKERS'] = 0
+        server = self.make_server()
+        self.assertEqual(type(server.dispatcher), Dispatcher)
+        self.assertFalse(server.base_environ['wsgi.multithread'])
+        server.dispatcher.dispatch(self.environ('ping'))
+        self.assertTrue(self.replies[0].startswith(
+            threading.current_thread().name))
+
+    def test_workers_have_own_app_context(self):
+        server = self.make_server(XMPPWSGI_WORKERS=2, XMPPWSGI_QUEUE_SIZE=10)
+        self.assertTrue(isinstance(server.dispatcher, ThreadPoolDispatcher))
+        self.assertTrue(server.base_environ['wsgi.multithread'])
+        self.release.set()
+        for _ in range(6):
+            server.dispatcher.dispatch(self.environ('ping'))
+        self.wait_replies(6)
+        server.dispatcher.stop()
+        workers = dict(reply.split() for reply in self.replies)
+        self.assertFalse(threading.current_thread().name in workers)
+        self.assertEqual(len(set(workers.values())), len(workers))
+
+    def test_worker_survives_app_error(self):
+        server = self.make_server()
+        self.release.set()
+        server.dispatcher.dispatch(self.environ('fail'))
+        server.dispatcher.dispatch(self.environ('slow 1'))
+        self.wait_replies(1)
+        server.dispatcher.stop()
+        self.assertEqual(self.replies, ['done 1'])
+
+    def fill_queue(self, server):
+        server.dispatcher.dispatch(self.environ('slow 1'))
+        self.entered.wait(5)  # the only worker is busy now
+        server.dispatcher.dispatch(self.environ('slow 2'))
+
+    def test_overflow_drop_oldest(self):
+        server = self.make_server(XMPPWSGI_QUEUE_OVERFLOW='drop_oldest')
+        self.fill_queue(server)
+        server.dispatcher.dispatch(self.environ('slow 3'))
+        self.assertEqual(server.dispatcher.dropped, 1)
+        self.release.set()
+        self.wait_replies(2)
+        server.dispatcher.stop()
+        self.assertEqual(self.replies, ['done 1', 'done 3'])
+
+    def test_overflow_reject(self):
+        server = self.make_server(XMPPWSGI_QUEUE_OVERFLOW='reject',
+                                  XMPPWSGI_REJECT_MESSAGE='busy')
+        self.fill_queue(server)
+        server.dispatcher.dispatch(self.environ('slow 3'))
+        self.assertEqual(server.dispatcher.rejected, 1)
+        self.assertEqual(self.replies, ['busy'])
+        self.release.set()
+        self.wait_replies(3)
+        server.dispatcher.stop()
+        self.assertEqual(self.replies, ['busy', 'done 1', 'done 2'])
+
+    def test_overflow_block(self):
+        server = self.make_server()
+        self.fill_queue(server)
+        # the only worker is busy with the view, nobody else waits
+        waiting = self.watch_waits(server.dispatcher)
+        blocked = threading.Thread(
+            target=server.dispatcher.dispatch, args=(self.environ('slow 3'),))
+        blocked.start()
+        self.assertTrue(waiting.wait(5))
+        self.assertTrue(blocked.is_alive())
+        self.release.set()
+        blocked.join(5)
+        self.wait_replies(3)
+        server.dispatcher.stop()
+        self.assertEqual(self.replies, ['done 1', 'done 2', 'done 3'])
+
+    def test_same_sender_handled_in_order(self):
+        server = self.make_server(XMPPWSGI_WORKERS=2, XMPPWSGI_QUEUE_SIZE=10)
+        dispatcher = server.dispatcher
+        self.assertTrue(isinstance(dispatcher, KeyedThreadPoolDispatcher))
+        dispatcher.dispatch(self.environ('slow 1'))
+        self.entered.wait(5)
+        dispatcher.dispatch(self.environ('slow 2', jid='k.bx@ya.ru/work'))
+        dispatcher.dispatch(self.environ('slow 3'))
+        # another sender is not blocked by the busy one
+        dispatcher.dispatch(self.environ('ping', jid='kxepal@ya.ru'))
+        self.wait_replies(1)
+        self.assertTrue(self.replies[0].startswith('xmppflask-worker'))
+        self.assertEqual(dispatcher.queue_depths()['k.bx@ya.ru'], 3)
+        self.assertEqual(dispatcher.queue_depth('k.bx@ya.ru'), 3)
+        self.release.set()
+        self.wait_replies(3)
+        dispatcher.stop()
+        self.assertEqual(self.replies[1:], ['done 1', 'done 2', 'done 3'])
+        self.assertEqual(dispatcher.queue_depths(), {})
+
+    def test_groupchat_keyed_by_room(self):
+        server = self.make_server(XMPPWSGI_WORKERS=2)
+        key = server.dispatcher.key
+        self.assertEqual(
+            key(self.environ('ping', jid='room@conf.ya.ru/k_bx',
+                             type='groupchat')),
+            key(self.environ('ping', jid='room@conf.ya.ru/kxepal',
+                             type='groupchat')))
+
+    def test_drop_oldest_of_same_sender(self):
+        server = self.make_server(XMPPWSGI_WORKERS=2, XMPPWSGI_QUEUE_SIZE=2,
+                                  XMPPWSGI_QUEUE_OVERFLOW='drop_oldest')
+        dispatcher = server.dispatcher
+        dispatcher.dispatch(self.environ('slow 1'))
+        self.entered.wait(5)
+        dispatcher.dispatch(self.environ('slow 2'))
+        dispatcher.dispatch(self.environ('slow 3'))
+        dispatcher.dispatch(self.environ('slow 4'))
+        self.assertEqual(dispatcher.dropped, 1)
+        self.release.set()
+        self.wait_replies(3)
+        dispatcher.stop()
+        self.assertEqual(self.replies, ['done 1', 'done 3', 'done 4'])
+
+    def test_resume_suspended_response_in_order(self):
+        self.app.session_interface = MemorySessionInterface()
+        server = self.make_server(XMPPWSGI_WORKERS=2, XMPPWSGI_QUEUE_SIZE=10)
+        dispatcher = server.dispatcher
+        future = Future()
+        suspended = threading.Event()
+        add_done_callback = future.add_done_callback
+
+        def suspend(callback):
+            add_done_callback(callback)
+            suspended.set()
+        future.add_done_callback = suspend
+        server.commands['ask'] = lambda environ, payload: future
+
+        @self.app.route('wait')
+        def wait():
+            from xmppflask import session
+            session['answer'] = yield 'ask', {}
+            yield 'got %s in %s' % (session['answer'],
+                                    threading.current_thread().name)
+
+        @self.app.route('answer')
+        def answer():
+            from xmppflask import session
+            return 'answer %s' % session.get('answer')
+
+        dispatcher.dispatch(self.environ('wait'))
+        self.assertTrue(suspended.wait(5))
+        idle = self.watch_waits(dispatcher)
+        dispatcher.dispatch(self.environ('answer'))
+        # woken up workers go back to wait, the sender is still busy
+        self.assertTrue(idle.wait(5))
+        self.assertEqual(self.replies, [])
+        self.assertEqual(dispatcher.queue_depth('k.bx@ya.ru'), 2)
+        future.set_result(42)
+        self.wait_replies(2)
+        dispatcher.stop()
+        self.assertTrue(self.replies[0].startswith('got 42 in xmppflask-'))
+        self.assertEqual(self.replies[1], 'answer 42')
+        self.assertEqual(dispatcher.queue_depths(), {})
+
+    def test_unknown_overflow_policy(self):
+        self.assertRaises(ValueError, self.make_server,
+                          XMPPWSGI_QUEUE_OVERFLOW='ignore')
+
+
+class LazyEnvironTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = LazyEnviron({'xmpp.body': u'ping'})
+        self.environ.lazy('xmpp.xml', lambda: u'<message/>')
+
+    def test_mapping_interface(self):
+        environ = self.environ
+        self.assertTrue('xmpp.xml' in environ)
+        self.assertEqual(environ.get('xmpp.xml'), u'<message/>')
+        self.assertEqual(environ.get('xmpp.delay', 0), 0)
+        self.assertRaises(KeyError, environ.__getitem__, 'xmpp.delay')
+        self.assertEqual(len(environ), 2)
+
+    def test_iteration_resolves_values(self):
+        self.assertEqual(sorted(self.environ.items()),
+                         [('xmpp.body', u'ping'), ('xmpp.xml', u'<message/>')])
+        self.assertEqual(self.environ, {'xmpp.body': u'ping',
+                                        'xmpp.xml': u'<message/>'})
+
+    def test_explicit_value_wins(self):
+        self.environ['xmpp.xml'] = u'<presence/>'
+        self.assertEqual(self.environ['xmpp.xml'], u'<presence/>')
+        self.assertEqual(self.environ.resolve()['xmpp.xml'], u'<presence/>')
+
+    def test_copy_keeps_pending_values(self):
+        environ = self.environ.copy()
+        self.assertTrue(isinstance(environ, LazyEnviron))
+        del self.environ['xmpp.xml']
+        self.assertFalse('xmpp.xml' in self.environ)
+        self.assertEqual(environ['xmpp.xml'], u'<message/>')
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.written = []
+
+    def send(self, limiter, items, lane=LANE_REPLY):
+        limiter.send([(lane, item) for item in items])
+
+    def make_limiter(self, **limits):
+        return OutboundRateLimiter(self.written.append, lambda item: item[0],
+                                   clock=lambda: self.now, **limits)
+
+    def test_global_bucket(self):
+        limiter = self.make_limiter(rate=2, burst=2)
+        self.send(limiter, [('a', 1), ('b', 1), ('c', 1)])
+        self.assertEqual(self.written, [[('a', 1), ('b', 1)]])
+        self.assertEqual(limiter.queued, 1)
+        self.assertAlmostEqual(limiter.drain(), 0.5)
+        self.now += 0.5
+        self.assertEqual(limiter.drain(), None)
+        self.assertEqual(self.written[-1], [('c', 1)])
+        self.assertEqual(limiter.stats(), {'queued': 0, 'lanes': {},
+                                           'delayed': 1, 'wait_avg': 0.5,
+                                           'wait_max': 0.5})
+
+    def test_recipient_buckets(self):
+        limiter = self.make_limiter(recipient_rate=1, recipient_burst=1)
+        self.send(limiter, [('a', 1), ('a', 2), ('b', 1), ('a', 3)])
+        self.assertEqual(self.written, [[('a', 1), ('b', 1)]])
+        self.now += 1
+        limiter.drain()
+        self.now += 1
+        limiter.drain()
+        self.assertEqual(self.written[1:], [[('a', 2)], [('a', 3)]])
+
+    def test_queued_stanzas_go_first(self):
+        limiter = self.make_limiter(rate=1, burst=1)
+        self.send(limiter, [('a', 1), ('b', 1)])
+        self.now += 1
+        self.send(limiter, [('c', 1)])
+        self.assertEqual(self.written, [[('a', 1)], [('b', 1)]])
+        self.assertEqual(limiter.queued, 1)
+
+    def test_replies_overtake_bulk(self):
+        limiter = self.make_limiter(rate=1, burst=1)
+        self.send(limiter, [('a', 1), ('b', 1), ('c', 1)], LANE_BULK)
+        self.send(limiter, [('d', 1)], LANE_REPLY)
+        self.assertEqual(limiter.stats()['lanes'], {LANE_BULK: 2,
+                                                    LANE_REPLY: 1})
+        self.now += 1
+        limiter.drain()
+        self.assertEqual(self.written, [[('a', 1)], [('d', 1)]])
+
+    def test_same_bare_recipient_keeps_order(self):
+        limiter = self.make_limiter(rate=1, burst=1)
+        limiter.send([(LANE_PRESENCE, ('room@muc/bot', 'join')),
+                      (LANE_REPLY, ('room@muc', 'hello')),
+                      (LANE_REPLY, ('user@ya.ru', 'hi'))])
+        self.now += 1
+        limiter.drain()
+        self.now += 1
+        limiter.drain()
+        self.assertEqual(self.written, [[('user@ya.ru', 'hi')],
+                                        [('room@muc/bot', 'join')],
+                                        [('room@muc', 'hello')]])
+        self.assertEqual(limiter.queued, 0)
+
+    def test_idle_buckets_pruned(self):
+        limiter = self.make_limiter(recipient_rate=1, recipient_burst=1)
+        self.send(limiter, [('a', 1), ('b', 1)])
+        self.now += limiter.prune_interval + 1
+        self.send(limiter, [('c', 1)])
+        self.assertEqual(list(limiter.buckets), ['c'])
+
+    def test_background_drain(self):
+        written = threading.Event()
+        limiter = OutboundRateLimiter(lambda items: written.set(),
+                                      lambda item: None, rate=100, burst=1)
+        self.send(limiter, [1])
+        written.clear()
+        self.send(limiter, [2])
+        limiter.start()
+        self.addCleanup(limiter.stop)
+        self.assertTrue(written.wait(1))
+
+
+class WeightedLanesTestCase(unittest.TestCase):
+
+    def test_weighted_round_robin(self):
+        lanes = WeightedLanes({'a': 3, 'b': 1})
+        for idx in range(8):
+            lanes.push('a', idx)
+            lanes.push('b', idx)
+        order = [lane for lane, _ in lanes.drain()]
+        self.assertEqual(order[:4].count('a'), 3)
+        self.assertEqual(order[4:8].count('a'), 3)
+        self.assertEqual(order[-4:], ['b', 'b', 'b', 'b'])
+        self.assertEqual(len(lanes), 0)
+
+    def test_items_of_lane_in_order(self):
+        lanes = WeightedLanes()
+        lanes.push(LANE_BULK, 1)
+        lanes.push(LANE_BULK, 2)
+        lanes.push(LANE_REPLY, 3)
+        self.assertEqual(lanes.depths(), {LANE_BULK: 2, LANE_REPLY: 1})
+        self.assertEqual(lanes.drain(), [(LANE_REPLY, 3), (LANE_BULK, 1),
+                                         (LANE_BULK, 2)])
+        self.assertRaises(IndexError, lanes.pop)
+
+
+class PendingIqTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.wheel = TimerWheel(tick=0.1, size=8, clock=lambda: self.now)
+        self.table = PendingIqTable(wheel=self.wheel)
+
+    def test_timers_fire_after_deadline(self):
+        fired = []
+        self.wheel.schedule(0.25, fired.append, 'a')
+        self.wheel.schedule(2.0, fired.append, 'b')  # beyond one revolution
+        timer = self.wheel.schedule(0.5, fired.append, 'c')
+        self.assertTrue(self.wheel.cancel(timer))
+        self.assertEqual(self.wheel.advance(100.2), 0)
+        self.assertEqual(self.wheel.advance(100.3), 1)
+        self.assertEqual(fired, ['a'])
+        self.assertEqual(self.wheel.advance(101.9), 0)
+        self.assertEqual(self.wheel.advance(102.05), 1)
+        self.assertEqual(fired, ['a', 'b'])
+        self.assertEqual(len(self.wheel), 0)
+        self.assertFalse(self.wheel.cancel(timer))
+
+    def test_resolve(self):
+        result = self.table.register('1', 'k.bx@ya.ru/home')
+        error = self.table.register('2', None)
+        self.assertEqual(len(self.table), 2)
+        self.assertFalse(self.table.resolve('1', 'evil@ya.ru', 'spoofed'))
+        self.assertTrue(self.table.resolve('1', 'k.bx@ya.ru/home', 'pong'))
+        self.assertTrue(self.table.resolve('2', 'ya.ru', 'oops', error=True))
+        self.assertFalse(self.table.resolve('3', 'ya.ru', 'unknown'))
+        self.assertEqual(result.result(), 'pong')
+        self.assertTrue(isinstance(error.exception(), IqError))
+        self.assertEqual(error.exception().stanza, 'oops')
+        self.assertEqual(len(self.table), 0)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_expire(self):
+        future = self.table.register('1', None, timeout=1)
+        self.assertRaises(RuntimeError, self.table.register, '1', None)
+        self.table.expire(100.5)
+        self.assertFalse(future.done())
+        self.table.expire(101.1)
+        self.assertTrue(isinstance(future.exception(), IqTimeout))
+        self.assertFalse('1' in self.table)
+        self.assertFalse(self.table.resolve('1', None, 'late'))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -125,3 +125,18 @@ class ResponseTestCase(unittest.TestCase):
         self.assertEqual(resp.send(None), 'foo')
         self.assertEqual(resp.send(True), 'bar')
         self.assertRaises(StopIteration, resp.send, True)
+
+    def test_closed_when_all_responses_are_over(self):
+        def gen():
+            try:
+                yield 'foo'
+            except ValueError:
+                pass
+        closed = []
+        resp = Response(gen())(Response('bar'))
+        resp.call_on_close(lambda: closed.append(True))
+        self.assertEqual(resp.send(None), 'foo')
+        self.assertEqual(resp.throw(ValueError), 'bar')
+        self.assertEqual(closed, [])
+        self.assertRaises(StopIteration, resp.send, None)
+        self.assertEqual(closed, [True])
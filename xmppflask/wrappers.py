@@ -92,11 +92,26 @@ class Response(Iterator, Callable):
     def __init__(self, data):
         self._stack = []
         self._current = self._wrap(data)
+        #: Whether response runs view code while it's iterated, i.e. it
+        #: wraps a generator.
+        self.lazy = isinstance(data, GeneratorType)
+        self._on_close = []
 
     def __call__(self, other):
         self._stack.append(self._wrap(other))
+        self.lazy = self.lazy or isinstance(other, GeneratorType)
         return self
 
+    def call_on_close(self, func):
+        """Adds a function to call once the response is over."""
+        self._on_close.append(func)
+        return func
+
+    def _closed(self):
+        callbacks, self._on_close = self._on_close, []
+        for func in callbacks:
+            func()
+
     def __iter__(self):
         return self
 
@@ -124,10 +139,18 @@ class Response(Iterator, Callable):
                 self._current = self._stack.pop(0)
                 return self.next()
             else:
+                self._closed()
                 raise
 
     def throw(self, exc_type, exc_val=None, exc_tb=None):
-        resp = self._current.throw(exc_type, exc_val, exc_tb)
+        try:
+            resp = self._current.throw(exc_type, exc_val, exc_tb)
+        except StopIteration:
+            if self._stack:
+                self._current = self._stack.pop(0)
+                return self.next()
+            self._closed()
+            raise
         if resp is not None:
             return resp
 